@@ -1,65 +1,270 @@
 #!/usr/bin/python
-from os import listdir
-from os.path import abspath, basename, dirname, exists, isdir
+from os.path import abspath, basename, dirname, exists
 from re import match
 import sys
 
+from image_tools.FileLinker import FileLinker, LINK_MODES, LinkNotSupportedError
+from image_tools.HashIndex import HashIndex, HASH_INDEX_FILENAME
 from image_tools.ImageToolsShared import ImageFileInfoTool, getTestFilePaths
+from image_tools.RunStats import NULL_RUN_STATS, addRunStatsArguments, openRunStats, runProfiled, writeRunStats
+from image_tools.Storage import LOCAL_STORAGE, addStorageArguments, openStorage
 from py_base.Job import Job
+from py_base.PySystemMock import PySystemMock
 
 
 REGEX_ALL_STARS_FOLDER = '^[Aa]ll ?[Ss]tars?$'
 DEFAULT_ALL_STAR_FOLDER_NAME = 'AllStars'
+DUPLICATE_MODES = ['skip', 'link']
 
 class AllStarCopier(Job):
+    resolvedAllStarsFullPaths = None  # directory -> all star folders for images in it (see resolveAllStarsFullPaths())
+    fileLinker = None
+    hashIndexes = None  # all star folder -> HashIndex
+    pendingCopies = None  # [(source, target, size, sha1 or None)] waiting for flushCopies()
+    stats = NULL_RUN_STATS
+    storage = LOCAL_STORAGE
 
     def defineCustomArguments(self, parser):
+        parser.add_argument('--link-mode',
+                            choices=LINK_MODES,
+                            default='auto',
+                            help="How to put images in the All-Star folder: a full copy, a copy-on-write clone (reflink), "
+                                 "a hard or symbolic link, or auto: a clone if possible, otherwise a copy (default auto)",
+                            )
+        parser.add_argument('--duplicates',
+                            choices=DUPLICATE_MODES,
+                            default='skip',
+                            help="What to do with an image that's already in the All-Star folder, maybe under another name: "
+                                 "skip it, or link it (a hard link to the one that's already there) (default skip)",
+                            )
+        parser.add_argument('--dedupe',
+                            action='store_true',
+                            default=False,
+                            help="Instead of copying, clean up the given All-Star folder(s): images that are the same as "
+                                 "another one are removed (--duplicates=skip) or made hard links to it (--duplicates=link)",
+                            )
+        addRunStatsArguments(parser)
+        addStorageArguments(parser)
         parser.add_argument('path',
                             nargs='*',
                             help="Path(s) of the image(s) to scale, space separated if multiple",
                             )
     def doRunSteps(self, imageTool=None):
+        self.stats = openRunStats(self.arguments)
+        self.storage = openStorage(self.arguments)
         if imageTool == None:
-            imageTool = ImageFileInfoTool(self.out, self.system)
+            imageTool = ImageFileInfoTool(self.out, self.system, stats=self.stats, storage=self.storage)
+        self.hashIndexes = {}
+        try:
+            if self.arguments.get('dedupe'):
+                runProfiled(self.out, self.arguments, self.dedupeAll)
+            else:
+                runProfiled(self.out, self.arguments, self.copyAllToAllStars, imageTool)
+        finally:
+            self.saveHashIndexes()
+            self.storage.close()
+            writeRunStats(self.out, self.arguments, self.stats, 'all-star')
+
+    def copyAllToAllStars(self, imageTool):
+        self.resolvedAllStarsFullPaths = {}
+
+        # resolve all the destinations first, so the copies can be grouped by AllStars folder
+        sourcesByAllStarsFullPath = {}
         for fullPath in self.getNormalizedPathArgument():
             fullPath = imageTool.renameFileIfNecessary(fullPath)
-            self.copyToAllStars(fullPath)
+            for allStarsFullPath in self.getDestinationAllStarsFullPaths(fullPath):
+                sourcesByAllStarsFullPath.setdefault(allStarsFullPath, []).append(fullPath)
+        for allStarsFullPath in sorted(sourcesByAllStarsFullPath.keys()):
+            self.out.put('copying %d file(s) to AllStar folder %s.' % (len(sourcesByAllStarsFullPath[allStarsFullPath]), allStarsFullPath))
+            for sourceFullPath in sourcesByAllStarsFullPath[allStarsFullPath]:
+                self._copyToAllStars(sourceFullPath, allStarsFullPath)
+            self.flushCopies()
 
-    def copyToAllStars(self, sourceFullPath, currentPath=None):
+    def copyToAllStars(self, sourceFullPath):
         '''
-        Recursive function to copy an image (sourceFullPath) to the first all star folder.
-
-        Recursion level is indicated by currentPath: if None, it's the first level;
-        if /path/to/some/directory, then that's the current PARENT folder that's being searched.
+        copy an image (sourceFullPath) to the nearest all star folder(s).
+        '''
+        for allStarsFullPath in self.getDestinationAllStarsFullPaths(sourceFullPath):
+            self.out.put('found AllStar folder %s.' % allStarsFullPath)
+            self._copyToAllStars(sourceFullPath, allStarsFullPath)
+        self.flushCopies()
 
-        REMEMBER: all-star folders are always CHILDREN of some ancestor of the original image.
+    def getDestinationAllStarsFullPaths(self, sourceFullPath):
         '''
-        if currentPath == None:
-            currentPath = dirname(sourceFullPath)
-        self.out.put('looking in %s for an AllStars folder...' % currentPath)
-        if currentPath == '/':
+        the all star folder(s) to copy an image to. If there are none, a new one is created
+        as a sibling of the image.
+        '''
+        currentPath = dirname(sourceFullPath)
+        allStarsFullPaths = self.resolveAllStarsFullPaths(currentPath)
+        if not allStarsFullPaths:
             # we got all the way to the root without finding an all star folder to use.
             # create a new all star folder as a sibling of the image.
-            currentPath = dirname(sourceFullPath)
             allStarsFullPath = '%s/%s' % (currentPath, DEFAULT_ALL_STAR_FOLDER_NAME)
-
             self.out.put("Creating new all-star folder %s..." % (allStarsFullPath))
             self.system.mkdir(allStarsFullPath)
-            self._copyToAllStars(sourceFullPath, allStarsFullPath)
+            allStarsFullPaths = [allStarsFullPath]
+            # other images in the same folder should use the new one
+            self.resolvedAllStarsFullPaths[currentPath] = allStarsFullPaths
+        return allStarsFullPaths
+
+    def resolveAllStarsFullPaths(self, currentPath):
+        '''
+        find the all star folders for images in currentPath: the ones in the nearest ancestor
+        (starting with currentPath itself) that has any. Returns [] if none were found up to the root.
+
+        REMEMBER: all-star folders are always CHILDREN of some ancestor of the original image.
+
+        The result for each directory on the way up is remembered for the rest of the run,
+        so images that share a folder (or an ancestor) only list each directory once.
+        '''
+        if self.resolvedAllStarsFullPaths == None:
+            self.resolvedAllStarsFullPaths = {}
+        if currentPath in self.resolvedAllStarsFullPaths:
+            return self.resolvedAllStarsFullPaths[currentPath]
+        if currentPath in ['/', '']:
+            allStarsFullPaths = []
         else:
+            self.out.put('looking in %s for an AllStars folder...' % currentPath)
             allStarsFullPaths = self.getAllStarsFullPaths(currentPath)
             if not allStarsFullPaths:
-                # recurse
                 self.out.put('no all star folders at the current level.')
-                self.copyToAllStars(sourceFullPath, currentPath=dirname(currentPath))
-            for allStarsFullPath in allStarsFullPaths:
-                self.out.put('found existing AllStar folder %s.' % allStarsFullPath)
-                self._copyToAllStars(sourceFullPath, allStarsFullPath)
+                allStarsFullPaths = self.resolveAllStarsFullPaths(dirname(currentPath))
+        self.resolvedAllStarsFullPaths[currentPath] = allStarsFullPaths
+        return allStarsFullPaths
+
+    def getHashIndex(self, allStarsFullPath):
+        if self.hashIndexes == None:
+            self.hashIndexes = {}
+        if allStarsFullPath not in self.hashIndexes:
+            self.hashIndexes[allStarsFullPath] = HashIndex(allStarsFullPath, self.stats, self.storage)
+        return self.hashIndexes[allStarsFullPath]
+
+    def saveHashIndexes(self):
+        if self.inDebugMode():
+            # if we're running in mock mode, then we shouldn't be changing anything on the filesystem.
+            self.out.put("DEBUG: Not saving %s files because we're in mock mode" % HASH_INDEX_FILENAME)
+            return
+        for hashIndex in self.hashIndexes.values():
+            try:
+                hashIndex.save()
+            except (IOError, OSError), e:
+                self.out.put("ERROR: Unable to save %s: %s" % (hashIndex.fullPath, e), self.out.LOG_LEVEL_ERROR)
 
     def _copyToAllStars(self, sourceFullPath, allStarsFullPath):
         targetFullPath = '%s/%s' % (allStarsFullPath, basename(sourceFullPath))
         self.out.put("Copying %s to All-Star folder %s..." % (sourceFullPath, allStarsFullPath))
-        self.system.copy(sourceFullPath, targetFullPath)
+        if self.fileLinker == None:
+            self.fileLinker = FileLinker(self.out, self.system, self.inDebugMode())
+        hashIndex = self.getHashIndex(allStarsFullPath)
+        if self.isCopyingInBulk():
+            if self.pendingCopies == None:
+                self.pendingCopies = []
+            size = self.storage.getsize(sourceFullPath)
+            if [target for (source, target, pendingSize, sha1) in self.pendingCopies if target == targetFullPath or pendingSize == size]:
+                # it could be a duplicate of a file that isn't there yet
+                self.flushCopies()
+        (duplicateName, sourceHash) = hashIndex.findDuplicate(sourceFullPath)
+        if duplicateName != None:
+            if duplicateName == basename(sourceFullPath) or self.arguments['duplicates'] == 'skip':
+                self.out.put("- skipped: %s is already there as %s" % (basename(sourceFullPath), duplicateName))
+                self.stats.count('duplicates skipped')
+                return
+            self.out.put("- %s is already there as %s; linking to it" % (basename(sourceFullPath), duplicateName))
+            self.linkToDuplicate(hashIndex, duplicateName, basename(sourceFullPath))
+            return
+        if self.isCopyingInBulk():
+            self.pendingCopies.append((sourceFullPath, targetFullPath, size, sourceHash))
+            return
+        try:
+            with self.stats.timer('copy'):
+                method = self.fileLinker.link(sourceFullPath, targetFullPath, self.arguments['link_mode'])
+        except LinkNotSupportedError, e:
+            self.out.put("ERROR: Unable to %s %s here (try --link-mode=auto): %s" % (self.arguments['link_mode'], sourceFullPath, e),
+                         self.out.LOG_LEVEL_ERROR)
+            return
+        self.copied(sourceFullPath, targetFullPath, sourceHash, method)
+
+    def copied(self, sourceFullPath, targetFullPath, sourceHash, method, targetStat=None):
+        self.out.put("- done (%s)" % method, self.out.LOG_LEVEL_VERBOSE)
+        self.getHashIndex(dirname(targetFullPath)).add(basename(targetFullPath), sourceHash, targetStat)
+        self.stats.count('files')
+        self.stats.count('copies (%s)' % method)
+        if self.stats.enabled and method in ['copy', 'kernel copy'] and not self.inDebugMode():
+            # (reflinks and links don't write the data again)
+            size = self.storage.getsize(sourceFullPath)
+            self.stats.count('bytes read', size)
+            self.stats.count('bytes written', size)
+
+    def isCopyingInBulk(self):
+        '''
+        whether plain copies wait in pendingCopies, to be done many at once by a concurrent
+        storage (see flushCopies()) instead of one after the other
+        '''
+        return self.storage.concurrent and self.arguments['link_mode'] == 'copy' and not self.inDebugMode()
+
+    def flushCopies(self):
+        '''
+        do the copies waiting in pendingCopies, all at once
+        '''
+        if not self.pendingCopies:
+            return
+        (copies, self.pendingCopies) = (self.pendingCopies, [])
+        with self.stats.timer('copy'):
+            errors = self.storage.copyMany([(source, target) for (source, target, size, sha1) in copies])
+        targetStats = self.storage.statMany([target for (source, target, size, sha1) in copies])
+        for ((sourceFullPath, targetFullPath, size, sourceHash), error, targetStat) in zip(copies, errors, targetStats):
+            if error != None or targetStat == None:
+                self.out.put("ERROR: Unable to copy %s: %s" % (sourceFullPath, error), self.out.LOG_LEVEL_ERROR)
+                continue
+            self.copied(sourceFullPath, targetFullPath, sourceHash, 'copy', targetStat)
+
+    def linkToDuplicate(self, hashIndex, name, duplicateName):
+        '''
+        make duplicateName (in the folder of hashIndex) a hard link to name, which has the same content
+        '''
+        try:
+            self.fileLinker.link('%s/%s' % (hashIndex.directory, name), '%s/%s' % (hashIndex.directory, duplicateName), 'hardlink')
+        except LinkNotSupportedError, e:
+            self.out.put("ERROR: Unable to link %s to %s: %s" % (duplicateName, name, e), self.out.LOG_LEVEL_ERROR)
+            return
+        hashIndex.add(duplicateName)
+        self.stats.count('duplicates linked')
+
+    def dedupeAll(self):
+        '''
+        for --dedupe: remove (or hard link) the images in each given all star folder that have the
+        same content as another one there. The first name (sorted) of each group is kept.
+        '''
+        if self.fileLinker == None:
+            self.fileLinker = FileLinker(self.out, self.system, self.inDebugMode())
+        for allStarsFullPath in self.getNormalizedPathArgument():
+            if not self.storage.isdir(allStarsFullPath):
+                self.out.put("Skipping %s because it isn't a folder." % allStarsFullPath, self.out.LOG_LEVEL_WARN)
+                continue
+            self.out.indent("Looking for duplicates in %s..." % allStarsFullPath)
+            hashIndex = self.getHashIndex(allStarsFullPath)
+            for group in hashIndex.getDuplicateGroups():
+                (kept, duplicateNames) = (group[0], group[1:])
+                for duplicateName in duplicateNames:
+                    (duplicateStat, keptStat) = self.storage.statMany(['%s/%s' % (allStarsFullPath, duplicateName),
+                                                                        '%s/%s' % (allStarsFullPath, kept)])
+                    if duplicateStat == None or keptStat == None:
+                        # gone since the folder was read
+                        continue
+                    if duplicateStat.st_ino == keptStat.st_ino:
+                        # already linked
+                        continue
+                    if self.arguments['duplicates'] == 'link':
+                        self.out.put("%s is the same as %s; linking it" % (duplicateName, kept))
+                        self.linkToDuplicate(hashIndex, kept, duplicateName)
+                    elif self.inDebugMode():
+                        self.out.put("DEBUG: Not removing %s (the same as %s) because we're in mock mode" % (duplicateName, kept))
+                    else:
+                        self.out.put("%s is the same as %s; removing it" % (duplicateName, kept))
+                        self.storage.remove('%s/%s' % (allStarsFullPath, duplicateName))
+                        hashIndex.remove(duplicateName)
+                        self.stats.count('duplicates removed')
+            self.out.unIndent()
 
     def getAllStarsFullPaths(self, path):
         self.out.put("Looking for all stars path in %s" % (path), self.out.LOG_LEVEL_VERBOSE)
@@ -68,7 +273,9 @@ class AllStarCopier(Job):
         # list the subfolder contents of path
         # I'm using sorted() here so that there is consistency
         # in the order of preference when multiple folders exist
-        for filename in sorted(listdir(path)):
+        with self.stats.timer('listdir'):
+            filenames = sorted(self.storage.listdir(path))
+        for filename in filenames:
             # does this name match the regex?
             if not self.isAllStarFolder(filename):
                 self.out.put("- filename %s failed all star regex" % filename, self.out.LOG_LEVEL_DEBUG)
@@ -78,7 +285,7 @@ class AllStarCopier(Job):
 
             # is the matching name a folder?
             allStarsFullPath = "%s/%s" % (path, filename)
-            if isdir(allStarsFullPath):
+            if self.storage.isdir(allStarsFullPath):
                 # we've found what we are looking for
                 self.out.put("- full path %s is a confirmed directory! Adding to result list." % allStarsFullPath, self.out.LOG_LEVEL_DEBUG)
                 result.append(allStarsFullPath)
@@ -87,6 +294,9 @@ class AllStarCopier(Job):
     def isAllStarFolder(self, filename):
         return match(REGEX_ALL_STARS_FOLDER, filename)
 
+    def inDebugMode(self):
+        return self.system.__class__ == PySystemMock
+
 if __name__ == "__main__":
     from py_base.Job import runMockJob
     runMockJob(AllStarCopier, arguments={'path': getTestFilePaths()})
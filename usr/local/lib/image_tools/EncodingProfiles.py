@@ -0,0 +1,152 @@
+'''
+Named sets of encoder settings for the files ImageScaler writes (--encoding), and the search
+for the JPEG/WebP quality that hits a file size (--target-size).
+'''
+from cStringIO import StringIO
+from os.path import splitext
+
+
+DEFAULT_ENCODING = 'fast'
+DEFAULT_FORMAT = 'same'
+
+# profile -> PIL format -> save() options
+ENCODING_PROFILES = {
+    # PIL's defaults (which is what scale-image always did), and WebP's quickest method
+    'fast': {'JPEG': {'quality': 75},
+             'WEBP': {'quality': 75, 'method': 0},
+             'PNG': {},
+             },
+    # smaller files for the web: optimized Huffman tables, progressive, 4:2:0 chroma
+    'web': {'JPEG': {'quality': 78, 'optimize': True, 'progressive': True, 'subsampling': 2},
+            'WEBP': {'quality': 80, 'method': 4},
+            'PNG': {'optimize': True},
+            },
+    # as close to the original as is reasonable: full chroma resolution
+    'archive': {'JPEG': {'quality': 95, 'optimize': True, 'subsampling': 0},
+                'WEBP': {'quality': 95, 'method': 6},
+                'PNG': {'optimize': True},
+                },
+}
+
+# --format -> (PIL format, file extension)
+OUTPUT_FORMATS = {'jpeg': ('JPEG', '.jpg'),
+                  'webp': ('WEBP', '.webp'),
+                  'png': ('PNG', '.png'),
+                  }
+EXTENSION_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP', '.png': 'PNG'}
+# formats that have a quality setting, and that take a raw EXIF block when saving
+LOSSY_FORMATS = ['JPEG', 'WEBP']
+
+MIN_QUALITY = 20
+PROXY_PIXELS = 256 * 256  # how big the stand-in image for the quality search is
+TARGET_SIZE_ATTEMPTS = 3  # full size encodes, at most
+TARGET_SIZE_SLACK = 0.9  # a file this close under the target size is close enough
+
+def getFormatByFileName(fileName):
+    '''
+    the PIL format a file will be written in, going by its extension (None if it's not one we have settings for)
+    '''
+    return EXTENSION_FORMATS.get(splitext(fileName)[1].lower())
+
+def getSaveOptions(encoding, pilFormat):
+    return dict(ENCODING_PROFILES[encoding].get(pilFormat, {}))
+
+def prepareForFormat(image, pilFormat):
+    '''
+    convert image to a mode pilFormat can store (eg. a PNG with transparency saved as a JPEG)
+    '''
+    if pilFormat == 'JPEG' and image.mode not in ['RGB', 'L', 'CMYK']:
+        return image.convert('RGB')
+    return image
+
+def saveImage(image, target, pilFormat, saveOptions):
+    '''
+    save image to a file name or file object. pilFormat can be None to go by the file name's extension.
+    '''
+    if saveOptions.get('optimize') or saveOptions.get('progressive'):
+        # old versions of PIL need the whole JPEG to fit in one output block to optimize it
+        from PIL import ImageFile
+        ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, image.size[0] * image.size[1] * 4)
+    image.save(target, pilFormat, **saveOptions)
+
+def getEncodedSize(image, pilFormat, saveOptions):
+    buf = StringIO()
+    saveImage(image, buf, pilFormat, saveOptions)
+    return buf.tell()
+
+def makeProxy(image):
+    '''
+    a smaller copy of image to try quality settings on, and how many times fewer pixels it has
+    '''
+    pixels = image.size[0] * image.size[1]
+    if pixels <= PROXY_PIXELS:
+        return (image, 1.0)
+    from PIL import Image
+    scale = (float(PROXY_PIXELS) / pixels) ** 0.5
+    proxy = image.resize((max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale))), Image.BILINEAR)
+    return (proxy, float(pixels) / (proxy.size[0] * proxy.size[1]))
+
+def findQualityOnProxy(proxy, pixelRatio, pilFormat, saveOptions, targetBytes, low, high):
+    '''
+    bisect for the highest quality from low to high whose proxy, scaled up by pixelRatio, fits in
+    targetBytes. Returns (quality or None if none fit, the number of proxy encodes).
+    '''
+    options = dict(saveOptions)
+    best = None
+    encodes = 0
+    while low <= high:
+        quality = (low + high) / 2
+        options['quality'] = quality
+        encodes += 1
+        if getEncodedSize(proxy, pilFormat, options) * pixelRatio <= targetBytes:
+            best = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    return (best, encodes)
+
+def encodeToTargetSize(image, pilFormat, saveOptions, targetBytes):
+    '''
+    encode image at the highest quality that fits in targetBytes (or MIN_QUALITY, if nothing does).
+
+    The quality is found by bisecting on a small proxy of the image, so each step costs a fraction
+    of a full encode. Files don't shrink exactly with their pixel count, so after each full encode
+    the proxy's estimate is corrected by how far off it was, and if the file is too big (or a lot
+    smaller than it could be), the search goes on from there, for at most TARGET_SIZE_ATTEMPTS full encodes.
+
+    Returns (the encoded file's bytes, quality, number of proxy encodes).
+    '''
+    (proxy, pixelRatio) = makeProxy(image)
+    (low, high) = (MIN_QUALITY, saveOptions.get('quality', 95))
+    options = dict(saveOptions)
+    proxyEncodes = 0
+    tried = {}  # quality -> encoded bytes
+    for attempt in range(TARGET_SIZE_ATTEMPTS):
+        (quality, encodes) = findQualityOnProxy(proxy, pixelRatio, pilFormat, saveOptions, targetBytes, low, high)
+        proxyEncodes += encodes
+        if quality == None:
+            # nothing above low looks like it fits; the last one tried is as good as it gets
+            quality = max(low - 1, MIN_QUALITY)
+        if quality in tried:
+            break
+        options['quality'] = quality
+        buf = StringIO()
+        saveImage(image, buf, pilFormat, options)
+        tried[quality] = buf.getvalue()
+        size = len(tried[quality])
+        if targetBytes * TARGET_SIZE_SLACK <= size <= targetBytes:
+            break
+        if size > targetBytes:
+            high = quality - 1
+        else:
+            low = quality + 1
+        if low > high:
+            break
+        pixelRatio = float(size) / getEncodedSize(proxy, pilFormat, options)
+        proxyEncodes += 1
+    fitting = [quality for (quality, data) in tried.items() if len(data) <= targetBytes]
+    if fitting:
+        quality = max(fitting)
+    else:
+        quality = min(tried)
+    return (tried[quality], quality, proxyEncodes)
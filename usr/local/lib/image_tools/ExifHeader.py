@@ -0,0 +1,220 @@
+'''
+Minimal reader for the few EXIF tags we need (Orientation and DateTimeOriginal),
+straight from the JPEG markers and the TIFF IFD chain in the APP1 segment.
+
+This only ever reads the first few KB of a file, instead of loading the whole
+metadata block (MakerNotes, XMP, IPTC, thumbnails) through libexiv2. Anything
+out of the ordinary raises ExifHeaderError, and the caller should fall back to
+pyexiv2 (see ImageFileMetadata.readExifFields()).
+'''
+from datetime import datetime
+from struct import error as StructError, pack, unpack, unpack_from
+
+from image_tools.Storage import LOCAL_STORAGE
+
+
+EXIF_PREFIX = 'Exif\x00\x00'
+EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+TAG_ORIENTATION = 0x0112
+TAG_EXIF_IFD_POINTER = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+TYPE_ASCII = 2
+TYPE_SHORT = 3
+TYPE_LONG = 4
+
+MARKER_APP1 = 0xE1
+MARKER_SOS = 0xDA
+MARKER_EOI = 0xD9
+# start of frame markers hold the image dimensions. C4, C8 and CC are something else.
+MARKERS_SOF = [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+MAX_SEGMENTS = 32
+
+class ExifHeaderError(Exception):
+    pass
+
+class ExifHeader:
+
+    def __init__(self):
+        self.dateTimeOriginal = None
+        self.orientation = None
+        self.orientationOffset = None  # where the orientation value is in the APP1 block
+        self.exifOffset = None  # where the APP1 block is in the file (only from readJpegHeader())
+        self.endian = None
+        self.width = None
+        self.height = None
+
+    def getFields(self):
+        '''
+        the same fields as ImageFileMetadata.readExifFields()
+        '''
+        return {'datetime': self.dateTimeOriginal,
+                'orientation': self.orientation,
+                'width': self.width,
+                'height': self.height}
+
+def readJpegHeader(fullPath, storage=LOCAL_STORAGE):
+    '''
+    read the EXIF header and the dimensions of a JPEG, reading only the segments before the image data.
+    A JPEG without EXIF isn't an error; its date and orientation are just None.
+    '''
+    header = None
+    width = height = None
+    f = storage.open(fullPath, 'rb')
+    try:
+        if f.read(2) != '\xff\xd8':
+            raise ExifHeaderError("%s is not a JPEG file" % fullPath)
+        for i in range(MAX_SEGMENTS):
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != '\xff':
+                raise ExifHeaderError("Unexpected data instead of a JPEG marker in %s" % fullPath)
+            code = ord(marker[1])
+            if code == MARKER_SOS or code == MARKER_EOI:
+                break
+            length = unpack('>H', f.read(2))[0]
+            if length < 2:
+                raise ExifHeaderError("Bad segment length in %s" % fullPath)
+            if code == MARKER_APP1 and header == None:
+                blockOffset = f.tell()
+                block = f.read(length - 2)
+                if block.startswith(EXIF_PREFIX):
+                    header = parseExifBlock(block)
+                    header.exifOffset = blockOffset
+                # (otherwise it's probably XMP, which we don't need)
+            elif code in MARKERS_SOF:
+                (precision, height, width) = unpack('>BHH', f.read(5))
+                break
+            else:
+                f.seek(length - 2, 1)
+    except StructError:
+        raise ExifHeaderError("%s is truncated" % fullPath)
+    finally:
+        f.close()
+    if width == None:
+        raise ExifHeaderError("Didn't find the image dimensions in the first %d segments of %s" % (MAX_SEGMENTS, fullPath))
+    if header == None:
+        header = ExifHeader()
+    header.width = width
+    header.height = height
+    return header
+
+def parseExifBlock(block):
+    '''
+    parse an APP1 EXIF block (starting with "Exif\\0\\0"), as found in a JPEG or in PIL's image.info['exif'].
+    '''
+    try:
+        return _parseExifBlock(block)
+    except StructError:
+        raise ExifHeaderError("EXIF block is truncated")
+
+def setOrientation(block, orientation):
+    '''
+    a copy of an APP1 EXIF block with its Orientation tag changed (if it has one), eg. to 1 once
+    the pixels have been turned upright
+    '''
+    header = parseExifBlock(block)
+    if header.orientationOffset == None:
+        return block
+    return block[:header.orientationOffset] + pack(header.endian + 'H', orientation) + block[header.orientationOffset + 2:]
+
+def writeJpegOrientation(fullPath, orientation):
+    '''
+    change the Orientation tag of a JPEG in place, without rewriting the file.
+    Returns False if the file has no Orientation tag to change.
+    '''
+    header = readJpegHeader(fullPath)
+    if header.orientationOffset == None:
+        return False
+    f = open(fullPath, 'r+b')
+    try:
+        f.seek(header.exifOffset + header.orientationOffset)
+        f.write(pack(header.endian + 'H', orientation))
+    finally:
+        f.close()
+    return True
+
+def _parseExifBlock(block):
+    if not block.startswith(EXIF_PREFIX) or len(block) < 14:
+        raise ExifHeaderError("Not an EXIF block")
+    base = len(EXIF_PREFIX)  # offsets in the TIFF structure are relative to here
+    byteOrder = block[base:base + 2]
+    if byteOrder == 'II':
+        endian = '<'
+    elif byteOrder == 'MM':
+        endian = '>'
+    else:
+        raise ExifHeaderError("Unknown TIFF byte order %r" % byteOrder)
+    (magic, ifd0Offset) = unpack_from(endian + 'HI', block, base + 2)
+    if magic != 42:
+        raise ExifHeaderError("Bad TIFF header")
+
+    header = ExifHeader()
+    header.endian = endian
+    ifd0 = _readIfd(block, base + ifd0Offset, endian)
+    if TAG_ORIENTATION in ifd0:
+        (valueType, count, valueOffset) = ifd0[TAG_ORIENTATION]
+        if valueType != TYPE_SHORT or count != 1:
+            raise ExifHeaderError("Unexpected orientation tag format")
+        header.orientation = unpack_from(endian + 'H', block, valueOffset)[0]
+        header.orientationOffset = valueOffset
+    if TAG_EXIF_IFD_POINTER in ifd0:
+        (valueType, count, valueOffset) = ifd0[TAG_EXIF_IFD_POINTER]
+        if valueType != TYPE_LONG or count != 1:
+            raise ExifHeaderError("Unexpected EXIF IFD pointer format")
+        exifIfd = _readIfd(block, base + unpack_from(endian + 'I', block, valueOffset)[0], endian)
+        if TAG_DATETIME_ORIGINAL in exifIfd:
+            header.dateTimeOriginal = _readDateTime(block, base, exifIfd[TAG_DATETIME_ORIGINAL], endian)
+    return header
+
+def _readIfd(block, start, endian):
+    '''
+    returns {tag: (type, count, offset of the value field)} for an IFD starting at block[start]
+    '''
+    if start + 2 > len(block):
+        raise ExifHeaderError("IFD offset is past the end of the EXIF block")
+    count = unpack_from(endian + 'H', block, start)[0]
+    if start + 2 + 12 * count > len(block):
+        raise ExifHeaderError("IFD runs past the end of the EXIF block")
+    entries = {}
+    for i in range(count):
+        entryOffset = start + 2 + 12 * i
+        (tag, valueType, valueCount) = unpack_from(endian + 'HHI', block, entryOffset)
+        entries[tag] = (valueType, valueCount, entryOffset + 8)
+    return entries
+
+def _readDateTime(block, base, entry, endian):
+    (valueType, count, valueOffset) = entry
+    if valueType != TYPE_ASCII:
+        raise ExifHeaderError("Unexpected date tag format")
+    if count > 4:
+        # too long to fit in the entry itself, so the entry holds an offset to it
+        valueOffset = base + unpack_from(endian + 'I', block, valueOffset)[0]
+    if valueOffset + count > len(block):
+        raise ExifHeaderError("Date runs past the end of the EXIF block")
+    text = block[valueOffset:valueOffset + count].rstrip('\x00 ')
+    try:
+        return datetime.strptime(text, EXIF_DATETIME_FORMAT)
+    except ValueError:
+        # the same as pyexiv2: a malformed date is no date
+        return None
+
+def buildExifBlock(dateTimeOriginal=None, orientation=None, endian='<'):
+    '''
+    build a minimal APP1 EXIF block with just these tags, eg. to save synthetic test images with
+    PIL (image.save(path, exif=block)).
+    '''
+    byteOrder = {'<': 'II', '>': 'MM'}[endian]
+    ifd0Entries = []
+    if orientation != None:
+        ifd0Entries.append(pack(endian + 'HHIHH', TAG_ORIENTATION, TYPE_SHORT, 1, orientation, 0))
+    exifIfd = ''
+    if dateTimeOriginal != None:
+        ifd0Size = 2 + 12 * (len(ifd0Entries) + 1) + 4
+        exifIfdOffset = 8 + ifd0Size
+        text = dateTimeOriginal.strftime(EXIF_DATETIME_FORMAT) + '\x00'
+        textOffset = exifIfdOffset + 2 + 12 + 4
+        ifd0Entries.append(pack(endian + 'HHII', TAG_EXIF_IFD_POINTER, TYPE_LONG, 1, exifIfdOffset))
+        exifIfd = pack(endian + 'H', 1) + pack(endian + 'HHII', TAG_DATETIME_ORIGINAL, TYPE_ASCII, len(text), textOffset) + pack(endian + 'I', 0) + text
+    ifd0 = pack(endian + 'H', len(ifd0Entries)) + ''.join(ifd0Entries) + pack(endian + 'I', 0)
+    return EXIF_PREFIX + byteOrder + pack(endian + 'HI', 42, 8) + ifd0 + exifIfd
@@ -0,0 +1,169 @@
+import errno
+import fcntl
+import os
+from os.path import abspath
+import shutil
+
+
+LINK_MODES = ['auto', 'copy', 'reflink', 'hardlink', 'symlink']
+FICLONE = 0x40049409  # from linux/fs.h: _IOW(0x94, 9, int)
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# errors that mean "this filesystem (or kernel, or pair of filesystems) can't do that"
+UNSUPPORTED_ERRNOS = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM]
+
+class LinkNotSupportedError(Exception):
+    pass
+
+_kernelCopyFunctions = None
+
+def getKernelCopyFunctions():
+    '''
+    (copy_file_range, sendfile) from the C library, each None if it doesn't have it.
+    (python 2's os module has neither.)
+    '''
+    global _kernelCopyFunctions
+    if _kernelCopyFunctions == None:
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        except OSError:
+            libc = None
+        functions = []
+        for (name, argtypes) in [('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                                      ctypes.c_size_t, ctypes.c_uint]),
+                                 ('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])]:
+            function = getattr(libc, name, None)
+            if function != None:
+                function.argtypes = argtypes
+                function.restype = ctypes.c_ssize_t
+            functions.append(function)
+        _kernelCopyFunctions = tuple(functions)
+    return _kernelCopyFunctions
+
+class FileLinker:
+    '''
+    Puts a copy (or a link) of a file somewhere else, with one of these modes:
+
+    copy:     a normal copy, through the system object
+    reflink:  a copy-on-write clone (btrfs, XFS), which is instant and shares the data blocks
+    hardlink: another name for the same file
+    symlink:  a symbolic link to the (absolute) source path
+    auto:     a reflink if the filesystem can do it, otherwise a copy done by the kernel
+              (copy_file_range/sendfile), otherwise a normal copy
+
+    reflink and auto give an independent file, just like copy. hardlink and symlink don't:
+    changes to one are changes to the other.
+    '''
+
+    def __init__(self, out, system, debugMode=False):
+        self.out = out
+        self.system = system
+        self.debugMode = debugMode
+
+    def link(self, sourceFullPath, targetFullPath, mode='auto'):
+        '''
+        returns the name of the method that was actually used
+        '''
+        if self.debugMode and mode != 'copy':
+            # we shouldn't be changing anything on the filesystem. The (mock) system copy will say what it would do.
+            self.out.put("DEBUG: Not using link mode '%s' because we're in mock mode" % mode)
+            mode = 'copy'
+        if mode == 'copy':
+            self.system.copy(sourceFullPath, targetFullPath)
+            return 'copy'
+        if mode == 'reflink':
+            self.reflink(sourceFullPath, targetFullPath)
+            return 'reflink'
+        if mode == 'hardlink':
+            self._replaceWith(targetFullPath, lambda tempFullPath: os.link(sourceFullPath, tempFullPath))
+            return 'hardlink'
+        if mode == 'symlink':
+            self._replaceWith(targetFullPath, lambda tempFullPath: os.symlink(abspath(sourceFullPath), tempFullPath))
+            return 'symlink'
+        if mode == 'auto':
+            for (method, function) in [('reflink', self.reflink),
+                                       ('kernel copy', self.kernelCopy)]:
+                try:
+                    function(sourceFullPath, targetFullPath)
+                    return method
+                except LinkNotSupportedError, e:
+                    self.out.put("- %s isn't possible here: %s" % (method, e), self.out.LOG_LEVEL_DEBUG)
+            self.system.copy(sourceFullPath, targetFullPath)
+            return 'copy'
+        raise ValueError("Unknown link mode '%s'" % mode)
+
+    def reflink(self, sourceFullPath, targetFullPath):
+        self._copyWith(sourceFullPath, targetFullPath, self._clone)
+
+    def kernelCopy(self, sourceFullPath, targetFullPath):
+        '''
+        copy without the data ever passing through this process: copy_file_range() (which NFS and
+        SMB can even do on the server), or else sendfile(), called from the C library through ctypes
+        '''
+        if getKernelCopyFunctions() == (None, None):
+            raise LinkNotSupportedError("the C library has neither copy_file_range nor sendfile")
+        self._copyWith(sourceFullPath, targetFullPath, self._copyInKernel)
+
+    def _clone(self, source, target):
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+    def _copyInKernel(self, source, target):
+        import ctypes
+        (copyFileRange, sendFile) = getKernelCopyFunctions()
+        size = os.fstat(source.fileno()).st_size
+        remaining = size
+        while remaining > 0:
+            count = min(remaining, KERNEL_COPY_CHUNK_SIZE)
+            if copyFileRange != None:
+                copied = copyFileRange(source.fileno(), None, target.fileno(), None, count, 0)
+            else:
+                copied = sendFile(target.fileno(), source.fileno(), None, count)
+            if copied < 0:
+                error = ctypes.get_errno()
+                if copyFileRange != None and error in [errno.ENOSYS, errno.EXDEV] and remaining == size:
+                    # older kernels can't copy_file_range() at all, or between filesystems; sendfile() can
+                    copyFileRange = None
+                    if sendFile == None:
+                        raise OSError(error, os.strerror(error))
+                    continue
+                raise OSError(error, os.strerror(error))
+            if copied == 0:
+                break
+            remaining -= copied
+
+    def _copyWith(self, sourceFullPath, targetFullPath, copyFunction):
+        '''
+        copy into a temporary file with copyFunction(source file, target file), then move it into place.
+        Unsupported operations raise LinkNotSupportedError, and leave nothing behind.
+        '''
+        def copy(tempFullPath):
+            source = open(sourceFullPath, 'rb')
+            try:
+                target = open(tempFullPath, 'wb')
+                try:
+                    copyFunction(source, target)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            shutil.copystat(sourceFullPath, tempFullPath)
+        self._replaceWith(targetFullPath, copy)
+
+    def _replaceWith(self, targetFullPath, createFunction):
+        '''
+        call createFunction(temporary path), and then rename the result over targetFullPath,
+        so an existing target is replaced the same way a copy would replace it.
+        '''
+        tempFullPath = '%s.image-tools-tmp' % targetFullPath
+        try:
+            createFunction(tempFullPath)
+            os.rename(tempFullPath, targetFullPath)
+            if os.path.lexists(tempFullPath):
+                # rename() does nothing if both names are already links to the same file
+                os.remove(tempFullPath)
+        except (IOError, OSError), e:
+            if os.path.lexists(tempFullPath):
+                os.remove(tempFullPath)
+            if e.errno in UNSUPPORTED_ERRNOS:
+                raise LinkNotSupportedError(e)
+            raise
@@ -0,0 +1,154 @@
+from contextlib import closing
+import hashlib
+import json
+from stat import S_ISREG
+
+from image_tools.RunStats import NULL_RUN_STATS
+from image_tools.Storage import LOCAL_STORAGE
+
+
+HASH_INDEX_FILENAME = '.image-tools-hashes.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hashFile(fullPath, storage=LOCAL_STORAGE):
+    '''
+    sha1 of a file's content, as hex
+    '''
+    sha1 = hashlib.sha1()
+    f = storage.open(fullPath, 'rb')
+    try:
+        chunk = f.read(HASH_CHUNK_SIZE)
+        while chunk:
+            sha1.update(chunk)
+            chunk = f.read(HASH_CHUNK_SIZE)
+    finally:
+        f.close()
+    return sha1.hexdigest()
+
+class HashIndex:
+    '''
+    Finds files with the same content in one (AllStars) folder.
+
+    Files are compared by size first, so most files are never read at all. Only files that
+    share a size get hashed, and their hashes are kept in HASH_INDEX_FILENAME in the folder,
+    valid for as long as the file's size and mtime don't change.
+    '''
+
+    def __init__(self, directory, stats=NULL_RUN_STATS, storage=LOCAL_STORAGE):
+        self.directory = directory
+        self.fullPath = '%s/%s' % (directory, HASH_INDEX_FILENAME)
+        self.stats = stats
+        self.storage = storage
+        self.changed = False
+        try:
+            with closing(storage.open(self.fullPath)) as f:
+                self.hashes = json.load(f)
+        except (IOError, ValueError):
+            self.hashes = {}
+        self.files = {}  # name -> (size, mtime), for every file in the folder
+        try:
+            names = storage.listdir(directory)
+        except OSError:
+            # (not there yet, like a new AllStars folder in mock mode, or unreadable): nothing in it
+            names = []
+        # (hidden files are our own, like this index, or at least not images someone chose)
+        names = sorted([name for name in names if not name.startswith('.')])
+        statResults = storage.statMany(['%s/%s' % (directory, name) for name in names])
+        for (name, statResult) in zip(names, statResults):
+            if statResult != None:
+                self.add(name, statResult=statResult)
+
+    def getKey(self, name):
+        '''
+        json keys are unicode, so hashes of names that aren't utf-8 aren't kept between runs
+        '''
+        try:
+            return name.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def add(self, name, sha1=None, statResult=None):
+        '''
+        note a file that is (now) in the folder. Pass its sha1 (and stat result) if you already know it.
+        '''
+        if statResult == None:
+            try:
+                statResult = self.storage.stat('%s/%s' % (self.directory, name))
+            except OSError:
+                return
+        if not S_ISREG(statResult.st_mode):
+            return
+        self.files[name] = (statResult.st_size, statResult.st_mtime)
+        if sha1 != None and self.getKey(name) != None:
+            self.hashes[self.getKey(name)] = {'size': statResult.st_size, 'mtime': statResult.st_mtime, 'sha1': sha1}
+            self.changed = True
+
+    def remove(self, name):
+        self.files.pop(name, None)
+        self.changed = True
+
+    def getHash(self, name):
+        (size, mtime) = self.files[name]
+        entry = self.hashes.get(self.getKey(name))
+        if entry != None and entry['size'] == size and entry['mtime'] == mtime:
+            return entry['sha1']
+        sha1 = self.hashFile('%s/%s' % (self.directory, name), size)
+        if self.getKey(name) != None:
+            self.hashes[self.getKey(name)] = {'size': size, 'mtime': mtime, 'sha1': sha1}
+            self.changed = True
+        return sha1
+
+    def hashFile(self, fullPath, size):
+        with self.stats.timer('hash'):
+            sha1 = hashFile(fullPath, self.storage)
+        self.stats.count('bytes hashed', size)
+        return sha1
+
+    def findDuplicate(self, sourceFullPath):
+        '''
+        returns (the name of a file in the folder with the same content as sourceFullPath, or None,
+        and the sha1 of sourceFullPath if it had to be worked out, or None)
+        '''
+        size = self.storage.stat(sourceFullPath).st_size
+        candidates = sorted([name for (name, (fileSize, mtime)) in self.files.items() if fileSize == size])
+        if not candidates:
+            return (None, None)
+        sourceHash = self.hashFile(sourceFullPath, size)
+        for name in candidates:
+            if self.getHash(name) == sourceHash:
+                return (name, sourceHash)
+        return (None, sourceHash)
+
+    def getDuplicateGroups(self):
+        '''
+        [[names]] of the files that have the same content, each group sorted by name
+        '''
+        namesBySize = {}
+        for (name, (size, mtime)) in self.files.items():
+            namesBySize.setdefault(size, []).append(name)
+        groups = []
+        for names in namesBySize.values():
+            if len(names) < 2:
+                continue
+            namesByHash = {}
+            for name in names:
+                namesByHash.setdefault(self.getHash(name), []).append(name)
+            groups += [sorted(group) for group in namesByHash.values() if len(group) > 1]
+        return sorted(groups)
+
+    def save(self):
+        if not self.changed:
+            return
+        # forget files that are gone
+        names = set([self.getKey(name) for name in self.files])
+        for key in self.hashes.keys():
+            if key not in names:
+                del self.hashes[key]
+        tempFullPath = '%s.tmp' % self.fullPath
+        f = self.storage.open(tempFullPath, 'w')
+        try:
+            json.dump(self.hashes, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        self.storage.rename(tempFullPath, self.fullPath)
+        self.changed = False
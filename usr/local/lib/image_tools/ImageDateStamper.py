@@ -1,14 +1,18 @@
 #!/usr/bin/python
 from datetime import datetime
-from os import listdir
-from os.path import abspath, basename, dirname, isdir
+from os.path import abspath, basename, dirname
 import re
 import sys
 import traceback
 from urllib import unquote
 
-from image_tools.ImageToolsShared import ImageFileInfoTool, getTestFilePaths
+from image_tools.ImageToolsShared import ImageFileInfoTool, getTestFilePaths, walkImageFiles
+from image_tools.MetadataIndex import addMetadataIndexArgument, openMetadataIndex
+from image_tools.RenamePlanner import RenamePlanner, UNDO_FILENAME
+from image_tools.RunStats import NULL_RUN_STATS, addRunStatsArguments, openRunStats, runProfiled, writeRunStats
+from image_tools.Storage import LOCAL_STORAGE, addStorageArguments, openStorage
 from py_base.Job import Job
+from py_base.PySystemMock import PySystemMock
 
 
 FILE_FORMAT_DATE = '%s-%s-%s %s.%s'  # 'Y-M-D H.M'
@@ -16,10 +20,36 @@ FILE_FORMAT_DATETIME = '%s-%s-%s %s.%s %s.%s'  # 'Y-M-D H.M S.ms'
 TIME_FORMAT_BRIEF = '{0:%Y-%m-%d %H%M}'  #
 TIME_FORMAT_VERBOSE = '{0:%Y-%m-%d %H:%M:%S}'
 
+def isWalkedBy(fullPath, directories, recursive=False):
+    '''
+    whether walking directories (see walkImageFiles()) gets to fullPath
+    '''
+    parent = dirname(fullPath)
+    for directory in directories:
+        if parent == directory or (recursive and parent.startswith(directory.rstrip('/') + '/')):
+            return True
+    return False
+
 class ImageDateStamper(Job):
+    imageTool = None
+    stats = NULL_RUN_STATS
+    storage = LOCAL_STORAGE
 
     def doRunSteps(self):
-        self.stamp()
+        self.stats = openRunStats(self.arguments)
+        self.storage = openStorage(self.arguments)
+        metadataIndex = openMetadataIndex(self.out, self.arguments, self.storage)
+        self.imageTool = ImageFileInfoTool(self.out, self.system, metadataIndex, self.stats, self.storage)
+        try:
+            runProfiled(self.out, self.arguments, self.stamp)
+        finally:
+            self.storage.close()
+            if metadataIndex:
+                metadataIndex.close()
+                self.out.put(metadataIndex.getStatsMessage(), self.out.LOG_LEVEL_VERBOSE)
+                self.stats.count('metadata cache hits', metadataIndex.hits)
+                self.stats.count('metadata cache misses', metadataIndex.misses)
+            writeRunStats(self.out, self.arguments, self.stats, 'date-stamp-images')
 
     def defineCustomArguments(self, parser):
         parser.add_argument('-s',
@@ -34,44 +64,111 @@ class ImageDateStamper(Job):
                             default=False,
                             help="Include time in date stamp",
                             )
+        parser.add_argument('-r',
+                            '--recursive',
+                            action='store_true',
+                            default=False,
+                            help="Also stamp images in subdirectories of the given directories",
+                            )
+        parser.add_argument('--undo',
+                            action='store_true',
+                            default=False,
+                            help="Put back the names from the last run in the given directories (from its %s file)" % UNDO_FILENAME,
+                            )
+        addMetadataIndexArgument(parser)
+        addRunStatsArguments(parser)
+        addStorageArguments(parser)
         parser.add_argument('path',
                             nargs='*',
                             help="Path(s) of the image(s) to date stamp, space separated if multiple",
                             )
 
     def stamp(self):
-        imageTool = ImageFileInfoTool(self.out, self.system)
-        filesToStamp = []
-        for filename in self.getNormalizedPathArgument():
-            if isdir(filename):
-                for child in listdir(filename):  # doesn't descend into subdirs
-                    child = '%s/%s' % (filename, child)
-                    filesToStamp.append(child)
-            else:
-                filesToStamp.append(filename)
-
-        for filename in sorted(filesToStamp):
-            if not imageTool.isImageFilename(filename):
+        '''
+        work out the new names of the files given as arguments, and of the images in the given
+        directories, and rename them one directory at a time (see RenamePlanner), so that
+        no file is renamed over another one. Each directory is renamed as soon as it has been read.
+
+        Returns {full path: new full path} for the files that were renamed.
+        '''
+        if self.imageTool == None:
+            self.imageTool = ImageFileInfoTool(self.out, self.system, stats=self.stats, storage=self.storage)
+        paths = self.getNormalizedPathArgument()
+        isDirectory = dict(zip(paths, self.storage.map(self.storage.isdir, paths)))
+        recursive = self.arguments['recursive']
+        directories = sorted(set([path for path in paths if isDirectory[path]]))
+        # what a given folder's walk gets to anyway is left to it, so that each folder is planned (and
+        # journalled) once per run. A second batch in the same folder would replace the first one's undo file.
+        if recursive:
+            directories = [directory for directory in directories if not isWalkedBy(directory, directories, True)]
+        filenames = sorted(set([path for path in paths if not isDirectory[path] and not isWalkedBy(path, directories, recursive)]))
+        moves = {}
+        originals = {}  # new full path -> the full path it had before this run
+
+        def fileMoved(oldFullPath, newFullPath):
+            self.imageTool.fileMoved(oldFullPath, newFullPath)
+            # (a file that went through a temporary name is moved twice)
+            original = originals.pop(oldFullPath, oldFullPath)
+            moves[original] = newFullPath
+            originals[newFullPath] = original
+
+        renamePlanner = RenamePlanner(self.out, self.system, self.inDebugMode(), self.stats, fileMoved, self.storage)
+        if self.arguments.get('undo'):
+            renamePlanner.undoAll(sorted(set([dirname(f) for f in filenames])))
+            renamePlanner.undoAll(directories, recursive)
+            return moves
+        # finish whatever an interrupted run started, before looking at any names
+        renamePlanner.resumeAll(sorted(set([dirname(f) for f in filenames])))
+        renamePlanner.resumeAll(directories, recursive)
+
+        wantedNamesByDirectory = {}  # directory -> {file name: new file name}
+        for filename in filenames:
+            if not self.imageTool.isImageFilename(filename):
                 self.out.put("Skipping %s because it doesn't look like an image file." % filename, self.out.LOG_LEVEL_WARN)
                 continue
-            try:
-                fileInfo = imageTool.getFileInfo(filename, okToUseFileName=True)
-            except:
-                fileInfo = False
-                self.out.put("File is broken or has no data!", self.out.LOG_LEVEL_WARN)
-                self.out.put(traceback.format_exc(), self.out.LOG_LEVEL_DEBUG)
-            if not fileInfo:
-                self.out.put("Unable to stamp file: %s" % basename(filename), self.out.LOG_LEVEL_WARN)
-                continue
-            self.out.put("Stamping %s..." % filename, self.out.LOG_LEVEL_WARN)
-            self.rename(filename, fileInfo)
+            self.planFile(wantedNamesByDirectory, filename)
+        for directory in sorted(wantedNamesByDirectory.keys()):
+            renamePlanner.renameAll(directory, wantedNamesByDirectory[directory])
+        for directory in directories:
+            # the walk gives each directory's files together, so each directory is renamed as
+            # soon as its files are planned, instead of after the whole tree has been read
+            wantedNames = {}
+            walkedDirectory = None
+            for (filename, statResult) in walkImageFiles(directory, recursive, self.stats, self.storage):
+                if dirname(filename) != walkedDirectory:
+                    if wantedNames:
+                        renamePlanner.renameAll(walkedDirectory, wantedNames)
+                    wantedNames = {}
+                    walkedDirectory = dirname(filename)
+                newFileName = self.stampFile(filename, statResult)
+                if newFileName:
+                    wantedNames[basename(filename)] = newFileName
+            if wantedNames:
+                renamePlanner.renameAll(walkedDirectory, wantedNames)
+        return moves
 
+    def planFile(self, wantedNamesByDirectory, filename, statResult=None):
+        newFileName = self.stampFile(filename, statResult)
+        if newFileName:
+            wantedNamesByDirectory.setdefault(dirname(filename), {})[basename(filename)] = newFileName
 
-    def rename(self, originalFileNameFullPath, fileInfo):
-        newFileName = self.getTargetFileName(fileInfo)
-        if newFileName != basename(originalFileNameFullPath):
-            newFileNameFullPath = '%s/%s' % (dirname(originalFileNameFullPath), newFileName)
-            self.system.rename(originalFileNameFullPath, newFileNameFullPath)
+    def stampFile(self, filename, statResult=None):
+        '''
+        returns the stamped name for a file (without renaming it), or None if it can't be stamped
+        '''
+        self.stats.count('files')
+        try:
+            fileInfo = self.imageTool.getFileInfo(filename, okToUseFileName=True, statResult=statResult)
+        except:
+            fileInfo = False
+            self.out.put("File is broken or has no data!", self.out.LOG_LEVEL_WARN)
+            self.out.put(traceback.format_exc(), self.out.LOG_LEVEL_DEBUG)
+        self.imageTool.releaseMetadata(filename)
+        if not fileInfo:
+            self.out.put("Unable to stamp file: %s" % basename(filename), self.out.LOG_LEVEL_WARN)
+            return None
+        self.out.put("Stamping %s..." % filename, self.out.LOG_LEVEL_WARN)
+        return self.getTargetFileName(fileInfo)
 
     def getTargetFileName(self, fileInfo):
         if self.arguments['strip']:
@@ -94,6 +191,8 @@ class ImageDateStamper(Job):
                                            fileInfo['extension'])
         return fileName
 
+    def inDebugMode(self):
+        return self.system.__class__ == PySystemMock
 
 if __name__ == "__main__":
     from py_base.Job import runMockJob
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+'''
+Date stamps and scales the images in an inbox folder (eg. where camera cards get dumped), and with
+--watch, keeps doing it for new images as they arrive.
+
+Watching uses inotify (pyinotify), so an idle inbox costs nothing: the process sleeps until the
+kernel has an event for it. A file is picked up when it has been closed after writing (or moved
+into the folder), and only once it has had no events for --settle seconds, so bursts of writes to
+the same file are handled once. Files are processed in batches, with the same code as
+date-stamp-images and scale-image --incremental.
+'''
+from multiprocessing import cpu_count
+from os.path import basename, dirname
+import re
+import time
+import traceback
+
+from image_tools.EncodingProfiles import DEFAULT_ENCODING, DEFAULT_FORMAT, ENCODING_PROFILES, OUTPUT_FORMATS
+from image_tools.ImageDateStamper import ImageDateStamper
+from image_tools.ImageScaler import DEFAULT_SCALE_SIZE, REGEX_SCALED_FILENAME, ImageScaler, parseLimitSizes
+from image_tools.ImageToolsShared import IMAGE_FILENAME_PATTERN, ImageFileInfoTool, walkImageFiles
+from image_tools.MetadataIndex import addMetadataIndexArgument, openMetadataIndex
+from image_tools.RunStats import NULL_RUN_STATS, addRunStatsArguments, openRunStats, runProfiled, writeRunStats
+from image_tools.Storage import LOCAL_STORAGE, addStorageArguments, openStorage
+from py_base.Job import Job
+
+
+DEFAULT_SETTLE_SECONDS = 2.0
+MAX_BATCH_SIZE = 200  # settled files to process at once, even if more are still arriving
+MAX_WAIT_SECONDS = 30.0  # how long a settled file waits for the rest of a slow copy to finish
+
+class SettleQueue:
+    '''
+    Paths waiting for their last event to be settleSeconds old.
+
+    Settled paths are handed out in batches: all of them once nothing at all has happened for
+    settleSeconds, or while a copy is still going on, maxBatchSize at a time (or whatever has
+    settled, once something has been waiting for maxWaitSeconds). That way a card dump is
+    processed in a few big batches, instead of one tiny batch per file.
+    '''
+
+    def __init__(self, settleSeconds=DEFAULT_SETTLE_SECONDS, maxBatchSize=MAX_BATCH_SIZE, maxWaitSeconds=MAX_WAIT_SECONDS):
+        self.settleSeconds = settleSeconds
+        self.maxBatchSize = maxBatchSize
+        self.maxWaitSeconds = maxWaitSeconds
+        self.lastEvents = {}  # path -> time of its last event
+        self.lastEvent = None  # time of the last event for any path
+
+    def __len__(self):
+        return len(self.lastEvents)
+
+    def add(self, path, now):
+        self.lastEvents[path] = now
+        self.lastEvent = now
+
+    def discard(self, path):
+        self.lastEvents.pop(path, None)
+
+    def getTimeout(self, now):
+        '''
+        seconds until something could be ready, or None if nothing is waiting
+        '''
+        if not self.lastEvents:
+            return None
+        oldest = min(self.lastEvents.values())
+        return max(0, min(self.lastEvent + self.settleSeconds, oldest + self.maxWaitSeconds) - now)
+
+    def popSettled(self, now):
+        '''
+        the settled paths (sorted) if it's time for a batch, otherwise []
+        '''
+        if not self.lastEvents:
+            return []
+        deadline = now - self.settleSeconds
+        settled = sorted([path for (path, lastEvent) in self.lastEvents.items() if lastEvent <= deadline])
+        if self.lastEvent > deadline:
+            if len(settled) < self.maxBatchSize and min(self.lastEvents.values()) > now - self.maxWaitSeconds:
+                # still busy; wait for more
+                return []
+            settled = settled[:self.maxBatchSize]
+        for path in settled:
+            del self.lastEvents[path]
+        return settled
+
+class ImageInbox(Job):
+    ownPaths = None  # while watching: files we renamed, whose events are our own doing
+    stats = NULL_RUN_STATS
+    storage = LOCAL_STORAGE
+
+    def defineCustomArguments(self, parser):
+        parser.add_argument('-w',
+                            '--watch',
+                            action='store_true',
+                            default=False,
+                            help="After processing what's there, keep watching the folders and process new images as they arrive "
+                                 "(until interrupted)",
+                            )
+        parser.add_argument('--settle',
+                            metavar='SECONDS',
+                            type=float,
+                            default=DEFAULT_SETTLE_SECONDS,
+                            help="With --watch, wait until a new file has been left alone this long (default %g)" % DEFAULT_SETTLE_SECONDS,
+                            )
+        parser.add_argument('-r',
+                            '--recursive',
+                            action='store_true',
+                            default=False,
+                            help="Also process (and watch) subdirectories of the given directories",
+                            )
+        parser.add_argument('-t',
+                            '--time',
+                            action='store_true',
+                            default=False,
+                            help="Include time in date stamp",
+                            )
+        parser.add_argument('-l',
+                            '--limit-size',
+                            metavar='x',
+                            type=parseLimitSizes,
+                            default=DEFAULT_SCALE_SIZE,
+                            help="Size(s) to scale to, as for scale-image (default %d)" % DEFAULT_SCALE_SIZE,
+                            )
+        parser.add_argument('-e',
+                            '--encoding',
+                            choices=sorted(ENCODING_PROFILES.keys()),
+                            default=DEFAULT_ENCODING,
+                            help="Encoder settings for the scaled files, as for scale-image (default %s)" % DEFAULT_ENCODING,
+                            )
+        parser.add_argument('-f',
+                            '--format',
+                            choices=sorted(OUTPUT_FORMATS.keys()) + [DEFAULT_FORMAT],
+                            default=DEFAULT_FORMAT,
+                            help="Format of the scaled files, as for scale-image (default %s)" % DEFAULT_FORMAT,
+                            )
+        parser.add_argument('--no-scale',
+                            action='store_true',
+                            default=False,
+                            help="Only date stamp the images",
+                            )
+        parser.add_argument('-j',
+                            '--jobs',
+                            metavar='N',
+                            type=int,
+                            default=cpu_count(),
+                            help="Scale up to N images at once in separate processes (default %d, the number of CPUs)" % cpu_count(),
+                            )
+        addMetadataIndexArgument(parser)
+        addRunStatsArguments(parser)
+        addStorageArguments(parser)
+        parser.add_argument('path',
+                            nargs='*',
+                            help="Path(s) of the inbox folder(s), space separated if multiple",
+                            )
+
+    def doRunSteps(self):
+        self.stats = openRunStats(self.arguments)
+        self.storage = openStorage(self.arguments)
+        metadataIndex = openMetadataIndex(self.out, self.arguments, self.storage)
+        self.imageTool = ImageFileInfoTool(self.out, self.system, metadataIndex, self.stats, self.storage)
+        try:
+            runProfiled(self.out, self.arguments, self.processInbox)
+        finally:
+            self.storage.close()
+            if metadataIndex:
+                metadataIndex.close()
+                self.out.put(metadataIndex.getStatsMessage(), self.out.LOG_LEVEL_VERBOSE)
+            writeRunStats(self.out, self.arguments, self.stats, 'image-inbox')
+
+    def processInbox(self):
+        directories = [path for path in self.getNormalizedPathArgument() if self.storage.isdir(path)]
+        if not directories:
+            self.out.put("ERROR: No folders to process", self.out.LOG_LEVEL_ERROR)
+            return
+        if self.arguments['watch']:
+            # (the images that are already there are processed once the watches are in place)
+            self.watch(directories)
+        else:
+            self.processBatch(self.findInboxImages(directories))
+
+    def findInboxImages(self, directories):
+        images = []
+        for directory in directories:
+            images += [fullPath for (fullPath, statResult) in walkImageFiles(directory, self.arguments['recursive'], self.stats, self.storage)
+                       if self.isInboxImage(fullPath)]
+        return images
+
+    def isInboxImage(self, fullPath):
+        '''
+        whether a file is an image to process, as opposed to one of our scaled files, or
+        our journals, manifests and temporary files (which are all hidden)
+        '''
+        name = basename(fullPath)
+        return (IMAGE_FILENAME_PATTERN.match(name) != None
+                and not name.startswith('.')
+                and not re.search(REGEX_SCALED_FILENAME, name))
+
+    def processBatch(self, fullPaths):
+        '''
+        date stamp the files, and scale them (by their new names)
+        '''
+        if not fullPaths:
+            return
+        self.out.indent("Processing %d new image(s)" % len(fullPaths))
+        stamper = ImageDateStamper(self.out, self.system)
+        stamper.arguments.update({'strip': False,
+                                  'time': self.arguments['time'],
+                                  'recursive': False,
+                                  'undo': False,
+                                  'path': fullPaths})
+        stamper.imageTool = self.imageTool
+        stamper.stats = self.stats
+        stamper.storage = self.storage
+        with self.stats.timer('stamp'):
+            moves = stamper.stamp()
+        stampedPaths = [moves.get(fullPath, fullPath) for fullPath in fullPaths]
+        if self.ownPaths != None:
+            self.ownPaths.update(moves.values())
+
+        if not self.arguments['no_scale']:
+            scaler = ImageScaler(self.out, self.system)
+            scaler.arguments.update({'limit_size': self.arguments['limit_size'],
+                                     'greyscale': False,
+                                     'jobs': self.arguments['jobs'],
+                                     'incremental': True,
+                                     'rotate_only': False,
+                                     'encoding': self.arguments['encoding'],
+                                     'format': self.arguments['format'],
+                                     'target_size': None,
+                                     'path': stampedPaths})
+            scaler.imageTool = self.imageTool
+            scaler.stats = self.stats
+            scaler.storage = self.storage
+            scaler.scale()
+        self.out.unIndent()
+
+    def tryProcessBatch(self, fullPaths):
+        '''
+        processBatch(), except that one bad batch (a file that can't be read, a full disk)
+        shouldn't stop the watching
+        '''
+        try:
+            self.processBatch(fullPaths)
+        except Exception, e:
+            # (processBatch() is indented once, for the batch)
+            self.out.unIndent()
+            self.out.put("ERROR: Unable to process %d image(s), moving on: %s" % (len(fullPaths), e), self.out.LOG_LEVEL_ERROR)
+            self.out.put(traceback.format_exc(), self.out.LOG_LEVEL_DEBUG)
+
+    def watch(self, directories):
+        try:
+            import pyinotify
+        except ImportError:
+            self.out.put("ERROR: --watch needs pyinotify (the python-pyinotify package)", self.out.LOG_LEVEL_ERROR)
+            return
+        queue = SettleQueue(self.arguments['settle'])
+        inbox = self
+
+        class EventHandler(pyinotify.ProcessEvent):
+
+            def process_IN_Q_OVERFLOW(self, event):
+                # the kernel dropped events (we were busy with a big batch), so look at everything again.
+                # Files that are done already are skipped by the stamping and scaling.
+                inbox.out.put("Missed some events; rescanning", inbox.out.LOG_LEVEL_WARN)
+                for fullPath in inbox.findInboxImages(directories):
+                    queue.add(fullPath, time.time())
+
+            def process_default(self, event):
+                now = time.time()
+                if event.dir:
+                    if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO) and inbox.arguments['recursive']:
+                        # a new folder (eg. DCIM/100CANON). pyinotify watches it from now on, but
+                        # files may have landed in it already
+                        for (fullPath, statResult) in walkImageFiles(event.pathname, True, inbox.stats, inbox.storage):
+                            if inbox.isInboxImage(fullPath):
+                                queue.add(fullPath, now)
+                elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                    queue.discard(event.pathname)
+                elif event.mask & pyinotify.IN_CREATE:
+                    # still being written; it's picked up when it's closed
+                    pass
+                elif event.pathname in inbox.ownPaths:
+                    # our own renames
+                    inbox.ownPaths.discard(event.pathname)
+                elif inbox.isInboxImage(event.pathname):
+                    queue.add(event.pathname, now)
+
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE
+                | pyinotify.IN_CREATE)
+        watchManager = pyinotify.WatchManager()
+        for directory in directories:
+            recursive = self.arguments['recursive']
+            watchManager.add_watch(directory, mask, rec=recursive, auto_add=recursive)
+        notifier = pyinotify.Notifier(watchManager, EventHandler())
+        self.out.put("Watching %s for new images (Ctrl-C to stop)" % ', '.join(directories))
+        try:
+            # the watches are in place before the images already there are processed, so the events
+            # of anything that arrives meanwhile (and of our own renames) wait for the loop below
+            self.ownPaths = set()
+            self.tryProcessBatch(self.findInboxImages(directories))
+            while True:
+                timeout = queue.getTimeout(time.time())
+                if timeout != None:
+                    timeout = int(timeout * 1000) + 1  # (milliseconds)
+                # sleeps until there's an event, or until the queue has something settled
+                if notifier.check_events(timeout):
+                    notifier.read_events()
+                    notifier.process_events()
+                batch = queue.popSettled(time.time())
+                # (it may have been renamed or deleted since, eg. by another tool)
+                statResults = self.storage.statMany(batch)
+                self.tryProcessBatch([fullPath for (fullPath, statResult) in zip(batch, statResults) if statResult != None])
+        except KeyboardInterrupt:
+            self.out.put("Stopped watching")
+        finally:
+            notifier.stop()
+
+if __name__ == "__main__":
+    from py_base.Job import runMockJob
+    from image_tools.ImageToolsShared import getTestFilePaths
+    runMockJob(ImageInbox, arguments={'watch': False,
+                                      'settle': DEFAULT_SETTLE_SECONDS,
+                                      'recursive': False,
+                                      'time': False,
+                                      'limit_size': 100,
+                                      'encoding': DEFAULT_ENCODING,
+                                      'format': DEFAULT_FORMAT,
+                                      'no_scale': False,
+                                      'jobs': 2,
+                                      'path': [dirname(getTestFilePaths()[0])]})
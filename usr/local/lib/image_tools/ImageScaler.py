@@ -1,23 +1,64 @@
 #!/usr/bin/python
-from PIL import Image
-from os.path import abspath, dirname, expanduser, splitext
-import pyexiv2
+from argparse import ArgumentTypeError
+from multiprocessing import Pool, cpu_count
+from os.path import abspath, basename, dirname, expanduser, splitext
+import re
+import subprocess
+import traceback
 
-from image_tools.ImageToolsShared import ImageFileInfoTool, getTestFilePaths
+from image_tools.EncodingProfiles import DEFAULT_ENCODING, DEFAULT_FORMAT, ENCODING_PROFILES, LOSSY_FORMATS, OUTPUT_FORMATS, \
+    encodeToTargetSize, getFormatByFileName, getSaveOptions, prepareForFormat, saveImage
+from image_tools.ExifHeader import ExifHeaderError, parseExifBlock, setOrientation, writeJpegOrientation
+from image_tools.ImageToolsShared import ORIENTATION_TRANSPOSES, BufferedOutput, ImageFileInfoTool, getTestFilePaths, hasNonExifMetadata, \
+    openReducedImage
+from image_tools.RunStats import NULL_RUN_STATS, addRunStatsArguments, openRunStats, runProfiled, writeRunStats
+from image_tools.ScaleManifest import ScaleManifest
+from image_tools.Storage import LOCAL_STORAGE, addStorageArguments, openStorage
 from py_base.Job import Job
 from py_base.PySystemMock import PySystemMock
 
 FILENAME_SCALED_SUFFIX = '.scaled'
 DEFAULT_SCALE_SIZE = 1200
+REGEX_LIMIT_SIZE = '^(\d+)(g?)$'
+REGEX_SCALED_FILENAME = '\.scaled(-\d+g?)?\.[^./]+$'
+
+# EXIF orientation -> the jpegtran arguments for the same thing as ORIENTATION_TRANSPOSES, done losslessly
+JPEGTRAN_TRANSFORMS = {2: ['-flip', 'horizontal'],
+                       3: ['-rotate', '180'],
+                       4: ['-flip', 'vertical'],
+                       5: ['-transpose'],
+                       6: ['-rotate', '90'],
+                       7: ['-transverse'],
+                       8: ['-rotate', '270'],
+                       }
+
+def parseLimitSizes(value):
+    '''
+    argparse type for --limit-size: a size, or a comma separated list of sizes.
+    A size ending in g is a greyscale rendition. Returns [(size, greyscale)].
+    '''
+    limitSizes = []
+    for token in value.split(','):
+        m = re.match(REGEX_LIMIT_SIZE, token.strip().lower())
+        if not m:
+            raise ArgumentTypeError("%s is not a size (eg. 1200) or a greyscale size (eg. 1200g)" % token)
+        limitSizes.append((int(m.group(1)), m.group(2) == 'g'))
+    return limitSizes
 
 class ImageScaler(Job):
+    scaleManifests = None
+    stats = NULL_RUN_STATS
+    storage = LOCAL_STORAGE
 
     def defineCustomArguments(self, parser):
         parser.add_argument('-l',
                             '--limit-size',
                             metavar='x',
+                            type=parseLimitSizes,
                             default=DEFAULT_SCALE_SIZE,
-                            help="Limit the size of the longest dimension of the original to x pixels (default %d)" % DEFAULT_SCALE_SIZE,
+                            help="Limit the size of the longest dimension of the original to x pixels (default %d). "
+                                 "Give a list (eg. 2048,1200,400,1200g) to make several renditions at once, "
+                                 "named .scaled-<size>; a g after the size makes that one greyscale" % DEFAULT_SCALE_SIZE,
                             )
         parser.add_argument('-g',
                             '--greyscale',
@@ -25,58 +66,414 @@ class ImageScaler(Job):
                             default=False,
                             help="Convert to greyscale",
                             )
+        parser.add_argument('-j',
+                            '--jobs',
+                            metavar='N',
+                            type=int,
+                            default=cpu_count(),
+                            help="Scale up to N images at once in separate processes (default %d, the number of CPUs)" % cpu_count(),
+                            )
+        parser.add_argument('-i',
+                            '--incremental',
+                            action='store_true',
+                            default=False,
+                            help="Skip images whose scaled files are up to date (same source file and settings), "
+                                 "and images that are scaled files themselves",
+                            )
+        parser.add_argument('-e',
+                            '--encoding',
+                            choices=sorted(ENCODING_PROFILES.keys()),
+                            default=DEFAULT_ENCODING,
+                            help="Encoder settings for the scaled files: fast (PIL's defaults, quickest to write), "
+                                 "web (smaller: optimized, progressive JPEGs) or archive (high quality) (default %s)" % DEFAULT_ENCODING,
+                            )
+        parser.add_argument('-f',
+                            '--format',
+                            choices=sorted(OUTPUT_FORMATS.keys()) + [DEFAULT_FORMAT],
+                            default=DEFAULT_FORMAT,
+                            help="Write the scaled files in this format (default %s: the same as the original)" % DEFAULT_FORMAT,
+                            )
+        parser.add_argument('--target-size',
+                            metavar='KB',
+                            type=int,
+                            help="Pick the JPEG/WebP quality for each scaled file so that it's at most KB kilobytes "
+                                 "(but no better than the --encoding quality)",
+                            )
+        parser.add_argument('--rotate-only',
+                            action='store_true',
+                            default=False,
+                            help="Don't scale; turn the JPEGs themselves upright according to their EXIF orientation, "
+                                 "losslessly with jpegtran, and set their orientation to normal",
+                            )
+        addRunStatsArguments(parser)
+        addStorageArguments(parser)
         parser.add_argument('path',
                             nargs='*',
                             help="Path(s) of the image(s) to scale, space separated if multiple",
                             )
 
     def doRunSteps(self, imageTool=None):
+        self.stats = openRunStats(self.arguments)
+        self.storage = openStorage(self.arguments)
         if imageTool == None:
-            self.imageTool = ImageFileInfoTool(self.out, self.system)
+            self.imageTool = ImageFileInfoTool(self.out, self.system, stats=self.stats, storage=self.storage)
         else:
             self.imageTool = imageTool
-        for filename in self.getNormalizedPathArgument():
-            if self.imageTool.isImageFilename(filename):
-                self.processImageFile(filename)
+        try:
+            runProfiled(self.out, self.arguments, self.scale)
+        finally:
+            self.storage.close()
+            writeRunStats(self.out, self.arguments, self.stats, 'scale-image')
+
+    def scale(self):
+        filenames = [f for f in self.getNormalizedPathArgument() if self.imageTool.isImageFilename(f)]
+        if self.arguments.get('rotate_only'):
+            for filename in filenames:
+                self.rotateImageFile(filename)
+            return
+        if self.arguments.get('incremental'):
+            self.scaleManifests = {}
+            filenames = self.getFilenamesToRebuild(filenames)
+        jobs = min(self.arguments.get('jobs') or cpu_count(), len(filenames))
+        if jobs > 1:
+            scaledFilenames = self.processImageFilesInParallel(filenames, jobs)
+        else:
+            scaledFilenames = [filename for filename in filenames if self.tryProcessImageFile(filename)]
+        if self.arguments.get('incremental'):
+            self.saveScaleManifests(scaledFilenames)
+
+    def getRenderParameters(self):
+        '''
+        everything that decides what the scaled files look like, as recorded in the ScaleManifest
+        (so, json types only)
+        '''
+        return {'renditions': [[size, greyscale, suffix] for (size, greyscale, suffix) in self.getRenditions()],
+                # (scaled files from before orientation was applied are sideways, so they're rebuilt)
+                'orientation': 'upright',
+                'encoding': self.arguments.get('encoding') or DEFAULT_ENCODING,
+                'format': self.arguments.get('format') or DEFAULT_FORMAT,
+                'target_size': self.arguments.get('target_size')}
+
+    def getScaleManifest(self, sourceFileName):
+        directory = dirname(sourceFileName)
+        if directory not in self.scaleManifests:
+            self.scaleManifests[directory] = ScaleManifest(directory, self.storage)
+        return self.scaleManifests[directory]
+
+    def getFilenamesToRebuild(self, filenames):
+        '''
+        for --incremental: leave out the scaled files themselves, and sources that the
+        ScaleManifest says are up to date
+        '''
+        parameters = self.getRenderParameters()
+        suffixes = [suffix for (size, greyscale, suffix) in self.getRenditions()]
+        sources = []  # [(source, its outputs)]
+        scaledFileCount = 0
+        for filename in filenames:
+            if re.search(REGEX_SCALED_FILENAME, filename):
+                self.out.put("Skipping %s: it's a scaled file" % filename, self.out.LOG_LEVEL_DEBUG)
+                scaledFileCount += 1
+                continue
+            sources.append((filename, [self.getTargetFileName(filename, suffix) for suffix in suffixes]))
+
+        # look up all the sources that have been scaled before, and their outputs, at once
+        fullPaths = []
+        for (filename, targetFileNames) in sources:
+            if self.getScaleManifest(filename).hasEntry(filename, parameters):
+                fullPaths += [filename] + targetFileNames
+        statResults = dict(zip(fullPaths, self.storage.statMany(fullPaths)))
+
+        toRebuild = []
+        for (filename, targetFileNames) in sources:
+            if self.getScaleManifest(filename).isCurrent(filename, parameters, targetFileNames, statResults):
+                self.out.put("Skipping %s: already scaled" % filename, self.out.LOG_LEVEL_DEBUG)
+                continue
+            toRebuild.append(filename)
+        self.out.put("Rebuilding %d files, skipping %d that are up to date and %d scaled files"
+                     % (len(toRebuild), len(filenames) - len(toRebuild) - scaledFileCount, scaledFileCount))
+        return toRebuild
+
+    def saveScaleManifests(self, scaledFilenames):
+        if self.inDebugMode():
+            # if we're running in mock mode, then we shouldn't be changing anything on the filesystem.
+            self.out.put("DEBUG: Not writing scale manifests because we're in mock mode")
+            return
+        parameters = self.getRenderParameters()
+        for (filename, statResult) in zip(scaledFilenames, self.storage.statMany(scaledFilenames)):
+            if statResult != None:
+                self.getScaleManifest(filename).record(filename, parameters, statResult)
+        for scaleManifest in self.scaleManifests.values():
+            try:
+                scaleManifest.save()
+            except (IOError, OSError), e:
+                self.out.put("ERROR: Unable to save %s: %s" % (scaleManifest.fullPath, e), self.out.LOG_LEVEL_ERROR)
+
+    def processImageFilesInParallel(self, filenames, jobs):
+        '''
+        scale the files in a pool of worker processes (see scaleImageFileInWorker()).
+
+        Each worker buffers its own output, and the buffers are replayed here in the
+        original file order, so the log reads the same as a single-process run.
+
+        Returns the files that were scaled without errors.
+        '''
+        self.out.put("Scaling %d files using %d processes..." % (len(filenames), jobs), self.out.LOG_LEVEL_VERBOSE)
+        logLevels = BufferedOutput.getLogLevels(self.out)
+        tasks = [(filename, self.arguments, self.system.__class__, logLevels) for filename in filenames]
+        scaledFilenames = []
+        pool = Pool(jobs)
+        try:
+            for (filename, (calls, succeeded, statsDict)) in zip(filenames, pool.imap(scaleImageFileInWorker, tasks)):
+                BufferedOutput.replay(self.out, calls)
+                self.stats.merge(statsDict)
+                if succeeded:
+                    scaledFilenames.append(filename)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return scaledFilenames
+
+    def getRenditions(self):
+        '''
+        the (size, greyscale, filename suffix) of each output, biggest first, so each
+        rendition can be scaled down from the one before it.
+        A single rendition gets the plain .scaled suffix, as always.
+        '''
+        limitSizes = self.arguments.get('limit_size') or DEFAULT_SCALE_SIZE
+        if isinstance(limitSizes, int):
+            limitSizes = [(limitSizes, False)]
+        limitSizes = set([(size, greyscale or self.arguments.get('greyscale')) for (size, greyscale) in limitSizes])
+        # colour before greyscale at the same size, so the greyscale one is converted from it
+        limitSizes = sorted(limitSizes, key=lambda (size, greyscale): (-size, greyscale))
+        if len(limitSizes) == 1:
+            return [(limitSizes[0][0], limitSizes[0][1], FILENAME_SCALED_SUFFIX)]
+        return [(size, greyscale, '%s-%d%s' % (FILENAME_SCALED_SUFFIX, size, greyscale and 'g' or ''))
+                for (size, greyscale) in limitSizes]
 
     def processImageFile(self, sourceFileName):
+        '''
+        decode the source once, at the resolution needed for the biggest rendition, and then make
+        each rendition by scaling down the previous one.
+        '''
         self.out.indent("Scaling file: %s" % sourceFileName)
-        targetFileName = self.getTargetFileName(sourceFileName)
+        renditions = self.getRenditions()
 
         self.out.put("reading image file...", self.out.LOG_LEVEL_DEBUG)
-        sourceImage = Image.open(sourceFileName)
+        allGreyscale = not [greyscale for (size, greyscale, suffix) in renditions if not greyscale]
+        with self.stats.timer('decode'):
+            image = openReducedImage(sourceFileName, renditions[0][0], allGreyscale, self.storage)
+            if self.stats.enabled:
+                # (otherwise the image is decoded by thumbnail(), and that time would count as resampling)
+                image.load()
+        self.stats.count('files')
+        if self.stats.enabled:
+            self.stats.count('bytes read', self.storage.getsize(sourceFileName))
 
-        self.processImage(sourceImage, targetFileName)
-        try:
-            self.imageTool.copyExifMetadata(sourceFileName, targetFileName)
-        except:
-            # probably in debug mode - no .scaled.jpg file was created
-            if not self.inDebugMode():
-                self.out.put("ERROR: Unable to copy EXIF metadata to %s. Was it scaled/saved correctly?" % targetFileName,
-                             self.out.LOG_LEVEL_ERROR)
+        # JPEG to JPEG, the raw EXIF block can be written while saving. Anything else
+        # falls back to copying the metadata with pyexiv2 after the file is written, and so
+        # do IPTC, XMP and the comment (keywords, captions, ratings), if the source has any.
+        exif = image.info.get('exif')
+        otherMetadata = hasNonExifMetadata(image)
+        orientation = self.getOrientation(sourceFileName, exif)
+        if exif and orientation != 1:
+            # the scaled files are turned upright, so their orientation has to say so
+            try:
+                exif = setOrientation(exif, 1)
+            except ExifHeaderError:
+                exif = None
+
+        for (size, greyscale, suffix) in renditions:
+            targetFileName = self.getTargetFileName(sourceFileName, suffix)
+            if getFormatByFileName(targetFileName) in LOSSY_FORMATS:
+                targetExif = exif
+            else:
+                targetExif = None
+            # only the first rendition needs turning; the rest are scaled down from it
+            image = self.processImage(image, targetFileName, targetExif, size, greyscale, orientation)
+            orientation = 1
+            if not targetExif or otherMetadata:
+                try:
+                    self.imageTool.copyExifMetadata(sourceFileName, targetFileName, orientation=1, exif=not targetExif)
+                except:
+                    # probably in debug mode - no .scaled.jpg file was created
+                    if not self.inDebugMode():
+                        self.out.put("ERROR: Unable to copy EXIF metadata to %s. Was it scaled/saved correctly?" % targetFileName,
+                                     self.out.LOG_LEVEL_ERROR)
+        self.imageTool.releaseMetadata(sourceFileName)
 
         self.out.unIndent()
 
-    def processImage(self, sourceImage, targetFileName):
-        size = (self.arguments['limit_size'], self.arguments['limit_size'])
-        if self.arguments['greyscale']:
-            self.out.put("converting image to greyscale...", self.out.LOG_LEVEL_VERBOSE)
-            sourceImage = sourceImage.convert("L")
+    def tryProcessImageFile(self, sourceFileName):
+        '''
+        processImageFile(), except that one broken file shouldn't take down the rest of the batch.
+        Returns whether it worked.
+        '''
+        try:
+            self.processImageFile(sourceFileName)
+            return True
+        except Exception:
+            # (processImageFile() is indented once, for the file)
+            self.out.unIndent()
+            self.out.put("ERROR: Unable to scale %s" % sourceFileName, self.out.LOG_LEVEL_ERROR)
+            self.out.put(traceback.format_exc(), self.out.LOG_LEVEL_DEBUG)
+            return False
+
+    def processImage(self, sourceImage, targetFileName, exif=None, limitSize=None, greyscale=None, orientation=1):
+        '''
+        scale sourceImage (in place) to fit in limitSize x limitSize, turn it upright according to its
+        EXIF orientation, and save it to targetFileName, in greyscale if asked to.
+        Sizes default to the (first) --limit-size and --greyscale arguments.
+
+        Returns the scaled (and upright) image before any greyscale conversion, for the next (smaller) rendition.
+        '''
+        if limitSize == None:
+            (limitSize, defaultGreyscale, suffix) = self.getRenditions()[0]
+            if greyscale == None:
+                greyscale = defaultGreyscale
+        elif greyscale == None:
+            greyscale = self.arguments.get('greyscale')
 
-        self.out.put("scaling image...", self.out.LOG_LEVEL_DEBUG)
-        sourceImage.thumbnail(size, Image.ANTIALIAS)
+        from PIL import Image  # (imported here to keep startup fast)
+        self.out.put("scaling image to %d pixels..." % limitSize, self.out.LOG_LEVEL_DEBUG)
+        with self.stats.timer('resample'):
+            sourceImage.thumbnail((limitSize, limitSize), Image.ANTIALIAS)
+        if orientation in ORIENTATION_TRANSPOSES:
+            # after scaling, so there are fewer pixels to move. (The box is square, so the size comes out the same.)
+            self.out.put("turning image upright (orientation %d)..." % orientation, self.out.LOG_LEVEL_DEBUG)
+            with self.stats.timer('rotate'):
+                for method in ORIENTATION_TRANSPOSES[orientation]:
+                    sourceImage = sourceImage.transpose(getattr(Image, method))
+
+        outputImage = sourceImage
+        if greyscale and sourceImage.mode != 'L':
+            # JPEGs that only need greyscale renditions are already decoded as greyscale by openReducedImage()
+            self.out.put("converting image to greyscale...", self.out.LOG_LEVEL_VERBOSE)
+            with self.stats.timer('greyscale'):
+                outputImage = sourceImage.convert("L")
 
         if self.inDebugMode():
             # if we're running in mock mode, then we shouldn't be changing anything on the filesystem.
             self.out.put("DEBUG: Not writing image file because we're in mock mode")
         else:
             self.out.put("writing image file...", self.out.LOG_LEVEL_DEBUG)
-            sourceImage.save(targetFileName)
+            self.saveImage(outputImage, targetFileName, exif)
+            self.stats.count('renditions')
+            if self.stats.enabled:
+                self.stats.count('bytes written', self.storage.getsize(targetFileName))
+        return sourceImage
+
+    def saveImage(self, image, targetFileName, exif=None):
+        '''
+        save with the --encoding settings for the target's format, and with --target-size,
+        at the quality that fits
+        '''
+        pilFormat = getFormatByFileName(targetFileName)
+        saveOptions = getSaveOptions(self.arguments.get('encoding') or DEFAULT_ENCODING, pilFormat)
+        if exif:
+            saveOptions['exif'] = exif
+        if pilFormat != None:
+            image = prepareForFormat(image, pilFormat)
+        if not self.arguments.get('target_size') or pilFormat not in LOSSY_FORMATS:
+            with self.stats.timer('save'):
+                saveImage(image, targetFileName, pilFormat, saveOptions)
+            return
+        targetBytes = self.arguments.get('target_size') * 1024
+        with self.stats.timer('quality search'):
+            (data, quality, proxyEncodes) = encodeToTargetSize(image, pilFormat, saveOptions, targetBytes)
+        self.stats.count('proxy encodes', proxyEncodes)
+        if len(data) > targetBytes:
+            self.out.put("%s is %d KB even at quality %d" % (targetFileName, len(data) / 1024, quality), self.out.LOG_LEVEL_WARN)
+        else:
+            self.out.put("saving at quality %d (%d KB)" % (quality, len(data) / 1024), self.out.LOG_LEVEL_VERBOSE)
+        with self.stats.timer('save'):
+            f = self.storage.open(targetFileName, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+
+    def getOrientation(self, sourceFileName, exif=None):
+        '''
+        the EXIF orientation (1 to 8) of a file, from its raw EXIF block if we have it; 1 if it doesn't say
+        '''
+        orientation = None
+        if exif:
+            try:
+                orientation = parseExifBlock(exif).orientation
+            except ExifHeaderError:
+                exif = None
+        if not exif:
+            try:
+                orientation = self.imageTool.getExifFields(sourceFileName)['orientation']
+            except Exception:
+                self.out.put("Unable to read the orientation of %s; leaving it as it is" % sourceFileName, self.out.LOG_LEVEL_WARN)
+        if orientation not in ORIENTATION_TRANSPOSES:
+            return 1
+        return orientation
 
-    def getTargetFileName(self, sourceFileName):
+    def rotateImageFile(self, sourceFileName):
+        '''
+        for --rotate-only: turn a JPEG upright in place with jpegtran, which moves the compressed blocks
+        around instead of decoding and re-encoding the image, so no quality is lost (and it's much faster).
+        Then the Orientation tag is set to 1, and the file keeps its modification time.
+
+        Returns whether the file is upright now.
+        '''
+        orientation = self.getOrientation(sourceFileName)
+        if orientation == 1:
+            self.out.put("%s is already upright" % sourceFileName, self.out.LOG_LEVEL_VERBOSE)
+            return True
+        if not self.imageTool.isJpg(sourceFileName):
+            self.out.put("Unable to turn %s upright losslessly: only JPEGs can be. Scale it instead." % sourceFileName,
+                         self.out.LOG_LEVEL_WARN)
+            return False
+        self.out.put("Turning %s upright (orientation %d)" % (sourceFileName, orientation))
+        if self.inDebugMode():
+            # if we're running in mock mode, then we shouldn't be changing anything on the filesystem.
+            self.out.put("DEBUG: Not rotating image file because we're in mock mode")
+            return True
+
+        tempFileName = '%s/.%s.rotate.tmp' % (dirname(sourceFileName), basename(sourceFileName))
+        # -perfect: fail rather than drop the partial blocks at the right/bottom edges
+        command = ['jpegtran', '-copy', 'all', '-perfect'] + JPEGTRAN_TRANSFORMS[orientation] + ['-outfile', tempFileName, sourceFileName]
+        try:
+            with self.stats.timer('rotate'):
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                (output, errors) = process.communicate()
+        except OSError, e:
+            self.out.put("ERROR: Unable to run jpegtran (is libjpeg-turbo-progs installed?): %s" % e, self.out.LOG_LEVEL_ERROR)
+            return False
+        if process.returncode != 0:
+            self.out.put("Unable to turn %s upright losslessly: %s. Scale it instead." % (sourceFileName, errors.strip()),
+                         self.out.LOG_LEVEL_WARN)
+            if self.storage.exists(tempFileName):
+                self.storage.remove(tempFileName)
+            return False
+
+        try:
+            writeJpegOrientation(tempFileName, 1)
+        except (ExifHeaderError, IOError), e:
+            self.out.put("Unable to reset the orientation of %s after turning it upright: %s. Leaving it as it was." % (sourceFileName, e),
+                         self.out.LOG_LEVEL_WARN)
+            self.storage.remove(tempFileName)
+            return False
+        statResult = self.storage.stat(sourceFileName)
+        self.storage.utime(tempFileName, (statResult.st_atime, statResult.st_mtime))
+        self.system.rename(tempFileName, sourceFileName)
+        self.imageTool.releaseMetadata(sourceFileName)
+        self.stats.count('files')
+        return True
+
+    def getTargetFileName(self, sourceFileName, suffix=FILENAME_SCALED_SUFFIX):
         self.out.put("Setting target filename...", self.out.LOG_LEVEL_VERBOSE)
         (base, ext) = splitext(sourceFileName)
-        targetFileName = base + FILENAME_SCALED_SUFFIX + ext.lower()
+        outputFormat = self.arguments.get('format') or DEFAULT_FORMAT
+        if outputFormat != DEFAULT_FORMAT:
+            ext = OUTPUT_FORMATS[outputFormat][1]
+        targetFileName = base + suffix + ext.lower()
         self.out.put("source path: %s" % sourceFileName, self.out.LOG_LEVEL_VERBOSE)
         self.out.put("target path: %s" % targetFileName, self.out.LOG_LEVEL_VERBOSE)
         return targetFileName
@@ -84,6 +481,39 @@ class ImageScaler(Job):
     def inDebugMode(self):
         return self.system.__class__ == PySystemMock
 
+def scaleImageFileInWorker(task):
+    '''
+    scale a single file in a worker process. This has to be a module-level function
+    so that multiprocessing can pickle it.
+
+    The system class is passed instead of the system object, so that PySystemMock
+    (debug mode) is honored by the workers too.
+
+    Returns the buffered output calls, to be replayed by the parent process, whether it worked,
+    and the RunStats numbers to merge into the parent's (None if there are no stats).
+    '''
+    (sourceFileName, arguments, systemClass, logLevels) = task
+    out = BufferedOutput(logLevels)
+    succeeded = False
+    stats = openRunStats(arguments)
+    # (a storage can't be sent to another process, so the worker opens its own, the same way the parent did)
+    storage = openStorage(arguments)
+    try:
+        scaler = ImageScaler(out, systemClass(out))
+        scaler.arguments = arguments
+        scaler.stats = stats
+        scaler.storage = storage
+        scaler.imageTool = ImageFileInfoTool(scaler.out, scaler.system, stats=stats, storage=storage)
+        succeeded = scaler.tryProcessImageFile(sourceFileName)
+    except Exception:
+        # the worker itself couldn't be set up
+        out.unIndentAll()
+        out.put("ERROR: Unable to scale %s" % sourceFileName, out.LOG_LEVEL_ERROR)
+        out.put(traceback.format_exc(), out.LOG_LEVEL_DEBUG)
+    finally:
+        storage.close()
+    return (out.calls, succeeded, stats.asDict())
+
 if __name__ == "__main__":
     from py_base.Job import runMockJob
 
@@ -94,4 +524,10 @@ if __name__ == "__main__":
     runMockJob(ImageScaler,
                arguments={'limit_size': 100,
                           'greyscale': True,
+                          'jobs': 2,
+                          'incremental': True,
+                          'rotate_only': False,
+                          'encoding': 'web',
+                          'format': DEFAULT_FORMAT,
+                          'target_size': None,
                           'path': getTestFilePaths()})
@@ -0,0 +1,600 @@
+#!/usr/bin/python
+'''
+Benchmarks for the image_tools hot paths.
+
+Each benchmark builds its own synthetic corpus in a temporary directory, so nothing
+outside of it is touched. Run one with eg.
+
+    python -m image_tools.ImageToolsBenchmark scale-decode
+    python -m image_tools.ImageToolsBenchmark exif-read -n 3000 --width 640 --height 480
+    python -m image_tools.ImageToolsBenchmark classify -n 1000000
+    python -m image_tools.ImageToolsBenchmark startup -n 20 --width 800 --height 600
+    python -m image_tools.ImageToolsBenchmark renditions --renditions 2048,1200,400,1200g
+    python -m image_tools.ImageToolsBenchmark storage -n 2000 --latency 2 --io-threads 16
+
+The regression benchmark times each tool's per-file work, and compares it with a baseline
+saved by an earlier run on the same machine. It exits with status 1 if anything got slower
+than the baseline by more than the tolerance:
+
+    python -m image_tools.ImageToolsBenchmark regression -n 200 --width 3000 --height 2000 --save-baseline
+    python -m image_tools.ImageToolsBenchmark regression -n 200 --width 3000 --height 2000 --tolerance 0.2
+'''
+import argparse
+from datetime import datetime, timedelta
+import json
+from multiprocessing import Process, Queue
+import os
+from PIL import Image
+import pyexiv2
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from image_tools.AllStarCopier import AllStarCopier
+from image_tools.ExifHeader import buildExifBlock, readJpegHeader
+from image_tools.ImageDateStamper import ImageDateStamper
+from image_tools.ImageScaler import ImageScaler, parseLimitSizes
+from image_tools.ImageToolsDaemon import runInDaemon
+from image_tools.ImageToolsShared import EXIF_DATETIME_KEY, EXIF_ORIENTATION_KEY, ImageFileInfoTool, \
+    REGEX_FILENAME_SHOULD_BE_CHANGED, REGEX_IMAGE_FILENAME, REGEX_JPG_FILENAME, REGEX_LIST, openReducedImage, walkImageFiles
+from image_tools.Storage import DEFAULT_IO_THREADS, ConcurrentStorage, MemoryStorage
+
+
+# extension -> PIL format, for the synthetic corpora
+IMAGE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF'}
+DEFAULT_BASELINE_PATH = '~/.cache/image-tools/benchmark-baseline.json'
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_LATENCY_MS = 2.0
+FILES_PER_DIRECTORY = 50
+
+def makeSyntheticPicture(size):
+    '''
+    an image of the given size. The content is upscaled noise, which is smooth
+    enough to compress like a photo instead of like static.
+    '''
+    (width, height) = size
+    seedSize = (max(1, width / 10), max(1, height / 10))
+    seed = Image.frombytes('RGB', seedSize, os.urandom(seedSize[0] * seedSize[1] * 3))
+    return seed.resize(size, Image.BILINEAR)
+
+def makeSyntheticJpeg(fullPath, size, quality=90, dateTimeOriginal=None, orientation=None):
+    '''
+    write a JPEG of the given size (see makeSyntheticPicture())
+    '''
+    image = makeSyntheticPicture(size)
+    if dateTimeOriginal or orientation:
+        image.save(fullPath, 'JPEG', quality=quality, exif=buildExifBlock(dateTimeOriginal, orientation))
+    else:
+        image.save(fullPath, 'JPEG', quality=quality)
+
+def makeJpegCorpus(directory, count, size, withExif=False):
+    '''
+    write count synthetic JPEGs to directory, and return their paths (sorted).
+    withExif=True gives each one a DateTimeOriginal and an Orientation.
+    '''
+    paths = []
+    for i in range(count):
+        fullPath = '%s/IMG_%05d.JPG' % (directory, i)
+        if withExif:
+            makeSyntheticJpeg(fullPath, size,
+                              dateTimeOriginal=datetime(2014, 12, 13, 10, 0) + timedelta(minutes=i),
+                              orientation=[1, 3, 6, 8][i % 4])
+        else:
+            makeSyntheticJpeg(fullPath, size)
+        paths.append(fullPath)
+    return paths
+
+def makeMixedCorpus(directory, count, size, seed=0):
+    '''
+    write count synthetic images to directory, and return their paths (sorted).
+    They're named like makeSyntheticFilenames() (minus the non-images), so there's a mix of
+    JPEGs, PNGs and GIFs, stamped and camera names. Every other JPEG has EXIF.
+    '''
+    paths = []
+    for (i, name) in enumerate(makeSyntheticFilenames(count * 4, seed)):
+        if len(paths) == count:
+            break
+        fullPath = '%s/%s' % (directory, name)
+        imageFormat = IMAGE_FORMATS.get(name.split('.')[-1].lower())
+        if imageFormat == None or os.path.exists(fullPath):
+            continue
+        if imageFormat == 'JPEG' and i % 2:
+            makeSyntheticJpeg(fullPath, size,
+                              dateTimeOriginal=datetime(2014, 12, 13, 10, 0) + timedelta(minutes=i),
+                              orientation=[1, 3, 6, 8][i % 4])
+        else:
+            makeSyntheticPicture(size).save(fullPath, imageFormat)
+        paths.append(fullPath)
+    return sorted(paths)
+
+class NullOutput:
+    '''
+    JobOutput stand-in that throws everything away, so benchmarks measure the work and not the logging
+    '''
+    LOG_LEVEL_ERROR = 0
+    LOG_LEVEL_WARN = 1
+    LOG_LEVEL_INFO = 2
+    LOG_LEVEL_VERBOSE = 3
+    LOG_LEVEL_DEBUG = 4
+    logLevel = LOG_LEVEL_INFO  # (what a normal run shows, so the benchmarks skip the same formatting)
+
+    def put(self, *args):
+        pass
+
+    def indent(self, *args):
+        pass
+
+    def unIndent(self, *args):
+        pass
+
+class DirectSystem:
+    '''
+    the few system calls the tools make, straight to the filesystem and without logging
+    '''
+
+    def copy(self, sourceFullPath, targetFullPath):
+        shutil.copy2(sourceFullPath, targetFullPath)
+
+    def rename(self, sourceFullPath, targetFullPath):
+        os.rename(sourceFullPath, targetFullPath)
+
+    def mkdir(self, fullPath):
+        os.mkdir(fullPath)
+
+def makeJob(jobClass, arguments):
+    '''
+    a tool that really writes files, with arguments set directly instead of parsed from sys.argv
+    '''
+    out = NullOutput()
+    job = jobClass(out, DirectSystem())
+    job.arguments.update(arguments)
+    job.imageTool = ImageFileInfoTool(out, job.system)
+    return job
+
+def makeSyntheticFilenames(count, seed=0):
+    '''
+    a reproducible mix of the kinds of names the tools see: camera names, stamped names
+    (with and without time), month-name folders, and non-images
+    '''
+    generator = random.Random(seed)
+    templates = ['IMG_%(n)04d.JPG',
+                 'P%(n)07d.jpg',
+                 '%(y)04d-%(m)02d-%(d)02d %(title)s.jpg',
+                 '%(y)04d-%(m)02d-%(d)02d %(h)02d.%(i)02d %(title)s.JPG',
+                 'jan-%(yy)02d %(title)s.png',
+                 '%(title)s.gif',
+                 '%(title)s.txt']
+    titles = ['Beach day', 'Birthday party', 'Grandma and the cat', 'Snow', 'Concert']
+    names = []
+    for n in range(count):
+        names.append(generator.choice(templates) % {'n': n,
+                                                    'y': generator.randint(1990, 2014),
+                                                    'yy': generator.randint(0, 99),
+                                                    'm': generator.randint(1, 12),
+                                                    'd': generator.randint(1, 28),
+                                                    'h': generator.randint(0, 23),
+                                                    'i': generator.randint(0, 59),
+                                                    'title': generator.choice(titles)})
+    return names
+
+def _runAndReport(queue, function, args):
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    peakRssKb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, peakRssKb, result))
+
+def runInChildProcess(function, *args):
+    '''
+    run function(*args) in a fresh process, so that its peak RSS isn't polluted
+    by whatever ran before it. Returns (seconds, peak RSS in KB, function's result).
+    '''
+    queue = Queue()
+    child = Process(target=_runAndReport, args=(queue, function, args))
+    child.start()
+    report = queue.get()
+    child.join()
+    return report
+
+def printTable(header, rows):
+    widths = [max([len(str(row[i])) for row in [header] + rows]) for i in range(len(header))]
+    for row in [header] + rows:
+        print '  '.join([str(cell).rjust(widths[i]) for (i, cell) in enumerate(row)])
+
+
+# --- scale-decode: full decode vs. reduced (draft mode) decode in ImageScaler ---
+
+def _scaleWithFullDecode(paths, limitSize, greyscale):
+    # what ImageScaler.processImage used to do
+    for fullPath in paths:
+        image = Image.open(fullPath)
+        if greyscale:
+            image = image.convert('L')
+        image.thumbnail((limitSize, limitSize), Image.ANTIALIAS)
+
+def _scaleWithReducedDecode(paths, limitSize, greyscale):
+    for fullPath in paths:
+        image = openReducedImage(fullPath, limitSize, greyscale)
+        if greyscale and image.mode != 'L':
+            image = image.convert('L')
+        image.thumbnail((limitSize, limitSize), Image.ANTIALIAS)
+
+def benchmarkScaleDecode(arguments):
+    directory = tempfile.mkdtemp(prefix='image-tools-bench-')
+    try:
+        size = (arguments.width, arguments.height)
+        print "generating %d synthetic %dx%d JPEGs..." % (arguments.count, size[0], size[1])
+        paths = makeJpegCorpus(directory, arguments.count, size)
+        rows = []
+        for greyscale in [False, True]:
+            for (name, function) in [('full decode', _scaleWithFullDecode),
+                                     ('reduced decode', _scaleWithReducedDecode)]:
+                (elapsed, peakRssKb, _) = runInChildProcess(function, paths, arguments.limit_size, greyscale)
+                rows.append([name,
+                             greyscale and 'yes' or 'no',
+                             '%.1f' % (1000.0 * elapsed / len(paths)),
+                             '%.1f' % (peakRssKb / 1024.0)])
+        printTable(['method', 'greyscale', 'ms/image', 'peak RSS (MB)'], rows)
+    finally:
+        shutil.rmtree(directory)
+
+
+# --- exif-read: ExifHeader vs. a full pyexiv2 metadata read ---
+
+def _readExifWithPyexiv2(paths):
+    for fullPath in paths:
+        metadata = pyexiv2.ImageMetadata(fullPath)
+        metadata.read()
+        metadata[EXIF_DATETIME_KEY].value
+        metadata[EXIF_ORIENTATION_KEY].value
+
+def _readExifWithHeaderReader(paths):
+    for fullPath in paths:
+        readJpegHeader(fullPath)
+
+def benchmarkExifRead(arguments):
+    directory = tempfile.mkdtemp(prefix='image-tools-bench-')
+    try:
+        print "generating %d synthetic %dx%d JPEGs with EXIF..." % (arguments.count, arguments.width, arguments.height)
+        paths = makeJpegCorpus(directory, arguments.count, (arguments.width, arguments.height), withExif=True)
+        rows = []
+        for (name, function) in [('pyexiv2', _readExifWithPyexiv2),
+                                 ('ExifHeader', _readExifWithHeaderReader)]:
+            (elapsed, peakRssKb, _) = runInChildProcess(function, paths)
+            rows.append([name,
+                         '%.0f' % (len(paths) / elapsed),
+                         '%.3f' % (1000.0 * elapsed / len(paths))])
+        printTable(['reader', 'files/s', 'ms/file'], rows)
+    finally:
+        shutil.rmtree(directory)
+
+
+# --- classify: one file at a time with raw regex strings vs. ImageFileInfoTool.classify() ---
+
+def _classifyOneAtATime(names):
+    # what the per-file methods used to do, including formatting the (discarded) log message
+    out = NullOutput()
+    for name in names:
+        re.match(REGEX_IMAGE_FILENAME, name, re.I)
+        re.match(REGEX_JPG_FILENAME, name, re.I)
+        result = {}
+        for patternConfig in REGEX_LIST:
+            m = re.match(patternConfig[0], name)
+            if not m:
+                continue
+            for i in range(1, len(patternConfig)):
+                result[patternConfig[i]] = m.group(i)
+            out.put("Returning filename info for %s: %s" % (name, result), out.LOG_LEVEL_VERBOSE)
+            break
+        if 'title' in result:
+            re.search(REGEX_FILENAME_SHOULD_BE_CHANGED, result['title'])
+
+def _classifyBatch(names):
+    ImageFileInfoTool(NullOutput(), None).classify(names)
+
+def benchmarkClassify(arguments):
+    print "generating %d synthetic file names..." % arguments.count
+    names = makeSyntheticFilenames(arguments.count)
+    rows = []
+    for (name, function) in [('one at a time', _classifyOneAtATime),
+                             ('classify()', _classifyBatch)]:
+        (elapsed, peakRssKb, _) = runInChildProcess(function, names)
+        rows.append([name,
+                     '%.0f' % (len(names) / elapsed),
+                     '%.2f' % (1000000.0 * elapsed / len(names)),
+                     '%.1f' % (peakRssKb / 1024.0)])
+    printTable(['method', 'names/s', 'us/name', 'peak RSS (MB)'], rows)
+
+
+# --- startup: a fresh interpreter per request vs. a request to a warm image-tools-daemon ---
+
+def _median(values):
+    return sorted(values)[len(values) / 2]
+
+def benchmarkStartup(arguments):
+    directory = tempfile.mkdtemp(prefix='image-tools-bench-')
+    socketPath = '%s/daemon.sock' % directory
+    daemon = None
+    try:
+        print "generating %d synthetic %dx%d JPEGs..." % (arguments.count, arguments.width, arguments.height)
+        paths = makeJpegCorpus(directory, arguments.count, (arguments.width, arguments.height))
+        toolArguments = ['--jobs', '1', '--limit-size', str(arguments.limit_size)]
+
+        importOnly = []
+        cold = []
+        for fullPath in paths:
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', 'import image_tools.ImageScaler'])
+            importOnly.append(time.time() - start)
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', 'from image_tools.ImageScaler import ImageScaler; ImageScaler().run()',
+                                   ] + toolArguments + [fullPath])
+            cold.append(time.time() - start)
+
+        daemon = subprocess.Popen([sys.executable, '-m', 'image_tools.ImageToolsDaemon', '--socket', socketPath])
+        while not os.path.exists(socketPath):
+            time.sleep(0.05)
+        warm = []
+        for fullPath in paths:
+            start = time.time()
+            if not runInDaemon('scale-image', toolArguments + [fullPath], socketPath):
+                raise Exception("image-tools-daemon didn't answer on %s" % socketPath)
+            warm.append(time.time() - start)
+
+        rows = []
+        for (name, times) in [('cold start, import only', importOnly),
+                              ('cold start, scale 1 image', cold),
+                              ('daemon, scale 1 image', warm)]:
+            rows.append([name, '%.0f' % (1000 * _median(times)), '%.0f' % (1000 * max(times))])
+        printTable(['', 'median ms', 'max ms'], rows)
+    finally:
+        if daemon != None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(directory)
+
+
+# --- renditions: one ImageScaler run per size vs. one run that makes every size from a single decode ---
+
+def _scaleEachSizeSeparately(paths, limitSizes):
+    for (limitSize, greyscale) in limitSizes:
+        scaler = makeJob(ImageScaler, {'limit_size': limitSize, 'greyscale': greyscale})
+        for fullPath in paths:
+            scaler.processImageFile(fullPath)
+
+def _scaleAllSizesAtOnce(paths, limitSizes):
+    scaler = makeJob(ImageScaler, {'limit_size': limitSizes, 'greyscale': False})
+    for fullPath in paths:
+        scaler.processImageFile(fullPath)
+
+def benchmarkRenditions(arguments):
+    directory = tempfile.mkdtemp(prefix='image-tools-bench-')
+    try:
+        limitSizes = parseLimitSizes(arguments.renditions)
+        print "generating %d synthetic %dx%d JPEGs with EXIF..." % (arguments.count, arguments.width, arguments.height)
+        paths = makeJpegCorpus(directory, arguments.count, (arguments.width, arguments.height), withExif=True)
+        rows = []
+        for (name, function) in [('one run per size', _scaleEachSizeSeparately),
+                                 ('cascade', _scaleAllSizesAtOnce)]:
+            (elapsed, peakRssKb, _) = runInChildProcess(function, paths, limitSizes)
+            rows.append([name,
+                         '%.1f' % (1000.0 * elapsed / len(paths)),
+                         '%.1f' % (peakRssKb / 1024.0)])
+        printTable(['method', 'ms/source image', 'peak RSS (MB)'], rows)
+    finally:
+        shutil.rmtree(directory)
+
+
+# --- storage: bulk file operations one at a time vs. many in flight, with a delay per operation ---
+
+def makeMemoryTree(storage, count):
+    '''
+    count small files in storage, FILES_PER_DIRECTORY to a folder, like /photos/2003/day 7/IMG_0012.JPG
+    '''
+    paths = []
+    for i in range(count):
+        folder = i / FILES_PER_DIRECTORY
+        fullPath = '/photos/%d/day %d/IMG_%04d.JPG' % (2000 + folder % 10, folder, i % FILES_PER_DIRECTORY)
+        storage.putFile(fullPath, 'x' * (1000 + i))
+        paths.append(fullPath)
+    storage.putFile('/copies/.keep', '')
+    return paths
+
+def _timeStorageOperations(storage, paths):
+    '''
+    {operation: (seconds, operations)} for a recursive walk, a stat of every file and a copy of every file
+    '''
+    results = {}
+    for (name, function) in [('walkImageFiles', lambda: list(walkImageFiles('/photos', True, storage=storage))),
+                             ('statMany', lambda: storage.statMany(paths)),
+                             ('copyMany', lambda: storage.copyMany([(fullPath, '/copies/%d.JPG' % i) for (i, fullPath) in enumerate(paths)]))]:
+        operations = storage.operations
+        start = time.time()
+        function()
+        results[name] = (time.time() - start, storage.operations - operations)
+    return results
+
+def benchmarkStorage(arguments):
+    latency = arguments.latency / 1000.0
+    print "making %d files in memory, with %g ms per file operation..." % (arguments.count, arguments.latency)
+    results = []
+    for threads in [1, arguments.io_threads]:
+        memoryStorage = MemoryStorage(latency)
+        paths = makeMemoryTree(memoryStorage, arguments.count)
+        if threads == 1:
+            storage = memoryStorage
+        else:
+            # (its operations are still counted by the storage underneath)
+            storage = ConcurrentStorage(memoryStorage, threads)
+        try:
+            results.append(_timeStorageOperations(storage, paths))
+        finally:
+            storage.close()
+    (oneAtATime, inFlight) = results
+    rows = []
+    for name in ['walkImageFiles', 'statMany', 'copyMany']:
+        rows.append([name,
+                     oneAtATime[name][1],
+                     '%.2f' % oneAtATime[name][0],
+                     '%.2f' % inFlight[name][0],
+                     '%.1fx' % (oneAtATime[name][0] / inFlight[name][0])])
+    printTable(['', 'operations', 'one at a time (s)', '%d threads (s)' % arguments.io_threads, 'speedup'], rows)
+
+
+# --- regression: each tool's per-file work, compared with a saved baseline ---
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def _timeEach(function, paths):
+    '''
+    call function(path) for each path, and return how long each call took
+    '''
+    latencies = []
+    for fullPath in paths:
+        start = time.time()
+        function(fullPath)
+        latencies.append(time.time() - start)
+    return latencies
+
+def _timeGetFileInfo(paths, limitSize):
+    imageTool = ImageFileInfoTool(NullOutput(), DirectSystem())
+
+    def getFileInfo(fullPath):
+        imageTool.getFileInfo(fullPath, okToUseFileName=True)
+        imageTool.releaseMetadata(fullPath)
+    return _timeEach(getFileInfo, paths)
+
+def _timeStamp(paths, limitSize):
+    stamper = makeJob(ImageDateStamper, {'strip': False, 'time': True, 'recursive': False, 'undo': False})
+
+    def stamp(fullPath):
+        # the whole entry point, one file per run: reading the date, planning and journalling the rename
+        stamper.arguments['path'] = [fullPath]
+        stamper.stamp()
+    return _timeEach(stamp, paths)
+
+def _timeProcessImage(paths, limitSize):
+    scaler = makeJob(ImageScaler, {'limit_size': limitSize, 'greyscale': False})
+
+    def processImage(fullPath):
+        # (the decode is lazy, so it happens inside processImage(), as it does in a real run)
+        scaler.processImage(openReducedImage(fullPath, limitSize), scaler.getTargetFileName(fullPath))
+    return _timeEach(processImage, paths)
+
+def _timeCopyToAllStars(paths, limitSize):
+    copier = makeJob(AllStarCopier, {'link_mode': 'copy'})
+    return _timeEach(copier.copyToAllStars, paths)
+
+REGRESSION_CASES = [('ImageFileInfoTool.getFileInfo', _timeGetFileInfo),
+                    ('ImageDateStamper.stamp', _timeStamp),
+                    ('ImageScaler.processImage', _timeProcessImage),
+                    ('AllStarCopier.copyToAllStars', _timeCopyToAllStars),
+                    ]
+
+def compareWithBaseline(results, baseline, tolerance):
+    '''
+    returns a message for each case whose median time per file is more than tolerance
+    (a fraction) slower than in the baseline
+    '''
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        limit = baseline[name]['p50'] * (1 + tolerance)
+        if result['p50'] > limit:
+            regressions.append("%s: median %.2f ms, baseline %.2f ms (+%.0f%%)"
+                               % (name, 1000 * result['p50'], 1000 * baseline[name]['p50'],
+                                  100 * (result['p50'] / baseline[name]['p50'] - 1)))
+    return regressions
+
+def benchmarkRegression(arguments):
+    directory = tempfile.mkdtemp(prefix='image-tools-bench-')
+    try:
+        print "generating %d synthetic %dx%d images..." % (arguments.count, arguments.width, arguments.height)
+        os.mkdir('%s/corpus' % directory)
+        makeMixedCorpus('%s/corpus' % directory, arguments.count, (arguments.width, arguments.height))
+        results = {}
+        rows = []
+        for (name, function) in REGRESSION_CASES:
+            # each case gets a fresh copy, because stamping renames, and scaling and all-starring add files.
+            # The copy is two levels down, under a folder with an All Stars folder in it.
+            caseDirectory = '%s/%s/shoot/day 1' % (directory, name)
+            shutil.copytree('%s/corpus' % directory, caseDirectory)
+            os.mkdir('%s/%s/All Stars' % (directory, name))
+            paths = sorted(['%s/%s' % (caseDirectory, f) for f in os.listdir(caseDirectory)])
+            (elapsed, peakRssKb, latencies) = runInChildProcess(function, paths, arguments.limit_size)
+            results[name] = {'p50': _percentile(latencies, 0.5),
+                             'p95': _percentile(latencies, 0.95),
+                             'throughput': len(latencies) / sum(latencies),
+                             'peakRssKb': peakRssKb}
+            rows.append([name,
+                         '%.1f' % results[name]['throughput'],
+                         '%.2f' % (1000 * results[name]['p50']),
+                         '%.2f' % (1000 * results[name]['p95']),
+                         '%.1f' % (peakRssKb / 1024.0)])
+        printTable(['', 'files/s', 'p50 ms', 'p95 ms', 'peak RSS (MB)'], rows)
+    finally:
+        shutil.rmtree(directory)
+
+    settings = {'count': arguments.count, 'width': arguments.width, 'height': arguments.height,
+                'limit_size': arguments.limit_size}
+    baselinePath = os.path.expanduser(arguments.baseline)
+    if arguments.save_baseline:
+        if not os.path.exists(os.path.dirname(baselinePath)):
+            os.makedirs(os.path.dirname(baselinePath))
+        json.dump({'settings': settings, 'results': results}, open(baselinePath, 'w'), indent=1, sort_keys=True)
+        print "saved the baseline to %s" % baselinePath
+        return
+    if not os.path.exists(baselinePath):
+        print "no baseline to compare with (make one with --save-baseline)"
+        return
+    baseline = json.load(open(baselinePath))
+    if baseline['settings'] != settings:
+        print "not comparing with the baseline in %s, because it was made with different settings: %s" % (baselinePath, baseline['settings'])
+        return
+    regressions = compareWithBaseline(results, baseline['results'], arguments.tolerance)
+    if regressions:
+        print "SLOWER than the baseline in %s:" % baselinePath
+        for regression in regressions:
+            print "  %s" % regression
+        sys.exit(1)
+    print "no regressions against the baseline in %s" % baselinePath
+
+
+BENCHMARKS = {'classify': benchmarkClassify,
+              'exif-read': benchmarkExifRead,
+              'regression': benchmarkRegression,
+              'renditions': benchmarkRenditions,
+              'scale-decode': benchmarkScaleDecode,
+              'startup': benchmarkStartup,
+              'storage': benchmarkStorage,
+              }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image_tools hot paths")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('-n', '--count', type=int, default=10, help="Number of synthetic images (default 10)")
+    parser.add_argument('--width', type=int, default=6000, help="Width of synthetic images (default 6000)")
+    parser.add_argument('--height', type=int, default=4000, help="Height of synthetic images (default 4000)")
+    parser.add_argument('-l', '--limit-size', type=int, default=1200, help="Size to scale to (default 1200)")
+    parser.add_argument('--renditions', default='2048,1200,400,1200g',
+                        help="Sizes for the renditions benchmark (default 2048,1200,400,1200g)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH,
+                        help="Baseline file for the regression benchmark (default %s)" % DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help="Save the regression benchmark results as the new baseline, instead of comparing with it")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="How much slower than the baseline is still OK, as a fraction (default %.2f)" % DEFAULT_TOLERANCE)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY_MS,
+                        help="Delay per file operation for the storage benchmark, in ms (default %g)" % DEFAULT_LATENCY_MS)
+    parser.add_argument('--io-threads', type=int, default=DEFAULT_IO_THREADS,
+                        help="Threads for the storage benchmark (default %d)" % DEFAULT_IO_THREADS)
+    arguments = parser.parse_args()
+    BENCHMARKS[arguments.benchmark](arguments)
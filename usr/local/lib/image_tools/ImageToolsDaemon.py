@@ -0,0 +1,174 @@
+#!/usr/bin/python
+'''
+An optional long-running worker for the Nemo actions.
+
+Every right-click otherwise starts a new python, which imports PIL, pyexiv2 and py_base
+before it even looks at its arguments. With the daemon running (image-tools-daemon),
+the nemo wrappers hand their arguments over a unix socket instead, and the work is done
+by a process that already has everything loaded.
+
+The client side (runInDaemon()) only uses the standard library, and is cheap to import.
+If the daemon isn't running (or dies before it answers), runInDaemon() returns False and the
+caller should run the tool itself, the same as before. The tool's output is sent back with the
+answer, and printed by the caller.
+'''
+import json
+import os
+import socket
+from StringIO import StringIO
+import sys
+import traceback
+
+
+# tool name (the same as the script in /usr/local/bin) -> (module, class)
+TOOLS = {'all-star': ('image_tools.AllStarCopier', 'AllStarCopier'),
+         'date-stamp-images': ('image_tools.ImageDateStamper', 'ImageDateStamper'),
+         'scale-image': ('image_tools.ImageScaler', 'ImageScaler'),
+         'find-near-duplicates': ('image_tools.NearDuplicateFinder', 'NearDuplicateFinder'),
+         }
+DEFAULT_IDLE_TIMEOUT = 30 * 60  # seconds
+
+def getDefaultSocketPath():
+    runtimeDirectory = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtimeDirectory:
+        runtimeDirectory = os.path.expanduser('~/.cache/image-tools')
+    return '%s/image-tools.sock' % runtimeDirectory
+
+def runInDaemon(toolName, arguments, socketPath=None):
+    '''
+    ask the daemon to run a tool with these (command line) arguments, wait for it to finish,
+    and print the tool's output. Returns False if there's no daemon to ask, or it didn't answer.
+    '''
+    if socketPath == None:
+        socketPath = getDefaultSocketPath()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(socketPath)
+        except socket.error:
+            return False
+        request = {'tool': toolName,
+                   'arguments': arguments,
+                   'cwd': os.getcwd()}
+        try:
+            connection.sendall(json.dumps(request) + '\n')
+            response = json.loads(connection.makefile('r').readline())
+        except (socket.error, ValueError):
+            # the daemon went away before answering (an empty reply isn't json)
+            return False
+    finally:
+        connection.close()
+    sys.stdout.write(response.get('output', '').encode('utf-8'))
+    if response['status'] != 'ok':
+        sys.stderr.write("image-tools-daemon: %s\n" % response['message'])
+    return True
+
+class ImageToolsDaemon:
+    '''
+    Serves requests from runInDaemon(), one at a time, until it has been idle for idleTimeout seconds.
+    '''
+
+    def __init__(self, socketPath=None, idleTimeout=DEFAULT_IDLE_TIMEOUT):
+        if socketPath == None:
+            socketPath = getDefaultSocketPath()
+        self.socketPath = socketPath
+        self.idleTimeout = idleTimeout
+
+    def warmUp(self):
+        '''
+        do all the slow imports now, instead of on the first request
+        '''
+        from PIL import Image
+        Image.init()  # loads all the image format plugins
+        import pyexiv2
+        import sqlite3
+        for (moduleName, className) in TOOLS.values():
+            __import__(moduleName)
+
+    def serve(self):
+        import SocketServer
+        self.warmUp()
+        if not os.path.isdir(os.path.dirname(self.socketPath)):
+            os.makedirs(os.path.dirname(self.socketPath))
+        if os.path.exists(self.socketPath):
+            # left over from a daemon that died, or one that's still running
+            if runInDaemon(None, [], self.socketPath):
+                raise SystemExit("image-tools-daemon is already running on %s" % self.socketPath)
+            os.remove(self.socketPath)
+
+        daemon = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                response = daemon.handleRequest(request)
+                self.wfile.write(json.dumps(response) + '\n')
+
+        oldUmask = os.umask(0077)  # only this user gets to talk to the daemon
+        try:
+            server = SocketServer.UnixStreamServer(self.socketPath, RequestHandler)
+        finally:
+            os.umask(oldUmask)
+        server.timeout = self.idleTimeout
+        server.idle = False
+        server.handle_timeout = lambda: setattr(server, 'idle', True)
+        try:
+            while not server.idle:
+                server.handle_request()
+        finally:
+            server.server_close()
+            os.remove(self.socketPath)
+
+    def handleRequest(self, request):
+        if request['tool'] == None:
+            # just checking that we're alive (see serve())
+            return {'status': 'ok'}
+        if request['tool'] not in TOOLS:
+            return {'status': 'error', 'message': "Unknown tool %s" % request['tool']}
+        (moduleName, className) = TOOLS[request['tool']]
+        toolClass = getattr(sys.modules[moduleName], className)
+
+        # run the tool just as if it had been started from the command line
+        (oldArgv, oldCwd, oldStdout, oldStderr) = (sys.argv, os.getcwd(), sys.stdout, sys.stderr)
+        output = StringIO()
+        response = {'status': 'ok'}
+        try:
+            # (json gives back unicode, but the tools expect byte strings, just like a real sys.argv)
+            sys.argv = [argument.encode('utf-8') for argument in [request['tool']] + request['arguments']]
+            os.chdir(request['cwd'].encode('utf-8'))
+            # what the tool prints goes back to the caller, not to wherever the daemon's output goes
+            sys.stdout = sys.stderr = output
+            toolClass().run()
+        except SystemExit, e:
+            if e.code:
+                response = {'status': 'error', 'message': "%s exited with %s" % (request['tool'], e.code)}
+        except Exception:
+            response = {'status': 'error', 'message': traceback.format_exc()}
+        finally:
+            (sys.argv, sys.stdout, sys.stderr) = (oldArgv, oldStdout, oldStderr)
+            os.chdir(oldCwd)
+        response['output'] = output.getvalue()
+        if isinstance(response['output'], str):
+            # (file names needn't be utf-8)
+            response['output'] = response['output'].decode('utf-8', 'replace')
+        return response
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Keep the image tools loaded, to run Nemo actions without startup delay")
+    parser.add_argument('--socket',
+                        default=getDefaultSocketPath(),
+                        help="Path of the unix socket to listen on (default %s)" % getDefaultSocketPath(),
+                        )
+    parser.add_argument('--idle-timeout',
+                        metavar='SECONDS',
+                        type=int,
+                        default=DEFAULT_IDLE_TIMEOUT,
+                        help="Exit after this long without requests (default %d)" % DEFAULT_IDLE_TIMEOUT,
+                        )
+    arguments = parser.parse_args()
+    ImageToolsDaemon(arguments.socket, arguments.idle_timeout).serve()
+
+if __name__ == "__main__":
+    main()
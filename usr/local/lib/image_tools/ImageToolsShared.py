@@ -1,10 +1,29 @@
+from collections import namedtuple
 from datetime import datetime
-from os.path import basename, dirname, getmtime, splitext
-import pyexiv2
+from math import ceil
+from os.path import basename, dirname, splitext
 import re
 
+from image_tools.ExifHeader import ExifHeaderError, parseExifBlock, readJpegHeader
+from image_tools.RunStats import NULL_RUN_STATS
+from image_tools.Storage import LOCAL_STORAGE
+
 
 EXIF_DATETIME_KEY = 'Exif.Photo.DateTimeOriginal'
+EXIF_ORIENTATION_KEY = 'Exif.Image.Orientation'
+XMP_PREFIX = 'http://ns.adobe.com/xap/1.0/\x00'  # an APP1 segment that holds XMP instead of EXIF
+IPTC_PREFIX = 'Photoshop 3.0\x00'  # the APP13 segment that holds IPTC
+
+# EXIF orientation -> the PIL transposes (Image.<name>) that turn the pixels upright.
+# (5 and 7 are Image.TRANSPOSE and Image.TRANSVERSE, which older versions of PIL don't have)
+ORIENTATION_TRANSPOSES = {2: ['FLIP_LEFT_RIGHT'],
+                          3: ['ROTATE_180'],
+                          4: ['FLIP_TOP_BOTTOM'],
+                          5: ['ROTATE_90', 'FLIP_TOP_BOTTOM'],
+                          6: ['ROTATE_270'],
+                          7: ['ROTATE_90', 'FLIP_LEFT_RIGHT'],
+                          8: ['ROTATE_90'],
+                          }
 
 SEPARATOR = '[-_\. /]'  # date or title separator
 REGEX_FILENAME_SHOULD_BE_CHANGED = '(\d{3,}%s\d{3,})|(\d{5,})|((IMG|P|DSCF?)_?\d{4,})' % SEPARATOR
@@ -21,6 +40,46 @@ REGEX_LIST = [['^(\d{2}|\d{4})%s(\d{2})%s(\d{2})%s(\d{2})%s(\d{2})%s+(.+)\.(\w{1
               ['^(.+)\.(\w{1,4})',
                'title', 'extension'],
               ]
+FILENAME_INFO_FIELDS = ['year', 'month', 'day', 'hour', 'minute', 'month_alpha', 'title', 'extension']
+
+def compileFilenamePatterns(regexList):
+    '''
+    compile a list like REGEX_LIST into a single regex, with one alternative per pattern.
+    Alternatives are tried in order, so the first pattern that matches wins, just like trying
+    them one at a time.
+
+    Returns (compiled regex, {index of an alternative's group: (offset of its first field in match.groups(), field names)}).
+    The outermost group of the alternative that matched is always match.lastindex.
+    '''
+    alternatives = []
+    fieldsByGroup = {}
+    groupIndex = 1
+    for patternConfig in regexList:
+        pattern = patternConfig[0]
+        if pattern.startswith('^'):
+            pattern = pattern[1:]
+        alternatives.append('(%s)' % pattern)
+        fieldsByGroup[groupIndex] = (groupIndex, patternConfig[1:])
+        groupIndex += 1 + re.compile(pattern).groups
+    return (re.compile('^(?:%s)' % '|'.join(alternatives)), fieldsByGroup)
+
+(FILENAME_PATTERN, FILENAME_PATTERN_FIELDS) = compileFilenamePatterns(REGEX_LIST)
+IMAGE_FILENAME_PATTERN = re.compile(REGEX_IMAGE_FILENAME, re.I)
+JPG_FILENAME_PATTERN = re.compile(REGEX_JPG_FILENAME, re.I)
+FILENAME_SHOULD_BE_CHANGED_PATTERN = re.compile(REGEX_FILENAME_SHOULD_BE_CHANGED)
+
+# what ImageFileInfoTool.classify() returns for each file. Filename fields that weren't in the name are None.
+ImageFileRecord = namedtuple('ImageFileRecord', ['path', 'isImage', 'isJpg', 'shouldBeRenamed'] + FILENAME_INFO_FIELDS)
+
+def matchFilename(fileName):
+    '''
+    return {field: value} for the first pattern in REGEX_LIST that matches fileName, or None
+    '''
+    m = FILENAME_PATTERN.match(fileName)
+    if not m:
+        return None
+    (offset, fields) = FILENAME_PATTERN_FIELDS[m.lastindex]
+    return dict(zip(fields, m.groups()[offset:offset + len(fields)]))
 
 def getTestFilePaths():
     from os import listdir
@@ -28,15 +87,279 @@ def getTestFilePaths():
     testFiles = sorted(['%s/%s' % (testPath, f) for f in listdir(testPath)])
     return testFiles
 
+def walkImageFiles(directory, recursive=False, stats=NULL_RUN_STATS, storage=LOCAL_STORAGE):
+    '''
+    generate (full path, stat result) for the image files in directory, sorted by name.
+    If recursive, each subdirectory (also sorted by name) is walked after the files.
+
+    Each directory is read in one go before its files are yielded, so it's safe for the
+    caller to rename files as it goes. Symlinked directories aren't followed.
+
+    The files of a directory are stat()ed together, and the subdirectories of a directory are
+    listed together, so with a ConcurrentStorage those round trips overlap.
+    '''
+    with stats.timer('listdir'):
+        entries = storage.scanDirectory(directory)
+    for result in _walkEntries(entries, recursive, stats, storage):
+        yield result
+
+def _walkEntries(entries, recursive, stats, storage):
+    entries = sorted(entries)
+    subdirectories = [fullPath for (name, fullPath, isDirectory, statFunction) in entries if isDirectory]
+    images = [(fullPath, statFunction) for (name, fullPath, isDirectory, statFunction) in entries
+              if not isDirectory and IMAGE_FILENAME_PATTERN.match(name)]
+    with stats.timer('stat'):
+        statResults = storage.map(lambda (fullPath, statFunction): _statOrNone(statFunction), images)
+    for ((fullPath, statFunction), statResult) in zip(images, statResults):
+        # (None if it vanished since the directory was listed, or it's a broken symlink)
+        if statResult != None:
+            yield (fullPath, statResult)
+    if recursive and subdirectories:
+        with stats.timer('listdir'):
+            subdirectoryEntries = storage.scanDirectories(subdirectories)
+        for entries in subdirectoryEntries:
+            if entries != None:
+                for result in _walkEntries(entries, recursive, stats, storage):
+                    yield result
+
+def isLogged(out, level):
+    '''
+    whether out shows messages at level (up to its logLevel, like JobOutput), so that messages that
+    are costly to format (eg. a dict per file) can be skipped when they wouldn't be shown.
+    '''
+    if not hasattr(out, 'logLevel'):
+        # (rather than quietly formatting everything)
+        raise AttributeError("%s has no logLevel, so there's no telling which messages it shows" % out.__class__.__name__)
+    return level <= out.logLevel
+
+def _statOrNone(statFunction):
+    try:
+        return statFunction()
+    except OSError:
+        return None
+
+def hasNonExifMetadata(image):
+    '''
+    whether an opened (JPEG) image has metadata besides its EXIF block: XMP, IPTC or a comment.
+    This only looks at the segments PIL already read, so no extra pass over the file.
+    '''
+    for (marker, data) in getattr(image, 'applist', []):
+        if marker == 'COM' or (marker == 'APP1' and data.startswith(XMP_PREFIX)) or \
+                (marker == 'APP13' and data.startswith(IPTC_PREFIX)):
+            return True
+    return False
+
+def openReducedImage(fullPath, limitSize, greyscale=False, storage=LOCAL_STORAGE):
+    '''
+    open an image, asking the decoder for the smallest size that is still at least
+    as big as the image will be after scaling it to fit in limitSize x limitSize.
+
+    For JPEGs this lets libjpeg use DCT scaling (1/2, 1/4 or 1/8 size), so most of a
+    big camera image never gets decoded, and with greyscale=True only the luma channel
+    is decoded. Other formats are decoded at full size as usual.
+    The caller should still resize the result (eg. with thumbnail()) to get the exact size.
+    '''
+    # PIL and pyexiv2 are imported where they're used, so that starting up (eg. from a
+    # Nemo action) doesn't pay for them until there's an image to work on
+    from PIL import Image
+    image = Image.open(storage.open(fullPath, 'rb'))
+    if image.format != 'JPEG':
+        return image
+    (width, height) = image.size
+    ratio = min(float(limitSize) / width, float(limitSize) / height)
+    if ratio < 1:
+        requestedSize = (int(ceil(width * ratio)), int(ceil(height * ratio)))
+    else:
+        requestedSize = image.size
+    if greyscale:
+        mode = 'L'
+    else:
+        mode = image.mode
+    image.draft(mode, requestedSize)
+    return image
+
+def getImageOrientation(image):
+    '''
+    the EXIF orientation of an opened image; 1 if it doesn't say (or its EXIF can't be read)
+    '''
+    exif = image.info.get('exif')
+    if not exif:
+        return 1
+    try:
+        return parseExifBlock(exif).orientation or 1
+    except ExifHeaderError:
+        return 1
+
+class BufferedOutput:
+    '''
+    Stand-in for JobOutput that records calls instead of printing them, so that
+    a worker process can hand its log back to the parent to be replayed in order
+    (see replay()). Otherwise output from parallel workers would be interleaved.
+    '''
+
+    LOG_LEVEL_NAMES = ['LOG_LEVEL_ERROR', 'LOG_LEVEL_WARN', 'LOG_LEVEL_INFO',
+                       'LOG_LEVEL_VERBOSE', 'LOG_LEVEL_DEBUG', 'logLevel']
+
+    def __init__(self, logLevels):
+        # copy the log level constants from the real output, so that callers can
+        # keep using self.out.LOG_LEVEL_* without knowing the difference
+        for name, value in logLevels.items():
+            setattr(self, name, value)
+        self.calls = []
+        self.indentLevel = 0
+
+    @classmethod
+    def getLogLevels(cls, out):
+        return dict([(name, getattr(out, name)) for name in cls.LOG_LEVEL_NAMES])
+
+    def put(self, *args):
+        self.calls.append(('put', args))
+
+    def indent(self, *args):
+        self.indentLevel += 1
+        self.calls.append(('indent', args))
+
+    def unIndent(self, *args):
+        self.indentLevel -= 1
+        self.calls.append(('unIndent', args))
+
+    def unIndentAll(self):
+        # used after an error, so that a half-finished file doesn't leave the log indented
+        while self.indentLevel > 0:
+            self.unIndent()
+
+    @staticmethod
+    def replay(out, calls):
+        for (method, args) in calls:
+            getattr(out, method)(*args)
+
+class ImageFileMetadata:
+    '''
+    The metadata of a single image file, parsed at most once: the filename info
+    (see ImageFileInfoTool.getFileInfoFromFilename()) and the EXIF metadata are each
+    read the first time they're asked for, and then served from here.
+
+    Get these from ImageFileInfoTool.getMetadata() rather than creating them directly,
+    so that they're shared across the whole run.
+    '''
+
+    def __init__(self, fullPath, storage=LOCAL_STORAGE):
+        self.fullPath = fullPath
+        self.storage = storage
+        self.filenameInfo = None
+        self.exifMetadata = None
+        self.exifFields = None
+
+    def getExifMetadata(self):
+        if self.exifMetadata == None:
+            import pyexiv2
+            metadata = pyexiv2.ImageMetadata(self.fullPath)
+            metadata.read()
+            self.exifMetadata = metadata
+        return self.exifMetadata
+
+    def readExifFields(self):
+        '''
+        the handful of EXIF values we actually use, in a form that can be cached
+        (see MetadataIndex). Missing or unreadable values are None.
+
+        For ordinary JPEGs these come from the JPEG header alone (see ExifHeader);
+        anything else is read with pyexiv2.
+        '''
+        try:
+            return readJpegHeader(self.fullPath, self.storage).getFields()
+        except ExifHeaderError:
+            pass
+        metadata = self.getExifMetadata()
+        fields = {'datetime': None,
+                  'orientation': None,
+                  'width': None,
+                  'height': None}
+        if EXIF_DATETIME_KEY in metadata.exif_keys:
+            value = metadata[EXIF_DATETIME_KEY].value
+            if isinstance(value, datetime):
+                fields['datetime'] = value
+        if EXIF_ORIENTATION_KEY in metadata.exif_keys:
+            try:
+                fields['orientation'] = int(metadata[EXIF_ORIENTATION_KEY].value)
+            except (TypeError, ValueError):
+                pass
+        (fields['width'], fields['height']) = metadata.dimensions
+        return fields
+
+    def copyExifTo(self, targetFullPath, orientation=None, exif=True):
+        '''
+        copy the metadata (EXIF, IPTC, XMP and the comment) to another file, with its Orientation
+        changed to orientation if given (eg. 1 when the target's pixels have already been turned upright).
+        With exif=False, the target's own EXIF is left alone (eg. when it was written along with the image).
+        '''
+        import pyexiv2
+        mdDest = pyexiv2.ImageMetadata(targetFullPath)
+        mdDest.read()
+        self.getExifMetadata().copy(mdDest, exif=exif)
+        if orientation != None and EXIF_ORIENTATION_KEY in mdDest.exif_keys:
+            mdDest[EXIF_ORIENTATION_KEY] = orientation
+        mdDest.write(preserve_timestamps=True)
+
 class ImageFileInfoTool:
 
-    def __init__(self, out, system):
+    def __init__(self, out, system, metadataIndex=None, stats=NULL_RUN_STATS, storage=LOCAL_STORAGE):
         self.out = out
         self.system = system
+        self.metadataCache = {}
+        self.metadataIndex = metadataIndex
+        self.stats = stats
+        self.storage = storage
+
+    def getMetadata(self, fullPath):
+        '''
+        get the (cached) ImageFileMetadata for a file. Call releaseMetadata() when
+        you're done with the file, so a big run doesn't keep every file's EXIF in memory.
+        '''
+        if fullPath not in self.metadataCache:
+            self.metadataCache[fullPath] = ImageFileMetadata(fullPath, self.storage)
+        return self.metadataCache[fullPath]
+
+    def releaseMetadata(self, fullPath):
+        self.metadataCache.pop(fullPath, None)
+
+    def getExifFields(self, fullPath, statResult=None):
+        '''
+        get the EXIF fields of a file (see ImageFileMetadata.readExifFields()),
+        from the persistent metadata index if there is one and it's up to date.
+        Pass statResult if you already have it, to save a stat() call.
+        '''
+        metadata = self.getMetadata(fullPath)
+        if metadata.exifFields == None:
+            fields = None
+            if self.metadataIndex:
+                fields = self.metadataIndex.get(fullPath, statResult)
+            if fields == None:
+                with self.stats.timer('exif read'):
+                    fields = metadata.readExifFields()
+                if self.metadataIndex:
+                    self.metadataIndex.put(fullPath, fields, statResult)
+            metadata.exifFields = fields
+        return metadata.exifFields
+
+    def fileMoved(self, oldFullPath, newFullPath):
+        self.releaseMetadata(oldFullPath)
+        if self.metadataIndex:
+            self.metadataIndex.move(oldFullPath, newFullPath)
+
+    def getFilenameInfo(self, fullPath):
+        '''
+        like getFileInfoFromFilename(), but the filename is only parsed once per file.
+        Returns a copy, so callers are free to change it.
+        '''
+        metadata = self.getMetadata(fullPath)
+        if metadata.filenameInfo == None:
+            metadata.filenameInfo = self.getFileInfoFromFilename(basename(fullPath))
+        return metadata.filenameInfo.copy()
 
-    def getFileInfo(self, fileNameFullPath, okToUseFileName=False, okToUseFileCreationTime=False):
+    def getFileInfo(self, fileNameFullPath, okToUseFileName=False, okToUseFileCreationTime=False, statResult=None):
         try:
-            fileInfo = self._getFileInfo(fileNameFullPath, okToUseFileName, okToUseFileCreationTime)
+            fileInfo = self._getFileInfo(fileNameFullPath, okToUseFileName, okToUseFileCreationTime, statResult)
         except:
             self.out.put("Error while reading file (do you have file permissions?): %s" % fileNameFullPath, self.out.LOG_LEVEL_VERBOSE)
             return {}
@@ -45,7 +368,7 @@ class ImageFileInfoTool:
             return {}
         return self.normalizeFileInfo(fileInfo)
 
-    def _getFileInfo(self, fileNameFullPath, okToUseFileName, okToUseFileCreationTime):
+    def _getFileInfo(self, fileNameFullPath, okToUseFileName, okToUseFileCreationTime, statResult=None):
         '''
         do the work of getting file information, from EXIF, filename, and file creation time.
         order of priority for each field is EXIF > filename > creation time.
@@ -55,41 +378,62 @@ class ImageFileInfoTool:
             fileInfo.update(self.getFileInfoFromFilesystem(fileNameFullPath))
             self.out.put("- after reading from filesystem: %s" % fileInfo.__str__(), self.out.LOG_LEVEL_VERBOSE)
         if okToUseFileName:
-            fileInfo.update(self.getFileInfoFromFilename(basename(fileNameFullPath)))
+            fileInfo.update(self.getFilenameInfo(fileNameFullPath))
             self.out.put("- after reading from filename: %s" % fileInfo.__str__(), self.out.LOG_LEVEL_VERBOSE)
         if self.isJpg(fileNameFullPath):
             try:
-                fileInfo.update(self.getFileInfoFromExifData(fileNameFullPath))
+                fileInfo.update(self.getFileInfoFromExifData(fileNameFullPath, statResult))
                 self.out.put("- after reading from EXIF: %s" % fileInfo.__str__(), self.out.LOG_LEVEL_VERBOSE)
             except:
                 self.out.put("Error happened while trying to read EXIF tags.", self.out.LOG_LEVEL_VERBOSE)
         return fileInfo
 
     def isImageFilename(self, originalFileName):
-        return re.match(REGEX_IMAGE_FILENAME, originalFileName, re.I)
+        return IMAGE_FILENAME_PATTERN.match(originalFileName)
 
     def isJpg(self, fileName):
-        return (re.match(REGEX_JPG_FILENAME, fileName, re.I) != None)
+        return (JPG_FILENAME_PATTERN.match(fileName) != None)
 
     def getFileInfoFromFilename(self, fileName):
-        result = {}
-        for patternConfig in REGEX_LIST:
-            pattern = patternConfig[0]
-            m = re.match(pattern, fileName)
-            if not m:
-                continue
-            for i in range(1, len(patternConfig)):
-                result[patternConfig[i]] = m.group(i)
-            self.out.put("Returning filename info for %s: %s" % (fileName, result), self.out.LOG_LEVEL_VERBOSE)
-            return result
-        self.out.put("Found no filename pattern match to get file info for %s" % (fileName), self.out.LOG_LEVEL_VERBOSE)
+        result = matchFilename(fileName)
+        if not isLogged(self.out, self.out.LOG_LEVEL_VERBOSE):
+            return result or {}
+        if result == None:
+            self.out.put("Found no filename pattern match to get file info for %s" % (fileName), self.out.LOG_LEVEL_VERBOSE)
+            return {}
+        self.out.put("Returning filename info for %s: %s" % (fileName, result), self.out.LOG_LEVEL_VERBOSE)
         return result
 
-    def getFileInfoFromExifData(self, fullPath):
-        metadata = self.readExifMetadata(fullPath)
-        result = self.getFileInfoFromFilename(basename(fullPath))
+    def classify(self, paths):
+        '''
+        batch version of isImageFilename(), isJpg(), getFileInfoFromFilename() and the
+        "should be renamed" check, for lots of files at once. Returns a list of ImageFileRecord.
+
+        Only a summary is logged, instead of a message per file.
+        '''
+        records = []
+        append = records.append
+        emptyInfo = dict.fromkeys(FILENAME_INFO_FIELDS)
+        for path in paths:
+            fileName = basename(path)
+            info = emptyInfo.copy()
+            matched = matchFilename(fileName)
+            if matched:
+                info.update(matched)
+            title = info['title']
+            append(ImageFileRecord(path=path,
+                                   isImage=IMAGE_FILENAME_PATTERN.match(fileName) != None,
+                                   isJpg=JPG_FILENAME_PATTERN.match(fileName) != None,
+                                   shouldBeRenamed=title != None and FILENAME_SHOULD_BE_CHANGED_PATTERN.search(title) != None,
+                                   **info))
+        self.out.put("Classified %d file names" % len(records), self.out.LOG_LEVEL_VERBOSE)
+        return records
+
+    def getFileInfoFromExifData(self, fullPath, statResult=None):
+        fields = self.getExifFields(fullPath, statResult)
+        result = self.getFilenameInfo(fullPath)
         try:
-            dt = metadata[EXIF_DATETIME_KEY].value
+            dt = fields['datetime']
             result['year'] = str(dt.year)
             result['month'] = str(dt.month)
             result['day'] = str(dt.day)
@@ -100,24 +444,23 @@ class ImageFileInfoTool:
             self.out.put('Unable to get all EXIF information from %s' % basename(fullPath))
         return result
 
-    def copyExifMetadata(self, sourceFullPath, targetFullPath):
-        md = self.readExifMetadata(sourceFullPath)
-        self.writeExifMetadata(targetFullPath, md)
+    def copyExifMetadata(self, sourceFullPath, targetFullPath, orientation=None, exif=True):
+        with self.stats.timer('exif copy'):
+            self.getMetadata(sourceFullPath).copyExifTo(targetFullPath, orientation, exif)
 
     def readExifMetadata(self, fullPath):
-        metadata = pyexiv2.ImageMetadata(fullPath)
-        metadata.read()
-        return metadata
+        return self.getMetadata(fullPath).getExifMetadata()
 
     def writeExifMetadata(self, fullPath, mdSource):
+        import pyexiv2
         mdDest = pyexiv2.ImageMetadata(fullPath)
         mdDest.read()
         mdSource.copy(mdDest)
         mdDest.write(preserve_timestamps=True)
 
     def getFileInfoFromFilesystem(self, fullPath):
-        result = self.getFileInfoFromFilename(basename(fullPath))
-        unixTime = getmtime(fullPath)
+        result = self.getFilenameInfo(fullPath)
+        unixTime = self.storage.getmtime(fullPath)
         dt = datetime.fromtimestamp(unixTime)
         result['year'] = str(dt.year)
         result['month'] = str(dt.month)
@@ -145,8 +488,8 @@ class ImageFileInfoTool:
         
         NOTE: only works in GUI mode (see askUserForNewFileName())
         """
-        fileInfo = self.getFileInfoFromFilename(basename(fullPath))
-        if not re.search(REGEX_FILENAME_SHOULD_BE_CHANGED, fileInfo['title']):
+        fileInfo = self.getFilenameInfo(fullPath)
+        if not FILENAME_SHOULD_BE_CHANGED_PATTERN.search(fileInfo['title']):
             return fullPath
         newFullPath = self.askUserForNewFileName(fullPath)
         if newFullPath == fullPath:
@@ -163,12 +506,11 @@ class ImageFileInfoTool:
         return fullPath
 
     def getImageRotationByExif(self, fullPath):
-        metadata = self.readExifMetadata(fullPath)
         rotationDegrees = {1: 0,
                            3: 180,
                            6:-90,
                            8: 90}
-        key = metadata['Exif.Image.Orientation'].value
+        key = self.getExifFields(fullPath)['orientation']
         if key in rotationDegrees:
             return rotationDegrees[key]
         return 0
@@ -1,10 +1,29 @@
-from os.path import dirname, realpath
+from datetime import datetime
+from os import listdir, makedirs, stat, statvfs, urandom, utime
+from os.path import basename, dirname, exists, islink, realpath
+import shutil
+from struct import pack
+import tempfile
 import unittest
 
+from image_tools.AllStarCopier import AllStarCopier
+from image_tools.EncodingProfiles import encodeToTargetSize, getSaveOptions
+from image_tools.ExifHeader import buildExifBlock, parseExifBlock, readJpegHeader, setOrientation, writeJpegOrientation
+from image_tools.FileLinker import FileLinker, LinkNotSupportedError
+from image_tools.HashIndex import HashIndex
 from image_tools.ImageDateStamper import ImageDateStamper
-from image_tools.ImageScaler import ImageScaler
-from image_tools.ImageToolsShared import ImageFileInfoTool
+from image_tools.ImageInbox import SettleQueue
+from image_tools.ImageScaler import ImageScaler, parseLimitSizes
+from image_tools.ImageToolsBenchmark import makeSyntheticJpeg, makeSyntheticPicture
+from image_tools.ImageToolsShared import XMP_PREFIX, ImageFileInfoTool, hasNonExifMetadata, isLogged, openReducedImage, walkImageFiles
+from image_tools.MetadataIndex import MetadataIndex
+from image_tools.NearDuplicateFinder import computeDHashes, findClusters, hammingDistance
+from image_tools.RenamePlanner import JOURNAL_FILENAME, UNDO_FILENAME, RenamePlanner, planRenames
+from image_tools.RunStats import NULL_RUN_STATS, RunStats
+from image_tools.ScaleManifest import ScaleManifest
+from image_tools.Storage import ConcurrentStorage, MemoryStorage
 from py_base.JobOutput import JobOutput
+from py_base.PySystem import PySystem
 from py_base.PySystemMock import PySystemMock
 
 class ImageToolsTest(unittest.TestCase):
@@ -18,6 +37,7 @@ class ImageToolsTest(unittest.TestCase):
     def setUp(self):
         self.out = JobOutput()
         self.out.disableLogFile()
+        self.out.logLevel = self.out.LOG_LEVEL_DEBUG
         self.sys = PySystemMock(self.out)
         self.dateStamper = ImageDateStamper(self.out, self.sys)
         self.testDir = '%s/test' % realpath(dirname(__file__))
@@ -39,6 +59,112 @@ class ImageToolsTest(unittest.TestCase):
         self.assertEqual(self.infoGrabber.getFileInfoFromFilename('2011.02_12.11.33   The title of the Picture.Jpg'), expectedResult)
         self.assertEqual(self.infoGrabber.getFileInfoFromFilename('2011 02 12 11:33  The title of the Picture.Jpg'), expectedResult)
 
+    def testGetFileInfoFromFilenameSkipsLoggingBelowVerbose(self):
+        puts = []
+        self.out.put = lambda *args: puts.append(args)
+        self.out.logLevel = self.out.LOG_LEVEL_INFO
+        self.assertEqual(self.infoGrabber.getFileInfoFromFilename('2011-02-12 The title of the Picture.Jpg')['day'], '12')
+        self.assertEqual(self.infoGrabber.getFileInfoFromFilename('no extension'), {})
+        self.assertEqual(puts, [])
+        self.out.logLevel = self.out.LOG_LEVEL_VERBOSE
+        self.infoGrabber.getFileInfoFromFilename('no extension')
+        self.assertEqual(len(puts), 1)
+        # an output that doesn't say what it shows is a mistake, not a reason to format everything
+        self.assertRaises(AttributeError, isLogged, object(), self.out.LOG_LEVEL_VERBOSE)
+
+    def testGetFilenameInfoIsCachedPerFile(self):
+        fullPath = '/some/folder/2011-02-12 The title of the Picture.Jpg'
+        fileInfo = self.infoGrabber.getFilenameInfo(fullPath)
+        self.assertEqual(fileInfo['title'], 'The title of the Picture')
+        fileInfo['title'] = 'changed by the caller'
+        self.assertEqual(self.infoGrabber.getFilenameInfo(fullPath)['title'], 'The title of the Picture')
+        self.assertEqual(self.infoGrabber.metadataCache.keys(), [fullPath])
+        self.infoGrabber.releaseMetadata(fullPath)
+        self.assertEqual(self.infoGrabber.metadataCache, {})
+
+    def testParseExifBlock(self):
+        for endian in ['<', '>']:
+            header = parseExifBlock(buildExifBlock(datetime(2011, 2, 12, 11, 33, 5), 6, endian))
+            self.assertEqual(header.dateTimeOriginal, datetime(2011, 2, 12, 11, 33, 5))
+            self.assertEqual(header.orientation, 6)
+        header = parseExifBlock(buildExifBlock())
+        self.assertEqual((header.dateTimeOriginal, header.orientation), (None, None))
+
+    def testSetOrientation(self):
+        block = buildExifBlock(datetime(2011, 2, 12, 14, 30, 5), orientation=6, endian='>')
+        header = parseExifBlock(setOrientation(block, 1))
+        self.assertEqual(header.orientation, 1)
+        self.assertEqual(header.dateTimeOriginal, datetime(2011, 2, 12, 14, 30, 5))
+        tempDir = tempfile.mkdtemp()
+        try:
+            # just enough of a JPEG for readJpegHeader(): SOI, APP1, SOF0
+            fullPath = '%s/rotated.jpg' % tempDir
+            open(fullPath, 'wb').write('\xff\xd8\xff\xe1' + pack('>H', len(block) + 2) + block +
+                                       '\xff\xc0' + pack('>HBHHB', 11, 8, 30, 40, 1) + '\x01\x11\x00')
+            self.assertTrue(writeJpegOrientation(fullPath, 1))
+            header = readJpegHeader(fullPath)
+            self.assertEqual((header.orientation, header.width, header.height), (1, 40, 30))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testMetadataIndex(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            fullPath = '%s/photo.jpg' % tempDir
+            open(fullPath, 'w').write('not really a jpeg')
+            fields = {'datetime': datetime(2011, 2, 12, 11, 33), 'orientation': 6, 'width': 4000, 'height': 3000}
+            index = MetadataIndex(self.out, '%s/cache/metadata.sqlite' % tempDir, maxEntries=1)
+            self.assertEqual(index.get(fullPath), None)
+            index.put(fullPath, fields)
+            self.assertEqual(index.get(fullPath), fields)
+            # a changed file is a miss
+            utime(fullPath, (0, 0))
+            self.assertEqual(index.get(fullPath), None)
+            self.assertEqual((index.hits, index.misses), (1, 2))
+            index.put(fullPath, fields)
+            otherFullPath = '%s/other.jpg' % tempDir
+            open(otherFullPath, 'w').write('not a jpeg either')
+            index.put(otherFullPath, fields)
+            index.close()
+            # only the most recently used entry survives the size cap
+            index = MetadataIndex(self.out, '%s/cache/metadata.sqlite' % tempDir)
+            self.assertEqual(index.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0], 1)
+            index.close()
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testClassify(self):
+        records = self.infoGrabber.classify(['/photos/2011-02-12 11:33 The title of the Picture.Jpg',
+                                             '/photos/IMG_12345.JPG',
+                                             '/photos/notes.txt'])
+        self.assertEqual([r.isImage for r in records], [True, True, False])
+        self.assertEqual([r.isJpg for r in records], [True, True, False])
+        self.assertEqual([r.shouldBeRenamed for r in records], [False, True, False])
+        self.assertEqual((records[0].year, records[0].minute, records[0].title), ('2011', '33', 'The title of the Picture'))
+        self.assertEqual((records[1].year, records[1].title), (None, 'IMG_12345'))
+        # the same answers as the one-at-a-time methods
+        for record in records:
+            fileInfo = self.infoGrabber.getFileInfoFromFilename(record.path.split('/')[-1])
+            for (field, value) in fileInfo.items():
+                self.assertEqual(getattr(record, field), value)
+
+    def testRunStats(self):
+        stats = RunStats()
+        with stats.timer('decode'):
+            stats.count('files')
+        workerStats = RunStats()
+        workerStats.addTime('decode', 2.0)
+        workerStats.count('files', 2)
+        stats.merge(workerStats.asDict())
+        summary = stats.getSummary('scale-image')
+        self.assertEqual(summary['phases']['decode']['calls'], 2)
+        self.assertTrue(summary['phases']['decode']['seconds'] >= 2.0)
+        self.assertEqual(summary['counters'], {'files': 3})
+        # the null version keeps nothing
+        with NULL_RUN_STATS.timer('decode'):
+            NULL_RUN_STATS.count('files')
+        self.assertEqual(NULL_RUN_STATS.asDict(), None)
+
     def testGetTargetFileName(self):
         # very brief. Partly we're testing that Jpg is not converted to jpg; otherwise, very stupid test.
         fileInfo = {'year':'11', 'month':'2', 'day':'12', 'hour':'11', 'minute':'33', 'title':'The title of the Picture', 'extension':'Jpg'}
@@ -49,18 +175,299 @@ class ImageToolsTest(unittest.TestCase):
         self.dateStamper.arguments['time'] = True
         self.assertEqual(self.dateStamper.getTargetFileName(fileInfo), '2011-02-12 11.33 The title of the Picture.Jpg')
 
-    def testGetFileNamesToStamp(self):
-        fileNames = ['2011-07-30 P0002394.JPG',
-                     'ImageDateStamperTest.pyc',
-                     'Named image file.JPG',
-                     'Non Image File.txt']
-        self.assertEqual(self.dateStamper.getFileNamesToStamp(), fileNames)
+    def testGetRenditions(self):
+        self.scaler.arguments['limit_size'] = parseLimitSizes('400, 1200g,2048,1200')
+        self.assertEqual(self.scaler.getRenditions(), [(2048, False, '.scaled-2048'),
+                                                       (1200, False, '.scaled-1200'),
+                                                       (1200, True, '.scaled-1200g'),
+                                                       (400, False, '.scaled-400')])
+        # a single size keeps the plain .scaled name
+        self.scaler.arguments['limit_size'] = 800
+        self.scaler.arguments['greyscale'] = True
+        self.assertEqual(self.scaler.getRenditions(), [(800, True, '.scaled')])
+        self.assertEqual(self.scaler.getTargetFileName('/photos/IMG_1.JPG', '.scaled-400'), '/photos/IMG_1.scaled-400.jpg')
+
+    def testEncodingProfiles(self):
+        self.scaler.arguments['format'] = 'webp'
+        self.assertEqual(self.scaler.getTargetFileName('/a/IMG_1.JPG', '.scaled-400'), '/a/IMG_1.scaled-400.webp')
+        image = makeSyntheticPicture((800, 600))
+        saveOptions = getSaveOptions('web', 'JPEG')
+        (data, quality, proxyEncodes) = encodeToTargetSize(image, 'JPEG', saveOptions, 40 * 1024)
+        self.assertTrue(len(data) <= 40 * 1024)
+        self.assertTrue(quality <= saveOptions['quality'])
+
+    def testScaleManifest(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            sourceFullPath = '%s/IMG_1.JPG' % tempDir
+            targetFullPath = '%s/IMG_1.scaled.jpg' % tempDir
+            for fullPath in [sourceFullPath, targetFullPath]:
+                open(fullPath, 'w').write('not really a jpeg')
+            parameters = {'renditions': [[1200, False, '.scaled']]}
+            scaleManifest = ScaleManifest(tempDir)
+            self.assertFalse(scaleManifest.isCurrent(sourceFullPath, parameters, [targetFullPath]))
+            scaleManifest.record(sourceFullPath, parameters)
+            scaleManifest.save()
+            scaleManifest = ScaleManifest(tempDir)
+            self.assertTrue(scaleManifest.isCurrent(sourceFullPath, parameters, [targetFullPath]))
+            self.assertFalse(scaleManifest.isCurrent(sourceFullPath, {'renditions': [[800, False, '.scaled']]}, [targetFullPath]))
+            utime(sourceFullPath, (0, 0))
+            self.assertFalse(scaleManifest.isCurrent(sourceFullPath, parameters, [targetFullPath]))
+
+            # the scaled file itself is never a source
+            self.scaler.arguments.update({'limit_size': 1200, 'greyscale': False})
+            self.scaler.scaleManifests = {}
+            self.assertEqual(self.scaler.getFilenamesToRebuild([sourceFullPath, targetFullPath]), [sourceFullPath])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testFilesToStamp(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            makedirs('%s/sub' % tempDir)
+            for fileName in ['Named image file.JPG', '2011-07-30 P0002394.JPG', 'Non Image File.txt', 'sub/IMG_1234.JPG']:
+                open('%s/%s' % (tempDir, fileName), 'w').close()
+            stamped = []
+            self.dateStamper.stampFile = lambda fullPath, statResult=None: stamped.append(basename(fullPath))
+            # explicit files first (images only), then the images in directories. Each file is stamped
+            # once, even if it's given as well as its directory.
+            self.dateStamper.arguments['path'] = [tempDir, '%s/Non Image File.txt' % tempDir, '%s/Named image file.JPG' % tempDir,
+                                                  '%s/sub/IMG_1234.JPG' % tempDir]
+            self.dateStamper.arguments['recursive'] = False
+            self.dateStamper.stamp()
+            self.assertEqual(stamped, ['IMG_1234.JPG', '2011-07-30 P0002394.JPG', 'Named image file.JPG'])
+            # with --recursive, the walk gets to the file in the subdirectory too
+            del stamped[:]
+            self.dateStamper.arguments['recursive'] = True
+            self.dateStamper.stamp()
+            self.assertEqual(stamped, ['2011-07-30 P0002394.JPG', 'Named image file.JPG', 'IMG_1234.JPG'])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testPlanRenames(self):
+        wantedNames = {'IMG_1.JPG': '2011-02-12 Beach.JPG',
+                       'IMG_2.JPG': '2011-02-12 Beach.JPG',
+                       'a.jpg': 'b.jpg',
+                       'b.jpg': 'a.jpg',
+                       'same.jpg': 'same.jpg'}
+        existingNames = wantedNames.keys() + ['2011-02-12 Beach (2).JPG']
+        self.assertEqual(planRenames(wantedNames, existingNames),
+                         [('IMG_1.JPG', '2011-02-12 Beach.JPG'),
+                          ('IMG_2.JPG', '2011-02-12 Beach (3).JPG'),
+                          # a swap goes through a temporary name
+                          ('a.jpg', '.image-tools-rename-1.tmp'),
+                          ('b.jpg', 'a.jpg'),
+                          ('.image-tools-rename-1.tmp', 'b.jpg')])
+
+    def testRenameJournal(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            for name in ['a.jpg', 'b.jpg']:
+                open('%s/%s' % (tempDir, name), 'w').write(name)
+            readAll = lambda: [open('%s/%s' % (tempDir, name)).read() for name in ['a.jpg', 'b.jpg']]
+            # mock mode leaves no trace at all
+            RenamePlanner(self.out, self.sys, True).renameAll(tempDir, {'a.jpg': 'b.jpg', 'b.jpg': 'a.jpg'})
+            self.assertEqual(sorted(listdir(tempDir)), ['a.jpg', 'b.jpg'])
+            renamePlanner = RenamePlanner(self.out, PySystem(self.out))
+            renamePlanner.renameAll(tempDir, {'a.jpg': 'b.jpg', 'b.jpg': 'a.jpg'})
+            self.assertEqual(readAll(), ['b.jpg', 'a.jpg'])
+            self.assertFalse(exists('%s/%s' % (tempDir, JOURNAL_FILENAME)))
+            renamePlanner.undo(tempDir)
+            self.assertEqual(readAll(), ['a.jpg', 'b.jpg'])
+            self.assertFalse(exists('%s/%s' % (tempDir, UNDO_FILENAME)))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testSettleQueue(self):
+        queue = SettleQueue(settleSeconds=2, maxBatchSize=3, maxWaitSeconds=30)
+        self.assertEqual(queue.getTimeout(0), None)
+        queue.add('a.jpg', 0)
+        queue.add('b.jpg', 1)
+        queue.add('a.jpg', 1.5)  # written again, so it settles later
+        self.assertEqual(queue.getTimeout(1.5), 2)
+        self.assertEqual(queue.popSettled(3), [])
+        self.assertEqual(queue.popSettled(3.5), ['a.jpg', 'b.jpg'])
+        # while a copy is still going on, only full batches go out
+        for i in range(5):
+            queue.add('%d.jpg' % i, 10 + i)
+        self.assertEqual(queue.popSettled(14), ['0.jpg', '1.jpg', '2.jpg'])
+        self.assertEqual(queue.popSettled(14.5), [])
+        self.assertEqual(queue.popSettled(16), ['3.jpg', '4.jpg'])
+
+    def testWalkImageFiles(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            for path in ['b/c', 'a']:
+                makedirs('%s/%s' % (tempDir, path))
+            for path in ['z.JPG', 'notes.txt', 'b/1.png', 'b/c/2.jpg', 'a/3.gif']:
+                open('%s/%s' % (tempDir, path), 'w').close()
+            walked = [fullPath[len(tempDir) + 1:] for (fullPath, statResult) in walkImageFiles(tempDir)]
+            self.assertEqual(walked, ['z.JPG'])
+            walked = [fullPath[len(tempDir) + 1:] for (fullPath, statResult) in walkImageFiles(tempDir, recursive=True)]
+            self.assertEqual(walked, ['z.JPG', 'a/3.gif', 'b/1.png', 'b/c/2.jpg'])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testResolveAllStarsFullPaths(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            makedirs('%s/All Stars' % tempDir)
+            makedirs('%s/event/day 1' % tempDir)
+            open('%s/event/allstars' % tempDir, 'w').close()  # not a directory, so it doesn't count
+            copier = AllStarCopier(self.out, self.sys)
+            self.assertEqual(copier.resolveAllStarsFullPaths('%s/event/day 1' % tempDir), ['%s/All Stars' % tempDir])
+            # every directory on the way up is remembered
+            self.assertEqual(copier.resolvedAllStarsFullPaths['%s/event' % tempDir], ['%s/All Stars' % tempDir])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testHashIndex(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            makedirs('%s/AllStars' % tempDir)
+            for (name, content) in [('AllStars/a.jpg', 'same'), ('AllStars/b.jpg', 'diff'), ('AllStars/c.jpg', 'same'),
+                                    ('AllStars/d.jpg', 'longer'), ('source.jpg', 'diff')]:
+                open('%s/%s' % (tempDir, name), 'w').write(content)
+            hashIndex = HashIndex('%s/AllStars' % tempDir)
+            self.assertEqual(hashIndex.getDuplicateGroups(), [['a.jpg', 'c.jpg']])
+            self.assertEqual(hashIndex.findDuplicate('%s/source.jpg' % tempDir)[0], 'b.jpg')
+            hashIndex.save()
+            # the saved hashes are used as long as the files don't change
+            self.assertEqual(HashIndex('%s/AllStars' % tempDir).hashes, hashIndex.hashes)
+            # a folder that isn't there yet is empty
+            self.assertEqual(HashIndex('%s/NotYet' % tempDir).files, {})
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testStorage(self):
+        memoryStorage = MemoryStorage()
+        for path in ['z.JPG', 'notes.txt', 'b/1.png', 'b/c/2.jpg', 'a/3.gif', 'AllStars/a.jpg']:
+            memoryStorage.putFile('/photos/%s' % path, 'same')
+        concurrentStorage = ConcurrentStorage(memoryStorage, 4)
+        try:
+            # the same walk, one operation at a time or many at once
+            for storage in [memoryStorage, concurrentStorage]:
+                walked = [fullPath for (fullPath, statResult) in walkImageFiles('/photos', True, storage=storage)]
+                self.assertEqual(walked, ['/photos/z.JPG', '/photos/AllStars/a.jpg', '/photos/a/3.gif', '/photos/b/1.png', '/photos/b/c/2.jpg'])
+            errors = concurrentStorage.copyMany([('/photos/z.JPG', '/photos/AllStars/z.JPG'), ('/photos/gone.jpg', '/photos/AllStars/gone.jpg')])
+            self.assertEqual(errors[0], None)
+            self.assertNotEqual(errors[1], None)
+            hashIndex = HashIndex('/photos/AllStars', storage=concurrentStorage)
+            self.assertEqual(hashIndex.getDuplicateGroups(), [['a.jpg', 'z.JPG']])
+        finally:
+            concurrentStorage.close()
+
+    def testFindClusters(self):
+        hashes = {'a.jpg': 0x0f0f0f0f0f0f0f0f,
+                  'b.jpg': 0x0f0f0f0f0f0f0f0e,  # 1 bit from a
+                  'c.jpg': 0x0f0f0f0f0f0f00fe,  # 8 bits from b, 9 from a
+                  'd.jpg': 0xf0f0f0f0f0f0f0f0,
+                  'e.jpg': 0xf0f0f0f0f0f0f0f0}
+        self.assertEqual(findClusters(hashes, 8), [['a.jpg', 'b.jpg', 'c.jpg'], ['d.jpg', 'e.jpg']])
+        self.assertEqual(findClusters(hashes, 0), [['d.jpg', 'e.jpg']])
+
+    def testComputeDHashesTurnsImagesUpright(self):
+        from PIL import Image
+        tempDir = tempfile.mkdtemp()
+        try:
+            picture = makeSyntheticPicture((256, 192))
+            picture.save('%s/upright.jpg' % tempDir, 'JPEG', quality=90)
+            # the same picture as a camera held sideways stores it: on its side, with orientation 6
+            picture.transpose(Image.ROTATE_90).save('%s/sideways.jpg' % tempDir, 'JPEG', quality=90,
+                                                    exif=buildExifBlock(orientation=6))
+            (upright, sideways) = computeDHashes(['%s/upright.jpg' % tempDir, '%s/sideways.jpg' % tempDir])
+            self.assertTrue(hammingDistance(upright, sideways) <= 4)
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testFileLinkerBytesWritten(self):
+        # /dev/shm is a tmpfs, so the free space there is only what's in memory
+        if exists('/dev/shm'):
+            tempDir = tempfile.mkdtemp(dir='/dev/shm')
+        else:
+            tempDir = tempfile.mkdtemp()
+        try:
+            sourceFullPath = '%s/source.jpg' % tempDir
+            sourceSize = 4 * 1024 * 1024
+            open(sourceFullPath, 'wb').write(urandom(sourceSize))
+            linker = FileLinker(self.out, self.sys)
+            for mode in ['hardlink', 'symlink', 'reflink', 'auto']:
+                targetFullPath = '%s/%s.jpg' % (tempDir, mode)
+                before = statvfs(tempDir)
+                try:
+                    method = linker.link(sourceFullPath, targetFullPath, mode)
+                except LinkNotSupportedError:
+                    self.out.put("%s: not supported on this filesystem" % mode)
+                    continue
+                after = statvfs(tempDir)
+                bytesWritten = (before.f_bfree - after.f_bfree) * before.f_frsize
+                self.out.put("%s (%s): %d bytes written for a %d byte file" % (mode, method, bytesWritten, sourceSize))
+                if method == 'copy':
+                    # the mock system doesn't really copy
+                    continue
+                self.assertEqual(open(targetFullPath, 'rb').read(), open(sourceFullPath, 'rb').read())
+                if mode in ['hardlink', 'symlink', 'reflink']:
+                    self.assertTrue(bytesWritten < sourceSize)
+            self.assertEqual(stat('%s/hardlink.jpg' % tempDir).st_ino, stat(sourceFullPath).st_ino)
+            self.assertTrue(islink('%s/symlink.jpg' % tempDir))
+        finally:
+            shutil.rmtree(tempDir)
 
     def testGetFileInfo(self):
-        self.assertEqual([], self.infoGrabber.getFileInfo('%s/Named image file.JPG' % self.testDir))
+        tempDir = tempfile.mkdtemp()
+        try:
+            fullPath = '%s/Named image file.JPG' % tempDir
+            makeSyntheticJpeg(fullPath, (64, 48), dateTimeOriginal=datetime(2011, 2, 12, 11, 33, 5))
+            fileInfo = self.infoGrabber.getFileInfo(fullPath)
+            self.assertEqual([fileInfo[field] for field in ['year', 'month', 'day', 'hour', 'minute', 'title']],
+                             ['2011', '02', '12', '11', '33', 'Named image file'])
+            # nothing to read at all
+            self.assertEqual(self.infoGrabber.getFileInfo('%s/missing.JPG' % tempDir), {})
+        finally:
+            shutil.rmtree(tempDir)
 
     def testScaleImage(self):
-        self.scaler.scaleImageFile('/home/luke/Public/AllStarTest/2011.07.25 picture folder name with spaces/subfolder/P1040425.JPG')
+        tempDir = tempfile.mkdtemp()
+        try:
+            sourceFullPath = '%s/P1040425.JPG' % tempDir
+            makeSyntheticJpeg(sourceFullPath, (600, 300))
+            image = self.scaler.processImage(openReducedImage(sourceFullPath, 100), '%s/P1040425.scaled.jpg' % tempDir,
+                                             limitSize=100, greyscale=True)
+            self.assertEqual(image.size, (100, 50))
+            # (mock mode, so nothing is written)
+            self.assertFalse(exists('%s/P1040425.scaled.jpg' % tempDir))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testScalingKeepsXmp(self):
+        from PIL import Image
+        tempDir = tempfile.mkdtemp()
+        try:
+            sourceFullPath = '%s/P1040425.JPG' % tempDir
+            makeSyntheticJpeg(sourceFullPath, (600, 300), dateTimeOriginal=datetime(2011, 2, 12, 11, 33, 5))
+            self.assertFalse(hasNonExifMetadata(Image.open(sourceFullPath)))
+            # a keyword, as photo managers write it
+            xmp = (XMP_PREFIX + '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+                   '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                   '<dc:subject><rdf:Bag><rdf:li>beach</rdf:li></rdf:Bag></dc:subject>'
+                   '</rdf:Description></rdf:RDF></x:xmpmeta>')
+            data = open(sourceFullPath, 'rb').read()
+            open(sourceFullPath, 'wb').write(data[:2] + '\xff\xe1' + pack('>H', len(xmp) + 2) + xmp + data[2:])
+            self.assertTrue(hasNonExifMetadata(Image.open(sourceFullPath)))
+            scaler = ImageScaler(self.out, PySystem(self.out))
+            scaler.imageTool = ImageFileInfoTool(self.out, scaler.system)
+            try:
+                scaler.imageTool.readExifMetadata(sourceFullPath)
+            except Exception:
+                self.skipTest("pyexiv2 can't read JPEGs here")
+            scaler.arguments['limit_size'] = 100
+            scaler.processImageFile(sourceFullPath)
+            targetFullPath = scaler.getTargetFileName(sourceFullPath)
+            self.assertTrue('<rdf:li>beach</rdf:li>' in open(targetFullPath, 'rb').read())
+            # and the EXIF written while saving is still there
+            self.assertEqual(readJpegHeader(targetFullPath).dateTimeOriginal, datetime(2011, 2, 12, 11, 33, 5))
+        finally:
+            shutil.rmtree(tempDir)
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,145 @@
+from datetime import datetime
+from os import makedirs
+from os.path import dirname, exists, expanduser
+import sqlite3
+import time
+
+from image_tools.Storage import LOCAL_STORAGE
+
+
+DEFAULT_INDEX_PATH = '~/.cache/image-tools/metadata.sqlite'
+DEFAULT_MAX_ENTRIES = 250000
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def addMetadataIndexArgument(parser):
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        default=False,
+                        help="Don't use the metadata cache in %s; always read EXIF from the files" % DEFAULT_INDEX_PATH,
+                        )
+
+def openMetadataIndex(out, arguments, storage=LOCAL_STORAGE):
+    '''
+    open the metadata index for a job, unless --no-cache was given.
+    Returns None if the index is disabled or can't be opened (that's not fatal; it's only a cache).
+    '''
+    if arguments.get('no_cache'):
+        return None
+    try:
+        return MetadataIndex(out, storage=storage)
+    except (IOError, OSError, sqlite3.Error), e:
+        out.put("Not using the metadata cache, because it couldn't be opened: %s" % e, out.LOG_LEVEL_WARN)
+        return None
+
+class MetadataIndex:
+    '''
+    Persistent cache of the EXIF fields we care about (see ImageFileMetadata.readExifFields()),
+    keyed by path, and only valid while the file's size and mtime are unchanged.
+    This lets repeat runs over a big archive skip EXIF parsing for files that haven't changed.
+    The perceptual hashes of NearDuplicateFinder are kept the same way, in their own table.
+
+    The least recently used entries are dropped on close() once there are more than maxEntries.
+    '''
+
+    def __init__(self, out, indexPath=DEFAULT_INDEX_PATH, maxEntries=DEFAULT_MAX_ENTRIES, storage=LOCAL_STORAGE):
+        self.out = out
+        self.storage = storage  # where the images are (the index itself is always a local file)
+        self.indexPath = expanduser(indexPath)
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        if not exists(dirname(self.indexPath)):
+            makedirs(dirname(self.indexPath))
+        self.connection = sqlite3.connect(self.indexPath)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                                       path TEXT PRIMARY KEY,
+                                       size INTEGER,
+                                       mtime_ns INTEGER,
+                                       exif_datetime TEXT,
+                                       orientation INTEGER,
+                                       width INTEGER,
+                                       height INTEGER,
+                                       last_used REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS dhash (
+                                       path TEXT PRIMARY KEY,
+                                       size INTEGER,
+                                       mtime_ns INTEGER,
+                                       dhash TEXT,
+                                       last_used REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS dhash_last_used ON dhash (last_used)')
+
+    def getStatKey(self, fullPath, statResult=None):
+        if statResult == None:
+            statResult = self.storage.stat(fullPath)
+        mtimeNs = getattr(statResult, 'st_mtime_ns', None)
+        if mtimeNs == None:
+            mtimeNs = int(statResult.st_mtime * 1000000000)
+        return (statResult.st_size, mtimeNs)
+
+    def get(self, fullPath, statResult=None):
+        '''
+        return the cached EXIF fields for fullPath, or None if they're missing or out of date
+        '''
+        (size, mtimeNs) = self.getStatKey(fullPath, statResult)
+        row = self.connection.execute('SELECT size, mtime_ns, exif_datetime, orientation, width, height FROM metadata WHERE path = ?',
+                                      (fullPath,)).fetchone()
+        if row == None or row[0] != size or row[1] != mtimeNs:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute('UPDATE metadata SET last_used = ? WHERE path = ?', (time.time(), fullPath))
+        exifDateTime = None
+        if row[2] != None:
+            exifDateTime = datetime.strptime(row[2], DATETIME_FORMAT)
+        return {'datetime': exifDateTime,
+                'orientation': row[3],
+                'width': row[4],
+                'height': row[5]}
+
+    def put(self, fullPath, fields, statResult=None):
+        (size, mtimeNs) = self.getStatKey(fullPath, statResult)
+        exifDateTime = None
+        if fields['datetime'] != None:
+            exifDateTime = fields['datetime'].strftime(DATETIME_FORMAT)
+        self.connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (fullPath, size, mtimeNs, exifDateTime, fields['orientation'],
+                                 fields['width'], fields['height'], time.time()))
+
+    def getDHash(self, fullPath, statResult=None):
+        '''
+        return the cached difference hash (an int) for fullPath, or None if it's missing or out of date
+        '''
+        (size, mtimeNs) = self.getStatKey(fullPath, statResult)
+        row = self.connection.execute('SELECT size, mtime_ns, dhash FROM dhash WHERE path = ?', (fullPath,)).fetchone()
+        if row == None or row[0] != size or row[1] != mtimeNs:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute('UPDATE dhash SET last_used = ? WHERE path = ?', (time.time(), fullPath))
+        return int(row[2], 16)
+
+    def putDHash(self, fullPath, dhash, statResult=None):
+        # (as hex, because sqlite integers are signed 64 bit)
+        (size, mtimeNs) = self.getStatKey(fullPath, statResult)
+        self.connection.execute('INSERT OR REPLACE INTO dhash VALUES (?, ?, ?, ?, ?)',
+                                (fullPath, size, mtimeNs, '%016x' % dhash, time.time()))
+
+    def move(self, oldFullPath, newFullPath):
+        '''
+        keep the entries when a file is renamed (renaming doesn't change the size or mtime)
+        '''
+        for table in ['metadata', 'dhash']:
+            self.connection.execute('DELETE FROM %s WHERE path = ?' % table, (newFullPath,))
+            self.connection.execute('UPDATE %s SET path = ? WHERE path = ?' % table, (newFullPath, oldFullPath))
+
+    def getStatsMessage(self):
+        return "Metadata cache: %d hits, %d misses (%s)" % (self.hits, self.misses, self.indexPath)
+
+    def close(self):
+        for table in ['metadata', 'dhash']:
+            self.connection.execute('''DELETE FROM %s WHERE path IN
+                                           (SELECT path FROM %s ORDER BY last_used DESC LIMIT -1 OFFSET ?)''' % (table, table),
+                                    (self.maxEntries,))
+        self.connection.commit()
+        self.connection.close()
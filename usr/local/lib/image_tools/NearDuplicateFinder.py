@@ -0,0 +1,267 @@
+#!/usr/bin/python
+from multiprocessing import Pool, cpu_count
+
+from image_tools.ImageToolsShared import ORIENTATION_TRANSPOSES, ImageFileInfoTool, getImageOrientation, getTestFilePaths, \
+    openReducedImage, walkImageFiles
+from image_tools.MetadataIndex import addMetadataIndexArgument, openMetadataIndex
+from image_tools.RunStats import NULL_RUN_STATS, addRunStatsArguments, openRunStats, runProfiled, writeRunStats
+from image_tools.Storage import LOCAL_STORAGE, addStorageArguments, openStorage
+from py_base.Job import Job
+
+
+DHASH_SIZE = 8  # the hash has DHASH_SIZE x DHASH_SIZE bits
+CHUNK_COUNT = 4  # for MultiIndexHashTable
+CHUNK_BITS = DHASH_SIZE * DHASH_SIZE / CHUNK_COUNT
+DEFAULT_MAX_DISTANCE = 8
+HASH_BATCH_SIZE = 64
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+def computeDHashes(fullPaths, storage=LOCAL_STORAGE):
+    '''
+    the difference hash of each image, or None for images that can't be read.
+
+    Each image is decoded at the smallest size the decoder can do (1/8 for JPEGs, see
+    openReducedImage()), turned upright as its EXIF orientation says, and shrunk to
+    (DHASH_SIZE + 1) x DHASH_SIZE greyscale pixels.
+    Each bit says whether a pixel is brighter than the one to its left, so the hash survives
+    scaling, recompression and small edits, and similar images have hashes that differ in few bits.
+    '''
+    from PIL import Image  # (imported here to keep startup fast)
+    images = []
+    for fullPath in fullPaths:
+        try:
+            image = openReducedImage(fullPath, DHASH_SIZE + 1, greyscale=True, storage=storage)
+            # (so a rotated copy of a picture hashes the same as the original)
+            for method in ORIENTATION_TRANSPOSES.get(getImageOrientation(image), []):
+                image = image.transpose(getattr(Image, method))
+            images.append(image.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.ANTIALIAS))
+        except Exception:
+            images.append(None)
+    decoded = [image for image in images if image != None]
+    if not decoded:
+        return [None] * len(images)
+    hashes = iter(hashPixels(decoded))
+    result = []
+    for image in images:
+        if image == None:
+            result.append(None)
+        else:
+            result.append(hashes.next())
+    return result
+
+def hashPixels(images):
+    '''
+    the difference hashes of (DHASH_SIZE + 1) x DHASH_SIZE greyscale images, all at once with
+    numpy if it's installed
+    '''
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy == None:
+        hashes = []
+        for image in images:
+            pixels = list(image.getdata())
+            value = 0
+            for row in range(DHASH_SIZE):
+                for column in range(DHASH_SIZE):
+                    offset = row * (DHASH_SIZE + 1) + column
+                    value = (value << 1) | (pixels[offset + 1] > pixels[offset])
+            hashes.append(value)
+        return hashes
+    pixels = numpy.array([numpy.asarray(image, dtype=numpy.int16) for image in images])
+    bits = (pixels[:, :, 1:] > pixels[:, :, :-1]).reshape(len(images), DHASH_SIZE * DHASH_SIZE)
+    # packbits puts the first bit in the highest place, the same as the loop above
+    return [int(value) for value in numpy.packbits(bits, axis=1).view('>u8').ravel()]
+
+class MultiIndexHashTable:
+    '''
+    Finds the hashes within maxDistance bits of a hash, without comparing it to every hash.
+
+    This is multi-index hashing: each hash is split into CHUNK_COUNT chunks, and each chunk position
+    has its own table. If two hashes differ in at most maxDistance bits, then at least one of their
+    chunks differs in at most maxDistance / CHUNK_COUNT bits, so a search only has to look in the
+    buckets for the chunk values that close to the hash's own chunks. (A BK-tree is simpler, but
+    with 64 bit hashes and a distance of 8 it ends up visiting most of the tree.)
+    '''
+
+    def __init__(self, maxDistance):
+        self.maxDistance = maxDistance
+        self.tables = [{} for i in range(CHUNK_COUNT)]
+        chunkDistance = maxDistance / CHUNK_COUNT
+        # every chunk value within chunkDistance of 0; xor with a chunk value to get the ones near it
+        self.chunkMasks = [mask for mask in range(1 << CHUNK_BITS) if bin(mask).count('1') <= chunkDistance]
+
+    def getChunks(self, value):
+        return [(value >> (CHUNK_BITS * i)) & ((1 << CHUNK_BITS) - 1) for i in range(CHUNK_COUNT)]
+
+    def add(self, value, item):
+        for (table, chunk) in zip(self.tables, self.getChunks(value)):
+            table.setdefault(chunk, []).append((value, item))
+
+    def search(self, value):
+        '''
+        returns [(distance, item)] for the items within maxDistance of value
+        '''
+        candidates = set()
+        for (table, chunk) in zip(self.tables, self.getChunks(value)):
+            for mask in self.chunkMasks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        results = []
+        for (candidateValue, item) in candidates:
+            distance = hammingDistance(value, candidateValue)
+            if distance <= self.maxDistance:
+                results.append((distance, item))
+        return results
+
+def findClusters(hashes, maxDistance):
+    '''
+    group {item: hash} into clusters, where each item is within maxDistance of at least one other
+    item in its cluster. Returns the clusters of two or more, each sorted, in order of their first item.
+    '''
+    parents = {}
+
+    def findRoot(item):
+        root = item
+        while parents[root] != root:
+            root = parents[root]
+        while parents[item] != root:
+            (parents[item], item) = (root, parents[item])
+        return root
+
+    table = MultiIndexHashTable(maxDistance)
+    for item in sorted(hashes.keys()):
+        parents[item] = item
+        for (distance, other) in table.search(hashes[item]):
+            parents[findRoot(other)] = findRoot(item)
+        table.add(hashes[item], item)
+
+    clusters = {}
+    for item in parents:
+        clusters.setdefault(findRoot(item), []).append(item)
+    return sorted([sorted(cluster) for cluster in clusters.values() if len(cluster) > 1])
+
+class NearDuplicateFinder(Job):
+    stats = NULL_RUN_STATS
+    storage = LOCAL_STORAGE
+
+    def defineCustomArguments(self, parser):
+        parser.add_argument('-d',
+                            '--max-distance',
+                            metavar='BITS',
+                            type=int,
+                            default=DEFAULT_MAX_DISTANCE,
+                            help="Images whose %d bit hashes differ in up to this many bits are near duplicates (default %d)"
+                                 % (DHASH_SIZE * DHASH_SIZE, DEFAULT_MAX_DISTANCE),
+                            )
+        parser.add_argument('-r',
+                            '--recursive',
+                            action='store_true',
+                            default=False,
+                            help="Also look at images in subdirectories of the given directories",
+                            )
+        parser.add_argument('-j',
+                            '--jobs',
+                            metavar='N',
+                            type=int,
+                            default=cpu_count(),
+                            help="Hash images in up to N processes at once (default %d, the number of CPUs)" % cpu_count(),
+                            )
+        addMetadataIndexArgument(parser)
+        addRunStatsArguments(parser)
+        addStorageArguments(parser)
+        parser.add_argument('path',
+                            nargs='*',
+                            help="Path(s) of the images, or folders of images, to compare, space separated if multiple",
+                            )
+
+    def doRunSteps(self):
+        self.stats = openRunStats(self.arguments)
+        self.storage = openStorage(self.arguments)
+        self.imageTool = ImageFileInfoTool(self.out, self.system, stats=self.stats, storage=self.storage)
+        metadataIndex = openMetadataIndex(self.out, self.arguments, self.storage)
+        try:
+            runProfiled(self.out, self.arguments, self.findNearDuplicates, metadataIndex)
+        finally:
+            self.storage.close()
+            if metadataIndex:
+                metadataIndex.close()
+                self.out.put(metadataIndex.getStatsMessage(), self.out.LOG_LEVEL_VERBOSE)
+            writeRunStats(self.out, self.arguments, self.stats, 'find-near-duplicates')
+
+    def findNearDuplicates(self, metadataIndex=None):
+        images = self.getImages()
+        hashes = self.getDHashes(images, metadataIndex)
+        with self.stats.timer('cluster'):
+            clusters = findClusters(hashes, self.arguments['max_distance'])
+        self.out.put("Found %d group(s) of near duplicates in %d images" % (len(clusters), len(hashes)))
+        for (i, cluster) in enumerate(clusters):
+            self.out.indent("Group %d (%d images):" % (i + 1, len(cluster)))
+            for fullPath in cluster:
+                self.out.put(fullPath)
+            self.out.unIndent()
+        return clusters
+
+    def getImages(self):
+        '''
+        [(full path, stat result or None)] for the image files given as arguments, and the images in the given directories
+        '''
+        paths = self.getNormalizedPathArgument()
+        isDirectory = dict(zip(paths, self.storage.map(self.storage.isdir, paths)))
+        images = [(path, None) for path in sorted(paths) if not isDirectory[path] and self.imageTool.isImageFilename(path)]
+        for directory in sorted([path for path in paths if isDirectory[path]]):
+            images += list(walkImageFiles(directory, self.arguments['recursive'], self.stats, self.storage))
+        return images
+
+    def getDHashes(self, images, metadataIndex=None):
+        '''
+        {full path: difference hash} for the images that could be read, from the metadata index
+        when they're in it. The others are hashed in batches, in parallel with --jobs.
+        '''
+        hashes = {}
+        toHash = []
+        for (fullPath, statResult) in images:
+            dhash = None
+            if metadataIndex:
+                dhash = metadataIndex.getDHash(fullPath, statResult)
+            if dhash == None:
+                toHash.append((fullPath, statResult))
+            else:
+                hashes[fullPath] = dhash
+        self.out.put("Hashing %d images (%d already hashed)..." % (len(toHash), len(hashes)), self.out.LOG_LEVEL_VERBOSE)
+
+        batches = [toHash[i:i + HASH_BATCH_SIZE] for i in range(0, len(toHash), HASH_BATCH_SIZE)]
+        jobs = min(self.arguments['jobs'], len(batches))
+        with self.stats.timer('hash'):
+            if jobs > 1:
+                pool = Pool(jobs)
+                try:
+                    results = pool.map(computeDHashes, [[fullPath for (fullPath, statResult) in batch] for batch in batches])
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                results = [computeDHashes([fullPath for (fullPath, statResult) in batch], self.storage) for batch in batches]
+        for (batch, batchHashes) in zip(batches, results):
+            for ((fullPath, statResult), dhash) in zip(batch, batchHashes):
+                if dhash == None:
+                    self.out.put("Unable to read %s; leaving it out" % fullPath, self.out.LOG_LEVEL_WARN)
+                    continue
+                hashes[fullPath] = dhash
+                if metadataIndex:
+                    metadataIndex.putDHash(fullPath, dhash, statResult)
+        self.stats.count('files', len(hashes))
+        return hashes
+
+if __name__ == "__main__":
+    from py_base.Job import runMockJob
+    runMockJob(NearDuplicateFinder, arguments={'max_distance': DEFAULT_MAX_DISTANCE,
+                                               'jobs': 2,
+                                               'path': getTestFilePaths()})
@@ -0,0 +1,243 @@
+from collections import deque
+from os import fsync
+from os.path import splitext
+
+from image_tools.RunStats import NULL_RUN_STATS
+from image_tools.Storage import LOCAL_STORAGE
+
+
+JOURNAL_FILENAME = '.image-tools-renames.journal'
+UNDO_FILENAME = '.image-tools-renames.undo'
+TEMP_FILENAME_FORMAT = '.image-tools-rename-%d.tmp'
+UNIQUE_FILENAME_FORMAT = '%s (%d)%s'  # 'title (2).ext'
+
+def getUniqueName(name, takenNames):
+    '''
+    name, or if that's taken, 'title (2).ext', 'title (3).ext' and so on
+    '''
+    (base, ext) = splitext(name)
+    candidate = name
+    number = 2
+    while candidate in takenNames:
+        candidate = UNIQUE_FILENAME_FORMAT % (base, number, ext)
+        number += 1
+    return candidate
+
+def planRenames(wantedNames, existingNames):
+    '''
+    plan the renames for one directory: [(name, new name)], in the order to do them in.
+    See resolveCollisions() and orderRenames().
+    '''
+    targets = resolveCollisions(wantedNames, existingNames)
+    return orderRenames(targets, set(existingNames) | set(targets.values()))
+
+def resolveCollisions(wantedNames, existingNames):
+    '''
+    wantedNames is {current name: wanted name} for files in one directory, and existingNames is
+    everything in the directory (including the files that aren't being renamed).
+
+    Where two files want the same name, or want the name of a file that's staying put, the later
+    one (in sorted order) gets ' (2)' and so on, so the same directory always gets the same names.
+    Returns {name: new name} for the files that really change names.
+    '''
+    moving = set([name for (name, wantedName) in wantedNames.items() if wantedName != name])
+    takenNames = set(existingNames) - moving
+    targets = {}
+    for (wantedName, name) in sorted([(wantedName, name) for (name, wantedName) in wantedNames.items() if name in moving]):
+        newName = getUniqueName(wantedName, takenNames)
+        takenNames.add(newName)
+        if newName != name:
+            targets[name] = newName
+    return targets
+
+def orderRenames(targets, takenNames):
+    '''
+    order {name: new name} renames (new names are all different), so that each file's new name
+    is free by the time it's renamed. takenNames is used to pick temporary names that are free.
+    '''
+    # the rename that's waiting for each name to become free
+    waiting = dict([(newName, name) for (name, newName) in targets.items() if newName in targets])
+    pending = dict(targets)
+    ready = deque(sorted([name for (name, newName) in targets.items() if newName not in targets]))
+    steps = []
+    tempNumber = 0
+    while pending:
+        if not ready:
+            # everything left is in a cycle. Break one by moving a file to a temporary name.
+            name = min(pending)
+            tempNumber += 1
+            while TEMP_FILENAME_FORMAT % tempNumber in takenNames:
+                tempNumber += 1
+            tempName = TEMP_FILENAME_FORMAT % tempNumber
+            steps.append((name, tempName))
+            pending[tempName] = pending.pop(name)
+            waiting[pending[tempName]] = tempName
+            ready.append(waiting.pop(name))
+            continue
+        name = ready.popleft()
+        steps.append((name, pending.pop(name)))
+        if name in waiting:
+            ready.append(waiting.pop(name))
+    return steps
+
+def findDirectoriesWith(fileName, directories, recursive=False, storage=LOCAL_STORAGE):
+    '''
+    the directories (and with recursive, their subdirectories) that have a file called fileName
+    '''
+    if not recursive:
+        found = storage.map(lambda directory: storage.exists('%s/%s' % (directory, fileName)), directories)
+        return [directory for (directory, isFound) in zip(directories, found) if isFound]
+    result = []
+    for directory in directories:
+        found = []
+        # a level at a time, so each level's directories can be listed at once
+        level = [directory]
+        while level:
+            nextLevel = []
+            for (subdirectory, entries) in zip(level, storage.scanDirectories(level)):
+                for (name, fullPath, isDirectory, statFunction) in entries or []:
+                    if isDirectory:
+                        nextLevel.append(fullPath)
+                    elif name == fileName:
+                        found.append(subdirectory)
+            level = nextLevel
+        result += sorted(found)
+    return result
+
+def readJournal(journalFullPath, storage=LOCAL_STORAGE):
+    '''
+    returns ([(name, new name)] steps, how many of them are done)
+    '''
+    steps = []
+    doneCount = 0
+    journal = storage.open(journalFullPath, 'rb')
+    try:
+        for line in journal:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'rename':
+                steps.append((fields[1].decode('string_escape'), fields[2].decode('string_escape')))
+            elif fields[0] == 'done':
+                doneCount += 1
+    finally:
+        journal.close()
+    return (steps, doneCount)
+
+class RenamePlanner:
+    '''
+    Renames the files of a directory as one batch (see planRenames()), with a journal.
+
+    Before the first rename, the whole plan is written to JOURNAL_FILENAME in the directory, and each
+    rename is marked done as it happens. If the run is interrupted, resume() finishes the plan.
+    Once a batch is done, the journal becomes UNDO_FILENAME, which undo() uses to put the names back.
+    '''
+
+    def __init__(self, out, system, debugMode=False, stats=NULL_RUN_STATS, renameCallback=None, storage=LOCAL_STORAGE):
+        self.out = out
+        self.system = system
+        self.debugMode = debugMode
+        self.stats = stats
+        self.renameCallback = renameCallback  # called with (old full path, new full path) after each rename
+        self.storage = storage
+
+    def renameAll(self, directory, wantedNames):
+        '''
+        rename files in directory according to {name: wanted name}
+        '''
+        existingNames = self.storage.listdir(directory)
+        targets = resolveCollisions(wantedNames, existingNames)
+        if not targets:
+            return
+        self.out.indent("Renaming %d file(s) in %s" % (len(targets), directory))
+        for name in sorted(targets):
+            if targets[name] != wantedNames[name]:
+                self.out.put("%s is taken, so %s will be %s" % (wantedNames[name], name, targets[name]), self.out.LOG_LEVEL_WARN)
+                self.stats.count('name collisions')
+        steps = orderRenames(targets, set(existingNames) | set(targets.values()))
+        if self.debugMode:
+            # if we're running in mock mode, then we shouldn't be changing anything on the filesystem.
+            self.out.put("DEBUG: Not writing a rename journal because we're in mock mode")
+            for (name, newName) in steps:
+                self._rename(directory, name, newName)
+        else:
+            self._runJournal(directory, steps, 0)
+        self.out.unIndent()
+
+    def resume(self, directory):
+        '''
+        finish the renames of an interrupted run in directory, if there was one
+        '''
+        journalFullPath = '%s/%s' % (directory, JOURNAL_FILENAME)
+        if not self.storage.exists(journalFullPath):
+            return
+        (steps, doneCount) = readJournal(journalFullPath, self.storage)
+        if doneCount < len(steps):
+            (name, newName) = steps[doneCount]
+            if not self.storage.lexists('%s/%s' % (directory, name)) and self.storage.lexists('%s/%s' % (directory, newName)):
+                # interrupted between the rename and marking it done
+                doneCount += 1
+        self.out.put("Finishing %d interrupted rename(s) in %s" % (len(steps) - doneCount, directory), self.out.LOG_LEVEL_WARN)
+        if self.debugMode:
+            self.out.put("DEBUG: Not finishing them because we're in mock mode")
+            return
+        self._runJournal(directory, steps, doneCount)
+
+    def resumeAll(self, directories, recursive=False):
+        for directory in findDirectoriesWith(JOURNAL_FILENAME, directories, recursive, self.storage):
+            self.resume(directory)
+
+    def undoAll(self, directories, recursive=False):
+        for directory in findDirectoriesWith(UNDO_FILENAME, directories, recursive, self.storage):
+            self.undo(directory)
+
+    def undo(self, directory):
+        '''
+        put back the names from the last batch of renames in directory
+        '''
+        undoFullPath = '%s/%s' % (directory, UNDO_FILENAME)
+        if not self.storage.exists(undoFullPath):
+            self.out.put("Nothing to undo in %s" % directory, self.out.LOG_LEVEL_WARN)
+            return
+        (steps, doneCount) = readJournal(undoFullPath, self.storage)
+        self.out.indent("Undoing %d rename(s) in %s" % (doneCount, directory))
+        for (name, newName) in reversed(steps[:doneCount]):
+            if self.storage.lexists('%s/%s' % (directory, name)) or not self.storage.lexists('%s/%s' % (directory, newName)):
+                self.out.put("ERROR: Unable to rename %s back to %s; it has changed since" % (newName, name), self.out.LOG_LEVEL_ERROR)
+                continue
+            self._rename(directory, newName, name)
+        if self.debugMode:
+            self.out.put("DEBUG: Not removing %s because we're in mock mode" % undoFullPath)
+        else:
+            self.storage.remove(undoFullPath)
+        self.out.unIndent()
+
+    def _runJournal(self, directory, steps, doneCount):
+        journalFullPath = '%s/%s' % (directory, JOURNAL_FILENAME)
+        if doneCount == 0:
+            journal = self.storage.open(journalFullPath, 'wb')
+            for (name, newName) in steps:
+                journal.write('rename\t%s\t%s\n' % (name.encode('string_escape'), newName.encode('string_escape')))
+            # the plan has to be on disk before anything is renamed, or it can't be resumed
+            journal.flush()
+            if hasattr(journal, 'fileno'):
+                fsync(journal.fileno())
+        else:
+            missingDoneCount = doneCount - readJournal(journalFullPath, self.storage)[1]
+            journal = self.storage.open(journalFullPath, 'ab')
+            journal.write('done\n' * missingDoneCount)
+        try:
+            for (name, newName) in steps[doneCount:]:
+                self._rename(directory, name, newName)
+                journal.write('done\n')
+                journal.flush()
+        finally:
+            journal.close()
+        self.system.rename(journalFullPath, '%s/%s' % (directory, UNDO_FILENAME))
+
+    def _rename(self, directory, name, newName):
+        oldFullPath = '%s/%s' % (directory, name)
+        newFullPath = '%s/%s' % (directory, newName)
+        with self.stats.timer('rename'):
+            self.system.rename(oldFullPath, newFullPath)
+        self.stats.count('renames')
+        if self.renameCallback and not self.debugMode:
+            self.renameCallback(oldFullPath, newFullPath)
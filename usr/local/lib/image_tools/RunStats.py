@@ -0,0 +1,150 @@
+import json
+from os import makedirs
+from os.path import dirname, exists, expanduser
+import time
+
+
+def addRunStatsArguments(parser):
+    parser.add_argument('--stats-file',
+                        metavar='PATH',
+                        help="Write a JSON summary of the run (time per phase, files/s, bytes read and written) to PATH",
+                        )
+    parser.add_argument('--profile',
+                        metavar='PATH',
+                        help="Run under cProfile, and write the profile to PATH (read it with python -m pstats PATH)",
+                        )
+
+def openRunStats(arguments):
+    '''
+    a RunStats for a job if --stats-file was given, otherwise NULL_RUN_STATS
+    '''
+    if arguments.get('stats_file'):
+        return RunStats()
+    return NULL_RUN_STATS
+
+def runProfiled(out, arguments, function, *args):
+    '''
+    call function(*args), under cProfile if --profile was given
+    '''
+    if not arguments.get('profile'):
+        return function(*args)
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        profile.dump_stats(expanduser(arguments['profile']))
+        out.put("Wrote the profile to %s" % arguments['profile'], out.LOG_LEVEL_VERBOSE)
+
+def writeRunStats(out, arguments, stats, toolName):
+    if not stats.enabled:
+        return
+    statsFullPath = expanduser(arguments['stats_file'])
+    try:
+        if dirname(statsFullPath) and not exists(dirname(statsFullPath)):
+            makedirs(dirname(statsFullPath))
+        json.dump(stats.getSummary(toolName), open(statsFullPath, 'w'), indent=1, sort_keys=True)
+    except (IOError, OSError), e:
+        out.put("ERROR: Unable to write the run stats to %s: %s" % (statsFullPath, e), out.LOG_LEVEL_ERROR)
+        return
+    out.put("Wrote the run stats to %s" % statsFullPath, out.LOG_LEVEL_VERBOSE)
+
+class PhaseTimer:
+
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stats.addTime(self.phase, time.time() - self.start)
+        return False
+
+class RunStats:
+    '''
+    Time spent per phase (eg. 'decode', 'save', 'listdir') and counters (eg. 'files', 'bytes read')
+    for a run of one of the tools:
+
+        with self.stats.timer('decode'):
+            ...
+        self.stats.count('files')
+
+    Phase times from worker processes are merged in (see merge()), so with --jobs they
+    add up to more than the run's wall clock time.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}  # phase -> [seconds, calls]
+        self.counters = {}
+
+    def timer(self, phase):
+        return PhaseTimer(self, phase)
+
+    def addTime(self, phase, seconds, calls=1):
+        if phase not in self.phases:
+            self.phases[phase] = [0.0, 0]
+        self.phases[phase][0] += seconds
+        self.phases[phase][1] += calls
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def asDict(self):
+        '''
+        the raw numbers, to hand back from a worker process (see merge())
+        '''
+        return {'phases': self.phases, 'counters': self.counters}
+
+    def merge(self, statsDict):
+        if statsDict == None:
+            return
+        for (phase, (seconds, calls)) in statsDict['phases'].items():
+            self.addTime(phase, seconds, calls)
+        for (counter, amount) in statsDict['counters'].items():
+            self.count(counter, amount)
+
+    def getSummary(self, toolName):
+        seconds = time.time() - self.start
+        return {'tool': toolName,
+                'seconds': seconds,
+                'files per second': self.counters.get('files', 0) / max(seconds, 0.000001),
+                'phases': dict([(phase, {'seconds': phaseSeconds, 'calls': calls})
+                                for (phase, (phaseSeconds, calls)) in self.phases.items()]),
+                'counters': self.counters}
+
+class NullPhaseTimer:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+class NullRunStats:
+    '''
+    RunStats that doesn't keep anything, for when --stats-file wasn't given.
+    Callers that need to do extra work (eg. a stat() call) just for the stats should check enabled first.
+    '''
+    enabled = False
+    nullTimer = NullPhaseTimer()
+
+    def timer(self, phase):
+        return self.nullTimer
+
+    def addTime(self, phase, seconds, calls=1):
+        pass
+
+    def count(self, counter, amount=1):
+        pass
+
+    def asDict(self):
+        return None
+
+    def merge(self, statsDict):
+        pass
+
+NULL_RUN_STATS = NullRunStats()
@@ -0,0 +1,86 @@
+import json
+from os.path import basename
+
+from image_tools.Storage import LOCAL_STORAGE
+
+
+MANIFEST_FILENAME = '.image-tools-scaled.json'
+
+class ScaleManifest:
+    '''
+    What ImageScaler has made in one directory: for each source file, the size and mtime it had
+    when it was scaled, and the render parameters it was scaled with. Kept as JSON in
+    MANIFEST_FILENAME, next to the sources (and their .scaled outputs).
+
+    A missing or unreadable manifest is just an empty one; everything gets rebuilt.
+    '''
+
+    def __init__(self, directory, storage=LOCAL_STORAGE):
+        self.fullPath = '%s/%s' % (directory, MANIFEST_FILENAME)
+        self.storage = storage
+        self.changed = False
+        try:
+            self.entries = json.load(storage.open(self.fullPath))
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def getKey(self, sourceFullPath):
+        '''
+        json keys are unicode, so names that aren't utf-8 can't be recorded (they're always rebuilt)
+        '''
+        try:
+            return basename(sourceFullPath).decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def hasEntry(self, sourceFullPath, parameters):
+        '''
+        whether the source was scaled with these parameters at some point (if not, it isn't current
+        no matter what's on disk)
+        '''
+        entry = self.entries.get(self.getKey(sourceFullPath))
+        return entry != None and entry['parameters'] == parameters
+
+    def isCurrent(self, sourceFullPath, parameters, targetFullPaths, statResults=None):
+        '''
+        True if the source hasn't changed since it was scaled with these parameters,
+        and all of its outputs are still there. statResults is {full path: stat result or None}
+        for the source and its outputs, if they've been looked up already.
+        '''
+        if not self.hasEntry(sourceFullPath, parameters):
+            return False
+        if statResults == None:
+            fullPaths = [sourceFullPath] + targetFullPaths
+            statResults = dict(zip(fullPaths, self.storage.statMany(fullPaths)))
+        entry = self.entries[self.getKey(sourceFullPath)]
+        statResult = statResults[sourceFullPath]
+        if statResult == None or entry['size'] != statResult.st_size or entry['mtime'] != statResult.st_mtime:
+            return False
+        for targetFullPath in targetFullPaths:
+            if statResults[targetFullPath] == None:
+                return False
+        return True
+
+    def record(self, sourceFullPath, parameters, statResult=None):
+        key = self.getKey(sourceFullPath)
+        if key == None:
+            return
+        if statResult == None:
+            statResult = self.storage.stat(sourceFullPath)
+        self.entries[key] = {'size': statResult.st_size,
+                             'mtime': statResult.st_mtime,
+                             'parameters': parameters}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        # write it next to the old one and rename it into place, so an interrupted run can't leave half a manifest
+        tempFullPath = '%s.tmp' % self.fullPath
+        f = self.storage.open(tempFullPath, 'w')
+        try:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        self.storage.rename(tempFullPath, self.fullPath)
+        self.changed = False
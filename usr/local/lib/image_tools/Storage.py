@@ -0,0 +1,352 @@
+'''
+Where the tools' files live: listing, metadata, reads, copies and renames.
+
+LocalStorage is the ordinary filesystem, one operation at a time. ConcurrentStorage wraps another
+storage and runs the bulk operations (statMany(), scanDirectories(), copyMany()) in a pool of
+threads, so on a high latency mount (SMB, NFS) many of them are in flight at once instead of each
+one waiting for the last. MemoryStorage is a fake filesystem in memory, with an optional delay per
+operation, for tests and benchmarks.
+
+Single writes done by the tools still go through their system object (PySystemMock in mock mode);
+the storage is what sits underneath. Image and EXIF header reads go through the storage too, but
+some things can only work on a local path: pyexiv2 (the EXIF fallback, and copying EXIF to scaled
+files), jpegtran (--rotate-only) and PIL saving the scaled files.
+'''
+from collections import namedtuple
+from cStringIO import StringIO
+import os
+from os.path import basename, dirname, islink
+import shutil
+from stat import S_IFDIR, S_IFREG, S_ISDIR
+import threading
+import time
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport of os.scandir for python < 3.5
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+DEFAULT_IO_THREADS = 16
+
+def addStorageArguments(parser):
+    parser.add_argument('--io-threads',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="Keep up to N file operations (listing, stat, copy) in flight at once. "
+                             "Helps a lot on network mounts (SMB, NFS); try %d (default 1)" % DEFAULT_IO_THREADS,
+                        )
+
+def openStorage(arguments):
+    '''
+    LOCAL_STORAGE, or a ConcurrentStorage over it if --io-threads was given
+    '''
+    threads = arguments.get('io_threads') or 1
+    if threads > 1:
+        return ConcurrentStorage(LOCAL_STORAGE, threads)
+    return LOCAL_STORAGE
+
+def _callOrNone(function, *args):
+    try:
+        return function(*args)
+    except (IOError, OSError):
+        return None
+
+def _callOrError(function, *args):
+    try:
+        function(*args)
+        return None
+    except (IOError, OSError), e:
+        return e
+
+class Storage:
+    '''
+    The bulk operations, in terms of the single ones. Here they run one at a time;
+    ConcurrentStorage overrides map() to run them in parallel.
+    '''
+    concurrent = False
+
+    def map(self, function, items):
+        return [function(item) for item in items]
+
+    def statMany(self, fullPaths):
+        '''
+        [stat result, or None if it's gone] for each path
+        '''
+        return self.map(lambda fullPath: _callOrNone(self.stat, fullPath), fullPaths)
+
+    def scanDirectories(self, directories):
+        '''
+        [scanDirectory() result, or None if it can't be read] for each directory
+        '''
+        return self.map(lambda directory: _callOrNone(self.scanDirectory, directory), directories)
+
+    def copyMany(self, copies):
+        '''
+        do [(source, target)] copies. Returns [None, or the error] for each.
+        '''
+        return self.map(lambda (sourceFullPath, targetFullPath): _callOrError(self.copy, sourceFullPath, targetFullPath), copies)
+
+    def close(self):
+        pass
+
+class LocalStorage(Storage):
+
+    def listdir(self, directory):
+        return os.listdir(directory)
+
+    def scanDirectory(self, directory):
+        '''
+        list (name, full path, is a real directory, stat function) for the entries of a directory.
+        With scandir, the directory check usually needs no stat() call at all, and the stat
+        result is cached on the entry.
+        '''
+        if scandir != None:
+            return [(entry.name, entry.path, entry.is_dir(follow_symlinks=False), entry.stat)
+                    for entry in scandir(directory)]
+        entries = []
+        for name in os.listdir(directory):
+            fullPath = '%s/%s' % (directory, name)
+            try:
+                statResult = os.stat(fullPath)
+            except OSError:
+                continue
+            entries.append((name, fullPath, S_ISDIR(statResult.st_mode) and not islink(fullPath), lambda statResult=statResult: statResult))
+        return entries
+
+    def stat(self, fullPath):
+        return os.stat(fullPath)
+
+    def isdir(self, fullPath):
+        return os.path.isdir(fullPath)
+
+    def exists(self, fullPath):
+        return os.path.exists(fullPath)
+
+    def lexists(self, fullPath):
+        return os.path.lexists(fullPath)
+
+    def getmtime(self, fullPath):
+        return os.path.getmtime(fullPath)
+
+    def getsize(self, fullPath):
+        return os.path.getsize(fullPath)
+
+    def open(self, fullPath, mode='rb'):
+        return open(fullPath, mode)
+
+    def copy(self, sourceFullPath, targetFullPath):
+        shutil.copy2(sourceFullPath, targetFullPath)
+
+    def rename(self, oldFullPath, newFullPath):
+        os.rename(oldFullPath, newFullPath)
+
+    def mkdir(self, fullPath):
+        os.mkdir(fullPath)
+
+    def remove(self, fullPath):
+        os.remove(fullPath)
+
+    def utime(self, fullPath, times):
+        os.utime(fullPath, times)
+
+LOCAL_STORAGE = LocalStorage()
+
+class ConcurrentStorage(Storage):
+    '''
+    Runs the bulk operations of another storage in a pool of threads. The single operations
+    are passed straight through.
+
+    Threads are enough (no processes needed): file operations release the GIL while they wait.
+    '''
+    concurrent = True
+
+    def __init__(self, storage=LOCAL_STORAGE, threads=DEFAULT_IO_THREADS):
+        self.storage = storage
+        self.threads = threads
+        self.pool = None
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def map(self, function, items):
+        items = list(items)
+        if len(items) < 2:
+            return [function(item) for item in items]
+        if self.pool == None:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(self.threads)
+        # chunksize=1: each operation is mostly waiting, so hand them out one by one
+        return self.pool.map(function, items, 1)
+
+    def close(self):
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+MemoryStat = namedtuple('MemoryStat', ['st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+                                       'st_size', 'st_atime', 'st_mtime', 'st_ctime'])
+
+class MemoryFile:
+    '''
+    a file being written to a MemoryStorage; it appears when it's closed
+    '''
+
+    def __init__(self, storage, fullPath, data=''):
+        self.storage = storage
+        self.fullPath = fullPath
+        self.buffer = StringIO()
+        self.buffer.write(data)
+        self.write = self.buffer.write
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.storage.putFile(self.fullPath, self.buffer.getvalue())
+
+class MemoryStorage(Storage):
+    '''
+    A filesystem in memory, for tests and benchmarks. Each operation first sleeps for latency
+    seconds, like a round trip to a file server would (and like one, it doesn't hold the GIL).
+    '''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.files = {}  # full path -> (data, mtime, inode)
+        self.children = {'/': set()}  # directory -> names in it
+        self.nextInode = 1
+        self.operations = 0
+
+    def _wait(self):
+        with self.lock:
+            self.operations += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _parent(self, fullPath):
+        directory = dirname(fullPath)
+        if directory not in self.children:
+            raise OSError(2, "No such directory", directory)
+        return self.children[directory]
+
+    def putFile(self, fullPath, data, mtime=None):
+        '''
+        create (or replace) a file, and any directories it needs, without any latency
+        '''
+        with self.lock:
+            directory = dirname(fullPath)
+            missing = []
+            while directory not in self.children:
+                missing.append(directory)
+                directory = dirname(directory)
+            for directory in reversed(missing):
+                self.children[dirname(directory)].add(basename(directory))
+                self.children[directory] = set()
+            self.children[dirname(fullPath)].add(basename(fullPath))
+            self.files[fullPath] = (data, mtime or time.time(), self.nextInode)
+            self.nextInode += 1
+
+    def _stat(self, fullPath):
+        if fullPath in self.children:
+            return MemoryStat(S_IFDIR | 0755, 0, 0, 2, 0, 0, 0, 0, 0, 0)
+        if fullPath not in self.files:
+            raise OSError(2, "No such file or directory", fullPath)
+        (data, mtime, inode) = self.files[fullPath]
+        return MemoryStat(S_IFREG | 0644, inode, 0, 1, 0, 0, len(data), mtime, mtime, mtime)
+
+    def listdir(self, directory):
+        self._wait()
+        if directory not in self.children:
+            raise OSError(2, "No such directory", directory)
+        return list(self.children[directory])
+
+    def scanDirectory(self, directory):
+        '''
+        like LocalStorage.scanDirectory(): the listing says which entries are directories,
+        but each stat() is another round trip
+        '''
+        entries = []
+        for name in self.listdir(directory):
+            fullPath = '%s/%s' % (directory.rstrip('/'), name)
+            entries.append((name, fullPath, fullPath in self.children, lambda fullPath=fullPath: self.stat(fullPath)))
+        return entries
+
+    def stat(self, fullPath):
+        self._wait()
+        return self._stat(fullPath)
+
+    def isdir(self, fullPath):
+        self._wait()
+        return fullPath in self.children
+
+    def exists(self, fullPath):
+        self._wait()
+        return fullPath in self.children or fullPath in self.files
+
+    lexists = exists  # (there are no links)
+
+    def getmtime(self, fullPath):
+        return self.stat(fullPath).st_mtime
+
+    def getsize(self, fullPath):
+        return self.stat(fullPath).st_size
+
+    def open(self, fullPath, mode='rb'):
+        self._wait()
+        if 'w' in mode:
+            self._parent(fullPath)
+            return MemoryFile(self, fullPath)
+        if 'a' in mode:
+            self._parent(fullPath)
+            return MemoryFile(self, fullPath, self.files.get(fullPath, ('',))[0])
+        if fullPath not in self.files:
+            raise IOError(2, "No such file", fullPath)
+        return StringIO(self.files[fullPath][0])
+
+    def copy(self, sourceFullPath, targetFullPath):
+        self._wait()
+        if sourceFullPath not in self.files:
+            raise IOError(2, "No such file", sourceFullPath)
+        self._parent(targetFullPath)
+        (data, mtime, inode) = self.files[sourceFullPath]
+        self.putFile(targetFullPath, data, mtime)
+
+    def rename(self, oldFullPath, newFullPath):
+        self._wait()
+        with self.lock:
+            if oldFullPath not in self.files:
+                raise OSError(2, "No such file", oldFullPath)
+            self._parent(newFullPath).add(basename(newFullPath))
+            self._parent(oldFullPath).discard(basename(oldFullPath))
+            self.files[newFullPath] = self.files.pop(oldFullPath)
+
+    def mkdir(self, fullPath):
+        self._wait()
+        with self.lock:
+            if fullPath in self.children or fullPath in self.files:
+                raise OSError(17, "File exists", fullPath)
+            self._parent(fullPath).add(basename(fullPath))
+            self.children[fullPath] = set()
+
+    def remove(self, fullPath):
+        self._wait()
+        with self.lock:
+            if fullPath not in self.files:
+                raise OSError(2, "No such file", fullPath)
+            del self.files[fullPath]
+            self._parent(fullPath).discard(basename(fullPath))
+
+    def utime(self, fullPath, times):
+        self._wait()
+        with self.lock:
+            if fullPath not in self.files:
+                raise OSError(2, "No such file", fullPath)
+            (data, mtime, inode) = self.files[fullPath]
+            self.files[fullPath] = (data, times[1], inode)